@@ -52,6 +52,9 @@ WSGI_APPLICATION = 'app.wsgi.application'
 
 APP_INDEX = os.environ.get("APP", "")
 
+# Outgoing messages waiting to be sent
+WEBMAIL_MAILER_SPOOL_DIR = os.path.join(BASE_DIR, 'webmail_spool%s' % APP_INDEX)
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
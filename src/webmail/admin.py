@@ -11,10 +11,10 @@ from .models import WebmailUser, WebmailSession, AccessLog, ContactUser, Mailbox
 
 class MailboxAdmin(admin.ModelAdmin):
     list_per_page = 10
-    list_display = ('id', 'name', 'user', 'is_default', 'emails', 'created_at')
+    list_display = ('id', 'name', 'user', 'is_default', 'emails', 'send_weight', 'created_at')
     list_filter = ('is_default', )
 
-    readonly_fields = ('user', 'name', 'is_default', 'emails', 'created_at')
+    readonly_fields = ('user', 'name', 'is_default', 'emails', 'send_weight', 'created_at')
     search_fields = ('user', 'name')
 
     def has_add_permission(self, request, obj=None):
@@ -26,8 +26,8 @@ class MailboxAdmin(admin.ModelAdmin):
 
 class Pop3MailServerAdmin(admin.ModelAdmin):
     list_per_page = 10
-    list_display = ('id', 'mailbox', 'active', 'username', 'password', 'ip_address', 'port', 'use_ssl', 'last_polling')
-    readonly_fields = ('mailbox', 'active', 'username', 'password', 'ip_address', 'port', 'use_ssl', 'last_polling',)
+    list_display = ('id', 'mailbox', 'active', 'username', 'password', 'ip_address', 'port', 'use_ssl', 'leave_messages_on_server', 'last_polling')
+    readonly_fields = ('mailbox', 'active', 'username', 'password', 'ip_address', 'port', 'use_ssl', 'leave_messages_on_server', 'last_polling',)
 
     def has_add_permission(self, request, obj=None):
         return False
@@ -39,7 +39,7 @@ class Pop3MailServerAdmin(admin.ModelAdmin):
 class SmtpServerAdmin(admin.ModelAdmin):
     list_per_page = 10
     list_display = ('id', 'mailbox', 'ip_address', 'port', 'username', 'password', 'use_tls', 'use_ssl', 'from_email', 'from_name',)
-    readonly_fields = ('mailbox', 'ip_address', 'port', 'username', 'password', 'use_tls', 'use_ssl', 'from_email', 'from_name')
+    readonly_fields = ('mailbox', 'ip_address', 'port', 'username', 'password', 'use_tls', 'use_ssl', 'from_email', 'from_name', 'max_messages_per_minute', 'max_messages_burst')
 
     def from_email_header(self, instance):
         return instance.get_from_email_header_value()
@@ -211,10 +211,15 @@ class WebmailUserAdmin(admin.ModelAdmin):
 
 class SendMailTaskAdmin(admin.ModelAdmin):
     list_per_page = 10
-    list_display = ["id", "priority", "status", "created_at","num_deferred_times", "scheduled_time", "last_sent_at",  "show_logs"]
-    readonly_fields = ["priority", "status", "created_at","num_deferred_times", "scheduled_time", "last_sent_at"]
+    list_display = ["id", "subject", "envelope_sender", "num_recipients", "payload_size", "priority", "status", "created_at","num_deferred_times", "scheduled_time", "last_sent_at",  "show_logs"]
+    readonly_fields = ["subject", "envelope_sender", "num_recipients", "payload_size", "priority", "status", "created_at","num_deferred_times", "scheduled_time", "last_sent_at"]
     date_hierarchy = "created_at"
     list_filter = ("priority", "status",)
+    search_fields = ("subject", "envelope_sender")
+
+    def get_queryset(self, request):
+        # The payload is not needed to list the tasks
+        return super().get_queryset(request).defer("multipart_mail_message")
 
 #    def show_to(self, instance):
 #        return ", ".join(instance.email_recipients)
@@ -279,9 +284,9 @@ class SendMailTaskExceptionLogAdmin(admin.ModelAdmin):
 
 class SendMailTaskErrorRecipientAdmin(admin.ModelAdmin):
     list_per_page = 10
-    list_display = ["id", "task_batch", "code", "response"]
-    list_filter = ["code"]
-    readonly_fields = ["id", "task_batch", "code", "response"]
+    list_display = ["id", "task_batch", "recipient", "code", "response", "retry"]
+    list_filter = ["code", "retry"]
+    readonly_fields = ["id", "task_batch", "recipient", "code", "response", "retry"]
 
     def has_add_permission(self, request, obj=None):
         return False
@@ -0,0 +1,568 @@
+import asyncio
+import base64
+import hmac
+import re
+import smtplib
+import socket
+import ssl
+import time
+
+
+from . import settings, metrics
+from .smtp_transport import CRLF, TRANSACTION_ERRORS, iter_data_chunks, split_recipients, SMTPRecipientChunksFailed
+from .logutils import get_logger
+
+
+logger = get_logger()
+
+
+# Max length of a reply line accepted from the server, like smtplib
+MAX_LINE_LENGTH = 8192
+
+
+def _create_ssl_context():
+    # Same behaviour as smtplib, used by the synchronous engine: the
+    # certificate of the server is not verified.
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class AsyncSmtpTransport:
+    """
+    Minimal SMTP client over asyncio streams with the same interface and
+    exceptions as `SmtpTransport`, so many sessions can be open at the same
+    time in a single process.
+    """
+
+    def __init__(self, hostname, port=None, ssl=False, tls=False, timeout=settings.WEBMAIL_MAILER_SMTP_TIMEOUT, metrics_label=None):
+        self.hostname = hostname or "localhost"
+        if port is None:
+            port = smtplib.SMTP_SSL_PORT if ssl else smtplib.SMTP_PORT
+
+        self.port = port
+        self.use_ssl = ssl
+        self.use_tls = tls
+        self.timeout = timeout
+        self.metrics_label = metrics_label
+
+        self.reader = None
+        self.writer = None
+        self.esmtp_features = {}
+        self.last_used_at = None
+        # See `SmtpTransport.mail_accepted`
+        self.mail_accepted = False
+
+    @property
+    def is_connected(self):
+        return self.writer is not None
+
+    async def _open(self):
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(
+                    self.hostname,
+                    self.port,
+                    ssl=_create_ssl_context() if self.use_ssl else None,
+                    limit=MAX_LINE_LENGTH * 2),
+                self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("Timeout connecting to %s:%s" % (self.hostname, self.port))
+
+        code, message = await self._read_reply()
+        if code != 220:
+            await self._abort()
+            raise smtplib.SMTPConnectError(code, message)
+
+    async def _abort(self):
+        writer = self.writer
+
+        self.reader = None
+        self.writer = None
+
+        if writer is not None:
+            writer.close()
+            try:
+                await asyncio.wait_for(writer.wait_closed(), self.timeout)
+            except (asyncio.TimeoutError, OSError, ssl.SSLError):
+                pass
+
+    async def _read_reply(self):
+        lines = []
+
+        while True:
+            try:
+                line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            except asyncio.TimeoutError:
+                await self._abort()
+                raise smtplib.SMTPServerDisconnected("Timeout waiting for a reply of the server")
+            except (ValueError, asyncio.LimitOverrunError):
+                await self._abort()
+                raise smtplib.SMTPResponseException(500, "Line too long.")
+            except OSError as e:
+                await self._abort()
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed: %s" % e)
+
+            if not line:
+                await self._abort()
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+
+            lines.append(line[4:].strip(b" \t\r\n"))
+
+            try:
+                code = int(line[:3])
+            except ValueError:
+                code = -1
+                break
+
+            # Check if multiline response
+            if line[3:4] != b"-":
+                break
+
+        return code, b"\n".join(lines)
+
+    async def _send(self, data):
+        if self.writer is None:
+            raise smtplib.SMTPServerDisconnected("please run connect() first")
+
+        try:
+            self.writer.write(data)
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            await self._abort()
+            raise smtplib.SMTPServerDisconnected("Server not connected: %s" % e)
+
+    async def command(self, cmd, args=""):
+        if args:
+            line = "%s %s" % (cmd, args)
+        else:
+            line = cmd
+
+        await self._send(line.encode("ascii") + CRLF)
+        return await self._read_reply()
+
+    async def ehlo(self):
+        code, message = await self.command("EHLO", socket.getfqdn())
+        if code != 250:
+            code, message = await self.command("HELO", socket.getfqdn())
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, message)
+
+            self.esmtp_features = {}
+            return
+
+        features = {}
+        for line in message.decode("latin-1").split("\n")[1:]:
+            match = re.match(r"(?P<feature>[A-Za-z0-9][A-Za-z0-9\-]*) ?", line)
+            if match is None:
+                continue
+
+            feature = match.group("feature").lower()
+            params = line[match.end("feature"):].strip()
+
+            if feature == "auth":
+                features[feature] = features.get(feature, "") + " " + params
+            else:
+                features[feature] = params
+
+        self.esmtp_features = features
+
+    def has_extn(self, opt):
+        return opt.lower() in self.esmtp_features
+
+    async def starttls(self):
+        if not self.has_extn("starttls"):
+            raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+
+        if not hasattr(self.writer, "start_tls"):
+            raise smtplib.SMTPNotSupportedError("STARTTLS with the asyncio engine requires Python 3.11 or later.")
+
+        code, message = await self.command("STARTTLS")
+        if code != 220:
+            raise smtplib.SMTPResponseException(code, message)
+
+        try:
+            await asyncio.wait_for(self.writer.start_tls(_create_ssl_context(), server_hostname=self.hostname), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            await self._abort()
+            raise smtplib.SMTPServerDisconnected("TLS negotiation failed: %s" % e)
+
+        # RFC 3207: the client must discard the knowledge obtained from the server
+        self.esmtp_features = {}
+
+    async def _auth(self, mechanism, username, password):
+        if mechanism == "CRAM-MD5":
+            code, message = await self.command("AUTH", mechanism)
+            if code == 334:
+                challenge = base64.decodebytes(message)
+                response = username + " " + hmac.HMAC(password.encode("ascii"), challenge, "md5").hexdigest()
+                code, message = await self.command(base64.b64encode(response.encode("ascii")).decode("ascii"))
+        elif mechanism == "PLAIN":
+            response = "\0%s\0%s" % (username, password)
+            code, message = await self.command("AUTH", "PLAIN " + base64.b64encode(response.encode("ascii")).decode("ascii"))
+        else:
+            code, message = await self.command("AUTH", "LOGIN " + base64.b64encode(username.encode("ascii")).decode("ascii"))
+            if code == 334:
+                code, message = await self.command(base64.b64encode(password.encode("ascii")).decode("ascii"))
+
+        return code, message
+
+    async def login(self, username, password):
+        if not self.has_extn("auth"):
+            raise smtplib.SMTPNotSupportedError("SMTP AUTH extension not supported by server.")
+
+        advertised_mechanisms = self.esmtp_features["auth"].upper().split()
+        mechanisms = [mechanism for mechanism in ("CRAM-MD5", "PLAIN", "LOGIN") if mechanism in advertised_mechanisms]
+        if not mechanisms:
+            raise smtplib.SMTPException("No suitable authentication method found.")
+
+        password = password or ""
+
+        last_exception = None
+        for mechanism in mechanisms:
+            code, message = await self._auth(mechanism, username, password)
+            if code in (235, 503):
+                return code, message
+
+            last_exception = smtplib.SMTPAuthenticationError(code, message)
+
+        raise last_exception
+
+    def _observe(self, histogram, start_time):
+        if self.metrics_label is not None:
+            histogram.observe(time.monotonic() - start_time, smtp_server=self.metrics_label)
+
+    async def connect(self, username, password):
+        start_time = time.monotonic()
+
+        await self._open()
+
+        try:
+            await self.ehlo()
+
+            # TLS/SSL are mutually exclusive, so only attempt TLS over
+            # non-secure connections.
+            if not self.use_ssl and self.use_tls:
+                await self.starttls()
+                await self.ehlo()
+
+            self._observe(metrics.SMTP_CONNECT_SECONDS, start_time)
+
+            start_time = time.monotonic()
+            await self.login(username, password)
+            self._observe(metrics.SMTP_AUTH_SECONDS, start_time)
+        except BaseException:
+            await self.close()
+            raise
+
+        self.last_used_at = time.monotonic()
+
+    async def reset(self):
+        """
+        Aborts any pending mail transaction so the session can be reused for
+        the next message.
+        """
+        code, message = await self.command("RSET")
+        if code != 250:
+            raise smtplib.SMTPResponseException(code, message)
+
+        self.last_used_at = time.monotonic()
+
+    async def _rset_quietly(self):
+        try:
+            await self.command("RSET")
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    async def sendmail(self, from_email, recipient_list, multipart_mail_message):
+        """
+        Same semantics as `smtplib.SMTP.sendmail`: returns a dictionary with
+        the refused recipients and raises an exception if the message was not
+        accepted for any recipient.
+        """
+        try:
+            return await self._sendmail(from_email, recipient_list, multipart_mail_message)
+        finally:
+            self.last_used_at = time.monotonic()
+
+    async def _send_envelope(self, from_email, recipient_list, mail_options):
+        """
+        Same as `SmtpTransport._send_envelope`: sends MAIL FROM and the RCPT TO
+        commands, pipelined if the server supports it, and returns their
+        replies.
+        """
+        mail_command = "MAIL FROM:%s%s" % (smtplib.quoteaddr(from_email), mail_options)
+        recipient_commands = ["RCPT TO:%s" % smtplib.quoteaddr(recipient) for recipient in recipient_list]
+
+        if self.has_extn("pipelining"):
+            await self._send("".join(command + "\r\n" for command in [mail_command] + recipient_commands).encode("ascii"))
+
+            mail_reply = await self._read_reply()
+            if mail_reply[0] == 421:
+                return mail_reply, []
+
+            self.mail_accepted = mail_reply[0] == 250
+
+            recipient_replies = []
+            for _command in recipient_commands:
+                reply = await self._read_reply()
+                recipient_replies.append(reply)
+
+                if reply[0] == 421:
+                    break
+        else:
+            mail_reply = await self.command(mail_command)
+            if mail_reply[0] != 250:
+                return mail_reply, []
+
+            self.mail_accepted = True
+
+            recipient_replies = []
+            for command in recipient_commands:
+                reply = await self.command(command)
+                recipient_replies.append(reply)
+
+                if reply[0] == 421:
+                    break
+
+        return mail_reply, recipient_replies
+
+    async def _sendmail(self, from_email, recipient_list, multipart_mail_message):
+        self.mail_accepted = False
+
+        if isinstance(multipart_mail_message, str):
+            multipart_mail_message = multipart_mail_message.encode("ascii")
+
+        if isinstance(recipient_list, str):
+            recipient_list = [recipient_list]
+
+        mail_options = ""
+        if self.has_extn("size"):
+            mail_options = " SIZE=%d" % len(multipart_mail_message)
+
+        (code, message), recipient_replies = await self._send_envelope(from_email, recipient_list, mail_options)
+        if code != 250:
+            if code == 421:
+                await self.close()
+            else:
+                await self._rset_quietly()
+            raise smtplib.SMTPSenderRefused(code, message, from_email)
+
+        refused_recipients = {}
+        for recipient, (code, message) in zip(recipient_list, recipient_replies):
+            if code not in (250, 251):
+                refused_recipients[recipient] = (code, message)
+
+            if code == 421:
+                await self.close()
+                raise smtplib.SMTPRecipientsRefused(refused_recipients)
+
+        if len(refused_recipients) == len(recipient_list):
+            # The server refused all our recipients
+            await self._rset_quietly()
+            raise smtplib.SMTPRecipientsRefused(refused_recipients)
+
+        data_start_time = time.monotonic()
+
+        code, message = await self.command("DATA")
+        if code != 354:
+            if code == 421:
+                await self.close()
+            else:
+                await self._rset_quietly()
+            raise smtplib.SMTPDataError(code, message)
+
+        # Spooled messages are read from a local file in chunks, waiting for
+        # the server to receive each one before reading the next
+        for chunk in iter_data_chunks(multipart_mail_message):
+            await self._send(chunk)
+
+        await self._send(b"." + CRLF)
+
+        code, message = await self._read_reply()
+        self._observe(metrics.SMTP_DATA_SECONDS, data_start_time)
+
+        if code != 250:
+            if code == 421:
+                await self.close()
+            else:
+                await self._rset_quietly()
+            raise smtplib.SMTPDataError(code, message)
+
+        return refused_recipients
+
+    async def close(self):
+        if self.writer is None:
+            return
+
+        try:
+            await self.command("QUIT")
+        except (smtplib.SMTPException, OSError, ssl.SSLError):
+            # The connection was already disconnected by the server
+            pass
+
+        await self._abort()
+
+
+class AsyncSmtpConnectionPool:
+    """
+    Asyncio version of `SmtpConnectionPool`. Several sessions with the same
+    SMTP server can be open at the same time, one for each message being sent
+    concurrently, and are reused by the next messages after a RSET.
+    """
+
+    def __init__(self, idle_timeout=settings.WEBMAIL_MAILER_SMTP_CONNECTION_IDLE_TIMEOUT, timeout=settings.WEBMAIL_MAILER_SMTP_TIMEOUT, max_recipients=settings.WEBMAIL_MAILER_MAX_RECIPIENTS_PER_TRANSACTION):
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.max_recipients = max_recipients
+        self._connections = {}
+
+    def __len__(self):
+        return sum(len(transports) for transports in self._connections.values())
+
+    @staticmethod
+    def _get_key(smtp_server):
+        # Changing the server configuration while a run is in progress must
+        # not reuse a session authenticated with the old parameters
+        return (smtp_server.pk, smtp_server.ip_address, smtp_server.port, smtp_server.username, smtp_server.password, smtp_server.use_ssl, smtp_server.use_tls)
+
+    async def _connect(self, smtp_server):
+        logger.debug("Opening SMTP session with %s", smtp_server)
+
+        transport = AsyncSmtpTransport(
+            smtp_server.ip_address,
+            port=smtp_server.port if smtp_server.port else None,
+            ssl=smtp_server.use_ssl,
+            tls=smtp_server.use_tls,
+            timeout=self.timeout,
+            metrics_label=smtp_server.pk)
+        await transport.connect(smtp_server.username, smtp_server.password)
+
+        return transport
+
+    async def _checkout(self, smtp_server):
+        idle_transports = self._connections.get(self._get_key(smtp_server))
+
+        while idle_transports:
+            transport = idle_transports.pop()
+
+            try:
+                await transport.reset()
+            except (smtplib.SMTPException, OSError):
+                logger.debug("SMTP session with %s is not usable anymore. Reconnecting.", smtp_server)
+                await transport.close()
+            else:
+                return transport, True
+
+        return await self._connect(smtp_server), False
+
+    def _checkin(self, smtp_server, transport):
+        if transport.is_connected:
+            self._connections.setdefault(self._get_key(smtp_server), []).append(transport)
+
+    async def send_mail(self, smtp_server, from_email, recipient_list, multipart_mail_message):
+        """
+        Same as `SmtpConnectionPool.send_mail`: one transaction for each chunk
+        of recipients, raising `SMTPRecipientChunksFailed` if some of them
+        failed.
+        """
+        chunks = split_recipients(recipient_list, self.max_recipients)
+
+        if len(chunks) == 1:
+            return await self._send_transaction(smtp_server, from_email, chunks[0], multipart_mail_message)
+
+        refused_recipients = {}
+        failed_chunks = []
+        session_exception = None
+
+        for chunk in chunks:
+            if session_exception is not None:
+                failed_chunks.append((chunk, session_exception))
+                continue
+
+            try:
+                refused_recipients.update(await self._send_transaction(smtp_server, from_email, chunk, multipart_mail_message))
+            except (smtplib.SMTPException, OSError, asyncio.TimeoutError) as e:
+                failed_chunks.append((chunk, e))
+
+                if not isinstance(e, TRANSACTION_ERRORS):
+                    session_exception = e
+
+        if failed_chunks:
+            raise SMTPRecipientChunksFailed(failed_chunks, refused_recipients, len(chunks))
+
+        return refused_recipients
+
+    async def _send_transaction(self, smtp_server, from_email, recipient_list, multipart_mail_message):
+        await self.close_idle()
+
+        transport, reused = await self._checkout(smtp_server)
+
+        try:
+            statusdict = await transport.sendmail(from_email, recipient_list, multipart_mail_message)
+        except smtplib.SMTPServerDisconnected:
+            await transport.close()
+
+            # Like `SmtpConnectionPool`, not sent again once MAIL FROM was
+            # accepted
+            if not reused or transport.mail_accepted:
+                raise
+
+            # The server closed a session that was idle in the pool. Try
+            # again only once with a brand new session.
+            logger.debug("SMTP session with %s disconnected by the server. Reconnecting.", smtp_server)
+            transport = await self._connect(smtp_server)
+
+            try:
+                statusdict = await transport.sendmail(from_email, recipient_list, multipart_mail_message)
+            except smtplib.SMTPResponseException:
+                self._checkin(smtp_server, transport)
+                raise
+            except BaseException:
+                await transport.close()
+                raise
+        except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+            # The server rejected this message, but the session is still
+            # valid for the next one.
+            self._checkin(smtp_server, transport)
+            raise
+        except BaseException:
+            await transport.close()
+            raise
+
+        self._checkin(smtp_server, transport)
+
+        return statusdict
+
+    async def close_idle(self):
+        if self.idle_timeout is None:
+            return
+
+        # The idle sessions are taken out of the pool before awaiting their
+        # closing, the pool can change in the meantime
+        now = time.monotonic()
+        idle_transports = []
+        for key, transports in list(self._connections.items()):
+            for transport in list(transports):
+                if now - transport.last_used_at >= self.idle_timeout:
+                    transports.remove(transport)
+                    idle_transports.append(transport)
+
+            if not transports:
+                del self._connections[key]
+
+        for transport in idle_transports:
+            logger.debug("Closing SMTP session idle for more than %s seconds", self.idle_timeout)
+            await transport.close()
+
+    async def close_all(self):
+        while self._connections:
+            _key, transports = self._connections.popitem()
+            await asyncio.gather(*(transport.close() for transport in transports), return_exceptions=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close_all()
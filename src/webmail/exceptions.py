@@ -9,3 +9,12 @@ class InvalidEmailMessageException(Exception):
         super().__init__(error_message)
 
 
+class MessageTooLargeException(Exception):
+    """
+    A message left in the POP3 server to be fetched apart, because it's larger
+    than the size limit of the fetch.
+    """
+    def __init__(self, message_number, size):
+        self.message_number = message_number
+        self.size = size
+        super().__init__("Message %d too large (%d bytes)" % (message_number, size))
@@ -70,10 +70,47 @@ def random_body_email(min_sentences=1, max_sentences=50, min_words_paragraph=10,
     return "\n\n".join(sentences)
 
 
+def random_text(size):
+    """
+    Paragraphs of lorem ipsum of about `size` characters.
+    """
+    paragraphs = []
+    length = 0
+
+    while length < size:
+        paragraph = lorem_ipsum(random.choice(range(10, 30)))
+
+        paragraphs.append(paragraph)
+        length += len(paragraph) + 2
+
+    return "\n\n".join(paragraphs)[:size]
+
+
 def random_ip():
     return ".".join([str(random.randrange(0, 255)) for i in range(0, 4)])
 
 
+def random_username(name=None, surname=None, names=settings.WEBMAIL_FAKE_DATA_NAMES, surnames=settings.WEBMAIL_FAKE_DATA_SURNAMES):
+    if name is None:
+        name = random.choice(names)
+
+    if surname is None:
+        surname = random.choice(surnames)
+
+    username = "%s.%s%s"%(name.replace(" ","").lower(), surname.replace(" ","").lower() , random.randint(1, 10000))
+
+    return username
+
+
+def random_email(username=None, email_domains=settings.WEBMAIL_FAKE_DATA_EMAIL_DOMAINS):
+    if username is None:
+        username = random_username()
+
+    domain_name = random.choice(email_domains)
+
+    return "%s@%s" % (username, domain_name)
+
+
 def create_fake_data(
     username="test",
     password="test",
@@ -96,25 +133,11 @@ def create_fake_data(
     surnames=settings.WEBMAIL_FAKE_DATA_SURNAMES,
     email_domains=settings.WEBMAIL_FAKE_DATA_EMAIL_DOMAINS):
 
-    def random_username(name=None, surname=None):
-        if name is None:
-            name = random.choice(names)
-
-        if surname is None:
-            surname = random.choice(surnames)
-
-        username = "%s.%s%s"%(name.replace(" ","").lower(), surname.replace(" ","").lower() , random.randint(1, 10000))
-
-        return username
-
-
-    def random_email(username=None):
+    def random_user_email(username=None):
         if username is None:
-            username = random_username()
-
-        domain_name = random.choice(email_domains)
+            username = random_username(names=names, surnames=surnames)
 
-        return "%s@%s" % (username, domain_name)
+        return random_email(username=username, email_domains=email_domains)
 
     user = WebmailUser.objects.create_user(username=username, password=password)
 
@@ -123,13 +146,13 @@ def create_fake_data(
         contact_name = random.choice(names)
         contact_surname = random.choice(surnames)
 
-        username = random_username(name=contact_name, surname=contact_surname)
+        username = random_username(name=contact_name, surname=contact_surname, names=names, surnames=surnames)
         if username in contact_usernames:
             username += "." + str(i)
 
         contact_usernames.add(username)
 
-        ContactUser.objects.create(user=user, displayed_name=("%s %s"%(contact_name, contact_surname)).title() , email=random_email(username=username))
+        ContactUser.objects.create(user=user, displayed_name=("%s %s"%(contact_name, contact_surname)).title() , email=random_user_email(username=username))
 
     my_email1 = "my_email1@domain.com"
 
@@ -153,9 +176,9 @@ def create_fake_data(
             mail_message_id = email_utils.make_msgid()
             is_starred = maybe_true(probability_message_is_starred)
 
-            from_email = random_email()
+            from_email = random_user_email()
 
-            to = [random_email() for i in range(random.choice(range(1, max_emails_in_to)))]
+            to = [random_user_email() for i in range(random.choice(range(1, max_emails_in_to)))]
 
             subject = generate_random_subject()
 
@@ -177,14 +200,14 @@ def create_fake_data(
 
             has_cc = maybe_true(probability_message_has_cc)
             if has_cc:
-                cc = [random_email() for i in range(random.choice(range(max_emails_in_cc)))]
+                cc = [random_user_email() for i in range(random.choice(range(max_emails_in_cc)))]
                 email_headers.append(("CC", ", ".join(cc)))
             else:
                 cc = None
 
             has_bcc = maybe_true(probability_message_has_bcc)
             if has_bcc:
-                bcc = [random_email() for i in range(random.choice(range(max_emails_in_bcc)))]
+                bcc = [random_user_email() for i in range(random.choice(range(max_emails_in_bcc)))]
                 email_headers.append(("BCC", ", ".join(bcc)))
             else:
                 bcc = None
@@ -269,7 +269,7 @@ class SmtpServerForm(forms.ModelForm):
 
     class Meta:
         model = SmtpServer
-        fields = ('ip_address', 'port', 'username', 'password', 'use_ssl', 'from_email', 'from_name',)
+        fields = ('ip_address', 'port', 'username', 'password', 'use_ssl', 'from_email', 'from_name', 'max_messages_per_minute', 'max_messages_burst',)
         widgets = {
             'ip_address': TextInput(attrs={"placeholder": _("Enter IP or domain name of SMTP server")}),
             'port': TextInput(attrs={"placeholder": _("Enter port of SMTP server")}),
@@ -288,7 +288,7 @@ class Pop3MailServerForm(forms.ModelForm):
 
     class Meta:
         model = Pop3MailServer
-        fields = ('ip_address', 'port', 'username', 'password', 'use_ssl', 'active')
+        fields = ('ip_address', 'port', 'username', 'password', 'use_ssl', 'leave_messages_on_server', 'active')
         widgets = {
             'ip_address': TextInput(attrs={"placeholder": _("Enter IP or domain name of POP3 server")}),
             'port': TextInput(attrs={"placeholder": _("Enter port of POP3 server")}),
@@ -0,0 +1,454 @@
+import asyncio
+import email
+import os
+import socket
+import time
+from email.errors import MessageParseError, MessageDefect
+
+
+from .models import Mailbox, Message
+from .mail_parse import get_parsing_policy
+from .mail_import import get_message_id
+from .mail_send_engine_async import _DatabaseExecutor
+from .exceptions import InvalidEmailMessageException
+from .logutils import get_logger
+from . import settings
+
+
+logger = get_logger()
+
+
+# LMTP (RFC 2033) server receiving the messages delivered by the MTA, instead
+# of running `getusermailfromstdin` for each message. The sessions run in the
+# event loop, and the deliveries in the thread of the database, one at a time.
+#
+# Unlike SMTP, after the data of a message there is a reply for each accepted
+# recipient, so the MTA retries only the deliveries that failed. A recipient
+# can be an email of several mailboxes: if the delivery failed only for some
+# of them, the MTA retries the recipient, and the mailboxes that already have
+# a message with its Message-ID don't receive it again, like in
+# `mail_import`.
+
+
+# Max length of a command or a line of the data of a message
+MAX_LINE_LENGTH = 1024 * 1024
+
+
+class RecipientMap:
+    """
+    Mailboxes of each email address, from the emails of the mailboxes of the
+    active users. It's reloaded every `refresh_interval` seconds, and when an
+    address is not found if it was not reloaded in the last
+    `miss_refresh_interval` seconds, so the new mailboxes receive mail soon.
+    """
+
+    def __init__(self, refresh_interval=60, miss_refresh_interval=5):
+        self.refresh_interval = refresh_interval
+        self.miss_refresh_interval = miss_refresh_interval
+
+        self._mailboxes_by_email = {}
+        self._load_time = None
+
+    def load(self):
+        mailboxes_by_email = {}
+
+        for mailbox in Mailbox.objects.filter(user__is_active=True).select_related("user"):
+            for mailbox_email in mailbox.emails or []:
+                mailboxes_by_email.setdefault(mailbox_email.lower(), []).append(mailbox)
+
+        self._mailboxes_by_email = mailboxes_by_email
+        self._load_time = time.monotonic()
+
+    def get_mailboxes(self, address):
+        """
+        Returns the list of mailboxes of the email address.
+        """
+        address = address.lower()
+
+        now = time.monotonic()
+        if self._load_time is None or now - self._load_time >= self.refresh_interval:
+            self.load()
+        elif address not in self._mailboxes_by_email and now - self._load_time >= self.miss_refresh_interval:
+            self.load()
+
+        return self._mailboxes_by_email.get(address, [])
+
+
+def deliver_message(raw_message, mailboxes):
+    """
+    Saves the message in each mailbox, unless the mailbox has a message with
+    the same Message-ID outside the sent folder, delivered before. Returns a dictionary from the id of
+    each mailbox to the LMTP reply of its delivery.
+    """
+    try:
+        email_message = email.message_from_bytes(raw_message, policy=get_parsing_policy())
+    except (MessageParseError, MessageDefect) as e:
+        return {mailbox.id: "554 5.6.0 Message can't be parsed: %s" % e for mailbox in mailboxes}
+
+    message_id = get_message_id(email_message)
+
+    replies = {}
+
+    for mailbox in mailboxes:
+        if mailbox.id in replies:
+            continue
+
+        try:
+            # The sent copy of a message sent to oneself is not a delivered copy
+            if message_id is not None and mailbox.messages.exclude(folder_id=Message.SENT_FOLDER_ID).filter(message_id=message_id).exists():
+                # Retried by the MTA after failing for other mailboxes
+                replies[mailbox.id] = "250 2.0.0 Already delivered"
+                continue
+
+            msg_record = mailbox.process_incomming_email(email_message)
+        except InvalidEmailMessageException as e:
+            logger.warning("Invalid email for mailbox %s: %s", mailbox.id, e)
+            replies[mailbox.id] = "554 5.6.0 Invalid message: %s" % e
+        except Exception:
+            logger.exception("Error delivering a message to mailbox %s", mailbox.id)
+            # Retried later by the MTA
+            replies[mailbox.id] = "451 4.3.0 Temporary failure delivering the message"
+        else:
+            logger.info(
+                'Received %s (from %s) in mailbox "%s" of user "%s"',
+                msg_record.subject,
+                msg_record.from_email,
+                mailbox.name,
+                mailbox.user.username
+            )
+            replies[mailbox.id] = "250 2.0.0 <%s> Delivered" % msg_record.id
+
+    return replies
+
+
+def _parse_path(argument, keyword):
+    """
+    Returns the address and the parameters of the argument of MAIL FROM or
+    RCPT TO, or None if it's not valid.
+    """
+    if not argument[:len(keyword)].upper() == keyword:
+        return None
+
+    argument = argument[len(keyword):].strip()
+    if not argument.startswith("<"):
+        return None
+
+    end = argument.find(">")
+    if end == -1:
+        return None
+
+    address = argument[1:end]
+
+    parameters = {}
+    for parameter in argument[end + 1:].split():
+        name, _sep, value = parameter.partition("=")
+        parameters[name.upper()] = value
+
+    return address, parameters
+
+
+class LmtpSession:
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+
+        self.reset()
+
+    def reset(self):
+        self.sender = None
+        # List of tuples with each accepted recipient and its mailboxes
+        self.recipients = []
+
+    @property
+    def is_idle(self):
+        """
+        Whether the session is between mail transactions. The transaction of
+        a message ends when the replies of its delivery are sent.
+        """
+        return self.sender is None
+
+    async def reply(self, line):
+        self.writer.write(line.encode("utf-8") + b"\r\n")
+        await self.writer.drain()
+
+    async def readline(self):
+        line = await asyncio.wait_for(self.reader.readuntil(b"\n"), self.server.timeout)
+        return line.rstrip(b"\r\n")
+
+    async def run(self):
+        await self.reply("220 %s LMTP server ready" % self.server.hostname)
+
+        while True:
+            try:
+                line = await self.readline()
+            except asyncio.IncompleteReadError:
+                return
+            except asyncio.LimitOverrunError:
+                await self.reply("500 5.5.2 Line too long")
+                return
+            except asyncio.TimeoutError:
+                await self.reply("421 4.4.2 %s Timeout" % self.server.hostname)
+                return
+
+            command, _sep, argument = line.decode("utf-8", "replace").partition(" ")
+            command = command.upper()
+
+            if command == "QUIT":
+                await self.reply("221 2.0.0 %s Bye" % self.server.hostname)
+                return
+
+            handler = getattr(self, "handle_" + command.lower(), None) if command.isalpha() else None
+            if handler is None:
+                await self.reply("500 5.5.1 Command not recognized")
+                continue
+
+            if not await handler(argument.strip()):
+                return
+
+            if self.server.is_stopping and self.is_idle:
+                await self.reply("421 4.3.2 Server shutting down")
+                return
+
+    async def handle_lhlo(self, argument):
+        if not argument:
+            await self.reply("501 5.5.4 Syntax: LHLO hostname")
+            return True
+
+        self.reset()
+
+        await self.reply("250-%s" % self.server.hostname)
+        await self.reply("250-PIPELINING")
+        await self.reply("250-ENHANCEDSTATUSCODES")
+        await self.reply("250-8BITMIME")
+        await self.reply("250 SIZE %d" % self.server.max_message_size)
+        return True
+
+    async def handle_helo(self, argument):
+        await self.reply("500 5.5.1 This is an LMTP server, use LHLO")
+        return True
+
+    handle_ehlo = handle_helo
+
+    async def handle_mail(self, argument):
+        if self.sender is not None:
+            await self.reply("503 5.5.1 Nested MAIL command")
+            return True
+
+        path = _parse_path(argument, "FROM:")
+        if path is None:
+            await self.reply("501 5.5.4 Syntax: MAIL FROM:<address>")
+            return True
+
+        address, parameters = path
+
+        try:
+            size = int(parameters.get("SIZE", 0))
+        except ValueError:
+            await self.reply("501 5.5.4 Invalid SIZE parameter")
+            return True
+
+        if size > self.server.max_message_size:
+            await self.reply("552 5.3.4 Message size exceeds fixed limit")
+            return True
+
+        self.sender = address
+        await self.reply("250 2.1.0 OK")
+        return True
+
+    async def handle_rcpt(self, argument):
+        if self.sender is None:
+            await self.reply("503 5.5.1 Need MAIL command")
+            return True
+
+        path = _parse_path(argument, "TO:")
+        if path is None:
+            await self.reply("501 5.5.4 Syntax: RCPT TO:<address>")
+            return True
+
+        address, _parameters = path
+
+        try:
+            mailboxes = await self.server.database_executor.run(self.server.recipient_map.get_mailboxes, address)
+        except Exception:
+            logger.exception("Error looking up the recipient %s", address)
+            await self.reply("451 4.3.0 Temporary failure looking up the recipient")
+            return True
+
+        if not mailboxes:
+            await self.reply("550 5.1.1 <%s> Recipient unknown" % address)
+            return True
+
+        self.recipients.append((address, mailboxes))
+        await self.reply("250 2.1.5 OK")
+        return True
+
+    async def handle_data(self, argument):
+        if not self.recipients:
+            await self.reply("503 5.5.1 No valid recipients")
+            return True
+
+        await self.reply("354 Start mail input; end with <CRLF>.<CRLF>")
+
+        lines = []
+        size = 0
+        too_large = False
+
+        while True:
+            try:
+                line = await self.readline()
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                # The MTA retries the message
+                return False
+
+            if line == b".":
+                break
+
+            # Transparency (RFC 5321, section 4.5.2)
+            if line.startswith(b"."):
+                line = line[1:]
+
+            size += len(line) + 2
+            if size > self.server.max_message_size:
+                # Read until the end, replying the error for each recipient
+                too_large = True
+                lines = []
+
+            if not too_large:
+                lines.append(line)
+
+        # Not idle until the replies are sent, the session is not closed at
+        # shutdown in the meantime
+        try:
+            if too_large:
+                for _address in self.recipients:
+                    await self.reply("552 5.3.4 Message size exceeds fixed limit")
+                return True
+
+            await self._deliver(b"\r\n".join(lines) + b"\r\n")
+            return True
+        finally:
+            self.reset()
+
+    async def _deliver(self, raw_message):
+        # Each mailbox receives the message once, also if it's the mailbox of
+        # several recipients
+        mailboxes = {}
+        for _address, recipient_mailboxes in self.recipients:
+            for mailbox in recipient_mailboxes:
+                mailboxes.setdefault(mailbox.id, mailbox)
+
+        try:
+            replies = await self.server.database_executor.run(deliver_message, raw_message, list(mailboxes.values()))
+        except Exception:
+            logger.exception("Error delivering a message")
+            replies = {}
+
+        for _address, recipient_mailboxes in self.recipients:
+            # The worst reply of the mailboxes of the recipient: if it failed
+            # for some of them, it's retried, and the mailboxes that received
+            # it skip it by its Message-ID
+            recipient_replies = [replies.get(mailbox.id, "451 4.3.0 Temporary failure delivering the message") for mailbox in recipient_mailboxes]
+            await self.reply(max(recipient_replies, key=lambda reply: reply[0]))
+
+    async def handle_rset(self, argument):
+        self.reset()
+        await self.reply("250 2.0.0 OK")
+        return True
+
+    async def handle_noop(self, argument):
+        await self.reply("250 2.0.0 OK")
+        return True
+
+    async def handle_vrfy(self, argument):
+        await self.reply("252 2.5.0 Cannot VRFY user")
+        return True
+
+
+class LmtpServer:
+    """
+    Accepts the deliveries of the MTA (Postfix, Exim...) on a TCP socket or
+    a Unix socket, and saves the messages in the mailboxes whose emails
+    include the recipients.
+    """
+
+    def __init__(self, hostname=None, max_message_size=settings.WEBMAIL_LMTP_MAX_MESSAGE_SIZE, timeout=settings.WEBMAIL_LMTP_TIMEOUT, recipient_map=None):
+        self.hostname = hostname or socket.getfqdn()
+        self.max_message_size = max_message_size
+        # Seconds waiting for a command or a line of data from the client
+        self.timeout = timeout
+        self.recipient_map = recipient_map if recipient_map is not None else RecipientMap()
+
+        self.database_executor = None
+        # Session of the task of each connection
+        self._sessions = {}
+        # The sessions are closed when they are idle
+        self.is_stopping = False
+
+    async def handle_client(self, reader, writer):
+        task = asyncio.current_task()
+        session = LmtpSession(self, reader, writer)
+        self._sessions[task] = session
+
+        try:
+            await session.run()
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        except Exception:
+            logger.exception("Error in LMTP session")
+        finally:
+            del self._sessions[task]
+            writer.close()
+
+    def _close_idle_sessions(self):
+        # The MTA keeps the connections open between deliveries. The
+        # sessions in a mail transaction are closed when it ends.
+        for session in self._sessions.values():
+            if session.is_idle:
+                session.writer.write(b"421 4.3.2 Server shutting down\r\n")
+                session.writer.close()
+
+    async def serve(self, host=None, port=None, unix_socket=None, socket_mode=0o660, stop_event=None):
+        """
+        Listens on `unix_socket`, if not None, or on `host` and `port`, until
+        `stop_event`, an `asyncio.Event`, is set. Then waits for the sessions
+        in progress.
+        """
+        self.database_executor = _DatabaseExecutor(thread_name_prefix="lmtp-db")
+
+        try:
+            if unix_socket is not None:
+                if os.path.exists(unix_socket):
+                    # Left by a previous run
+                    os.remove(unix_socket)
+
+                server = await asyncio.start_unix_server(self.handle_client, path=unix_socket, limit=MAX_LINE_LENGTH)
+                os.chmod(unix_socket, socket_mode)
+
+                logger.info("LMTP server listening on %s", unix_socket)
+            else:
+                server = await asyncio.start_server(self.handle_client, host=host, port=port, limit=MAX_LINE_LENGTH)
+
+                logger.info("LMTP server listening on %s", ", ".join("%s:%s" % sock.getsockname()[:2] for sock in server.sockets))
+
+            async with server:
+                if stop_event is None:
+                    stop_event = asyncio.Event()
+
+                await stop_event.wait()
+
+                server.close()
+                self.is_stopping = True
+                self._close_idle_sessions()
+
+                if self._sessions:
+                    num_deliveries = sum(1 for session in self._sessions.values() if not session.is_idle)
+                    if num_deliveries:
+                        logger.info("Waiting for %d deliveries in progress", num_deliveries)
+
+                    await asyncio.wait(list(self._sessions), timeout=self.timeout)
+        finally:
+            self.database_executor.shutdown()
+
+            if unix_socket is not None and os.path.exists(unix_socket):
+                os.remove(unix_socket)
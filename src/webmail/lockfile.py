@@ -1,4 +1,4 @@
-import warnings
+import fcntl
 import os
 import time
 from pathlib import Path
@@ -23,6 +23,9 @@ from pathlib import Path
 
 #  - http://ionrock.wordpress.com/2012/06/28/file-locking-in-python/
 
+# The lock files created with O_EXCL were left behind when the process holding
+# them was killed, and had to be removed by hand. They were replaced by
+# fcntl.flock, released by the kernel.
 
 
 class LockError(Exception):
@@ -62,15 +65,16 @@ class AlreadyLocked(LockError):
 
 
 class FileLock:
-    """A simple locking mechanism based on lockfiles.
+    """A lock held with `fcntl.flock` on a lock file.
 
-    It creates lockfiles and thus works across different processes and
-    different machines with access to the same shared file system as
-    long as that file system guarantees atomicity for O_CREAT with O_EXCL.
+    The kernel releases the lock when its file descriptor is closed, also if
+    the process is killed, so a lock is never left behind. The lock file
+    itself is not removed, and only works between processes of the same host
+    (flock is not reliable on network file systems).
 
     Args:
-        file_or_lockfile: If it has a ".lock" suffix, it is used as is and will
-            be truncated, otherwise a ".lock" suffix is appended.
+        file_or_lockfile: If it has a ".lock" suffix, it is used as is,
+            otherwise a ".lock" suffix is appended.
     """
 
     def __init__(
@@ -89,30 +93,6 @@ class FileLock:
     def is_locked(self):
         return self._lockfile_fd is not None
 
-    @staticmethod
-    def is_valid_lock(lock_filename):
-        """
-        See if the lock exists and is left over from an old process.
-        """
-
-        try:
-            lock_pid = int(open(lock_filename).read())
-        except IOError:
-            return False
-        except ValueError:
-            # most likely an empty or otherwise invalid lock file
-            return False
-
-        # it is/was another process
-        # see if it is running
-        try:
-            os.kill(lock_pid, 0)
-        except OSError:
-            return False
-
-        # it is running
-        return True
-
     def acquire(self, timeout=None, interval = 0.05):
         """
         timeout: Number of seconds before a LockTimeout is raised. Can be
@@ -121,31 +101,38 @@ class FileLock:
         interval: Number of seconds between each retry."""
 
         assert not self.is_locked
-        start_time = time.time()
+
+        fd = os.open(self.lockfile, os.O_RDWR | os.O_CREAT, 0o644)
+
+        start_time = time.monotonic()
         while True:
-            mode = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_TRUNC
             try:
-                fd = os.open(self.lockfile, mode)
-            except FileExistsError:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
                 if timeout is None:
+                    os.close(fd)
                     raise AlreadyLocked(self.lockfile)
-                if time.time() - start_time >= timeout:
+                if time.monotonic() - start_time >= timeout:
+                    os.close(fd)
                     raise LockTimeout(self.lockfile)
                 time.sleep(interval)
+            except BaseException:
+                os.close(fd)
+                raise
             else:
                 self._lockfile_fd = fd
+
+                # Only informative, the lock is not the file
+                os.ftruncate(fd, 0)
                 os.write(fd, self._pid)
 
                 break
 
     def release(self):
         if self.is_locked:
+            # Closing the file releases the lock
             os.close(self._lockfile_fd)
             self._lockfile_fd = None
-            try:
-                os.remove(self.lockfile)
-            except FileNotFoundError:
-                warnings.warn(f"{self.lockfile} did not exist anymore")
 
     def __enter__(self):
         if not self.is_locked:
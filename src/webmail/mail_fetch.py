@@ -0,0 +1,343 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait as wait_futures
+
+
+from django import db
+from django.utils import timezone
+
+
+from .exceptions import InvalidEmailMessageException, MessageTooLargeException
+from .logutils import get_logger
+from . import settings
+
+
+logger = get_logger()
+
+
+class FetchResult:
+    """
+    Outcome of fetching the new messages of a POP3 mail server.
+    """
+
+    def __init__(self, pop3_mail_server, large_messages=False):
+        self.pop3_mail_server = pop3_mail_server
+        self.large_messages = large_messages
+        self.num_messages = 0
+        self.num_invalid = 0
+        # Left in the server to be fetched apart
+        self.num_large_messages = 0
+        self.num_bytes = 0
+        self.elapsed_time = 0
+        self.error = None
+
+    @property
+    def name(self):
+        mailbox = self.pop3_mail_server.mailbox
+        return "%s:%s" % (mailbox.user.username, mailbox.name)
+
+    def __str__(self):
+        resume = "%s%s: %d messages; %d invalid; %d bytes in %.2f seconds" % (self.name, " (large messages)" if self.large_messages else "", self.num_messages, self.num_invalid, self.num_bytes, self.elapsed_time)
+        if self.num_large_messages:
+            resume += "; %d large messages deferred" % self.num_large_messages
+        if self.error is not None:
+            resume += "; error: %s" % self.error
+        return resume
+
+
+def fetch_mail_server(pop3_mail_server, timeout=settings.WEBMAIL_POP3_TIMEOUT, max_message_size=settings.WEBMAIL_POP3_MAX_MESSAGE_SIZE, large_messages=False, parser_pool=None):
+    """
+    Fetches the new messages of a POP3 mail server. The errors are logged and
+    returned in the result, not raised, so they don't affect the rest of
+    servers.
+
+    The messages larger than `max_message_size` bytes are left in the server
+    and counted in the result, so a single large message doesn't delay the
+    rest. They are fetched apart with `large_messages`.
+
+    The messages are parsed in the worker processes of `parser_pool`, a
+    `MessageParserPool`, if not None.
+    """
+    result = FetchResult(pop3_mail_server, large_messages=large_messages)
+    mailbox = pop3_mail_server.mailbox
+
+    logger.info(
+        'Gathering messages for user "%s" from mailbox "%s"',
+        mailbox.user.username,
+        mailbox.name
+    )
+
+    start_time = time.monotonic()
+    connection = None
+
+    try:
+        connection = pop3_mail_server.get_connection(timeout=timeout)
+
+        if large_messages:
+            new_mail = pop3_mail_server.get_new_mail(connection=connection, min_message_size=max_message_size, parser_pool=parser_pool)
+        else:
+            new_mail = pop3_mail_server.get_new_mail(connection=connection, max_message_size=max_message_size, parser_pool=parser_pool)
+
+        for msg_record in new_mail:
+            if isinstance(msg_record, MessageTooLargeException):
+                result.num_large_messages += 1
+            elif isinstance(msg_record, InvalidEmailMessageException):
+                result.num_invalid += 1
+                logger.warning("Invalid email: %s" % str(msg_record))
+            else:
+                result.num_messages += 1
+                logger.info(
+                    'Received %s (from %s)',
+                    msg_record.subject,
+                    msg_record.from_email
+                )
+    except OSError as e:
+        # Server not reachable, timeout...
+        result.error = e
+        logger.error("Error fetching messages from %s: %s", result.name, e)
+    except Exception as e:
+        result.error = e
+        logger.exception("Error fetching messages from %s", result.name)
+    finally:
+        if connection is not None:
+            result.num_bytes = connection.num_bytes_received
+
+        result.elapsed_time = time.monotonic() - start_time
+
+    return result
+
+
+def _fetch_mail_server_in_thread(pop3_mail_server, timeout, max_message_size, large_messages=False, parser_pool=None):
+    try:
+        return fetch_mail_server(pop3_mail_server, timeout=timeout, max_message_size=max_message_size, large_messages=large_messages, parser_pool=parser_pool)
+    finally:
+        # Each thread has its own database connections
+        db.connections.close_all()
+
+
+def fetch_all(pop3_mail_servers, concurrency=settings.WEBMAIL_FETCH_CONCURRENCY, timeout=settings.WEBMAIL_POP3_TIMEOUT, max_message_size=settings.WEBMAIL_POP3_MAX_MESSAGE_SIZE, large_message_concurrency=1, parser_pool=None):
+    """
+    Fetches the new messages of the POP3 mail servers, from `concurrency`
+    servers at the same time. Returns the list of `FetchResult`, in the same
+    order as the servers, followed by the results of the servers with
+    messages larger than `max_message_size`.
+
+    The large messages of a server are fetched after the rest of its
+    messages, from `large_message_concurrency` servers at the same time,
+    while the other servers are fetched.
+
+    All the servers share the worker processes of `parser_pool`, if not None.
+    """
+    pop3_mail_servers = list(pop3_mail_servers)
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="fetch") as executor, \
+         ThreadPoolExecutor(max_workers=large_message_concurrency, thread_name_prefix="fetch-large") as large_executor:
+        futures = [executor.submit(_fetch_mail_server_in_thread, pop3_mail_server, timeout, max_message_size, parser_pool=parser_pool) for pop3_mail_server in pop3_mail_servers]
+
+        large_futures = []
+        for future in as_completed(futures):
+            result = future.result()
+
+            if result.num_large_messages:
+                large_futures.append(large_executor.submit(_fetch_mail_server_in_thread, result.pop3_mail_server, timeout, max_message_size, large_messages=True, parser_pool=parser_pool))
+
+        return [future.result() for future in futures] + [future.result() for future in large_futures]
+
+
+# Seconds between checks of the stop event while waiting for the next poll
+STOP_CHECK_INTERVAL = 1
+
+
+class _ScheduleEntry:
+    def __init__(self, next_poll_time, interval):
+        self.next_poll_time = next_poll_time
+        self.interval = interval
+        self.num_errors = 0
+
+
+class FetchSchedule:
+    """
+    When each POP3 mail server is polled next by `fetch_forever`.
+
+    The polling interval of each server adapts to its traffic: it's halved
+    when a poll finds new messages, down to `min_interval`, and it grows by
+    `backoff_factor` when there are none, up to `max_interval`. After a
+    connection error, the server is polled again after `min_interval`
+    seconds, doubled with each consecutive error up to `max_error_backoff`.
+
+    The times are randomized by a `jitter` fraction, and when it starts the
+    servers not polled recently are spread over `min_interval`, so they are
+    not all polled at the same time. Times are monotonic clock seconds.
+    """
+
+    def __init__(
+        self,
+        min_interval=settings.WEBMAIL_FETCH_MIN_POLL_INTERVAL,
+        max_interval=settings.WEBMAIL_FETCH_MAX_POLL_INTERVAL,
+        max_error_backoff=settings.WEBMAIL_FETCH_MAX_ERROR_BACKOFF,
+        backoff_factor=1.5,
+        jitter=0.1):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_error_backoff = max_error_backoff
+        self.backoff_factor = backoff_factor
+        self.jitter = jitter
+
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _randomize(self, delay):
+        return delay * (1 - self.jitter) + random.uniform(0, 2 * delay * self.jitter)
+
+    def update_servers(self, pop3_mail_servers, now):
+        """
+        Adds the new servers to the schedule and removes the ones not in
+        `pop3_mail_servers`.
+        """
+        server_ids = set()
+
+        for pop3_mail_server in pop3_mail_servers:
+            server_ids.add(pop3_mail_server.id)
+
+            if pop3_mail_server.id in self._entries:
+                continue
+
+            delay = random.uniform(0, self.min_interval)
+
+            if pop3_mail_server.last_polling is not None:
+                # Polled recently by another process
+                seconds_since_last_polling = (timezone.now() - pop3_mail_server.last_polling).total_seconds()
+                delay = max(delay, self.min_interval - seconds_since_last_polling)
+
+            self._entries[pop3_mail_server.id] = _ScheduleEntry(now + delay, self.min_interval)
+
+        for server_id in set(self._entries) - server_ids:
+            del self._entries[server_id]
+
+    def get_due_servers(self, now):
+        """
+        Returns the ids of the servers to poll now, the most delayed first.
+        """
+        due_entries = [(entry.next_poll_time, server_id) for server_id, entry in self._entries.items() if entry.next_poll_time <= now]
+        return [server_id for _next_poll_time, server_id in sorted(due_entries)]
+
+    def get_next_poll_time(self, exclude=()):
+        return min((entry.next_poll_time for server_id, entry in self._entries.items() if server_id not in exclude), default=None)
+
+    def record_result(self, server_id, result, now):
+        """
+        Schedules the next poll of the server after `result`, a `FetchResult`.
+        Returns the delay in seconds.
+        """
+        entry = self._entries.get(server_id)
+        if entry is None:
+            # Removed while it was polled
+            return None
+
+        if result.error is not None:
+            entry.num_errors += 1
+            delay = min(self.max_error_backoff, self.min_interval * 2 ** min(entry.num_errors - 1, 32))
+        else:
+            entry.num_errors = 0
+
+            if result.num_messages:
+                entry.interval = max(self.min_interval, entry.interval / 2)
+            else:
+                entry.interval = min(self.max_interval, entry.interval * self.backoff_factor)
+
+            delay = entry.interval
+
+        delay = self._randomize(delay)
+        entry.next_poll_time = now + delay
+
+        return delay
+
+
+def fetch_forever(get_pop3_mail_servers, concurrency=settings.WEBMAIL_FETCH_CONCURRENCY, timeout=settings.WEBMAIL_POP3_TIMEOUT, max_message_size=settings.WEBMAIL_POP3_MAX_MESSAGE_SIZE, large_message_concurrency=1, schedule=None, refresh_interval=60, stop_event=None, parser_pool=None):
+    """
+    Polls the POP3 mail servers returned by `get_pop3_mail_servers`, a
+    function called every `refresh_interval` seconds to know the servers
+    added or removed, following `schedule`, a `FetchSchedule`. Up to
+    `concurrency` servers are fetched at the same time.
+
+    The messages larger than `max_message_size` are fetched apart after each
+    poll, from `large_message_concurrency` servers at the same time. The
+    server is not polled again until they are fetched.
+
+    It runs until `stop_event` is set, then waits for the fetches in
+    progress.
+    """
+    if schedule is None:
+        schedule = FetchSchedule()
+
+    pop3_mail_servers = {}
+    next_refresh_time = None
+
+    in_progress = {}
+    large_in_progress = {}
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="fetch") as executor, \
+         ThreadPoolExecutor(max_workers=large_message_concurrency, thread_name_prefix="fetch-large") as large_executor:
+        while True:
+            now = time.monotonic()
+
+            if stop_event is not None and stop_event.is_set():
+                break
+
+            if next_refresh_time is None or now >= next_refresh_time:
+                pop3_mail_servers = {pop3_mail_server.id: pop3_mail_server for pop3_mail_server in get_pop3_mail_servers()}
+                schedule.update_servers(pop3_mail_servers.values(), now)
+                next_refresh_time = now + refresh_interval
+
+                # The connection of this thread is only used for this query
+                db.connections.close_all()
+
+            polling_servers = set(in_progress.values()) | set(large_in_progress.values())
+
+            for server_id in schedule.get_due_servers(now):
+                if len(in_progress) >= concurrency:
+                    break
+
+                if server_id in polling_servers:
+                    continue
+
+                future = executor.submit(_fetch_mail_server_in_thread, pop3_mail_servers[server_id], timeout, max_message_size, parser_pool=parser_pool)
+                in_progress[future] = server_id
+                polling_servers.add(server_id)
+
+            next_poll_time = schedule.get_next_poll_time(exclude=polling_servers)
+
+            wait_time = min(STOP_CHECK_INTERVAL, next_refresh_time - now)
+            if next_poll_time is not None and len(in_progress) < concurrency:
+                wait_time = min(wait_time, next_poll_time - now)
+            wait_time = max(wait_time, 0)
+
+            if in_progress or large_in_progress:
+                done, _not_done = wait_futures(list(in_progress) + list(large_in_progress), timeout=wait_time, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    result = future.result()
+
+                    if future in large_in_progress:
+                        del large_in_progress[future]
+                        logger.info("%s", result)
+                        continue
+
+                    server_id = in_progress.pop(future)
+
+                    delay = schedule.record_result(server_id, result, time.monotonic())
+                    if delay is not None:
+                        logger.info("%s. Next poll in %d seconds", result, delay)
+
+                    if result.num_large_messages:
+                        large_future = large_executor.submit(_fetch_mail_server_in_thread, result.pop3_mail_server, timeout, max_message_size, large_messages=True, parser_pool=parser_pool)
+                        large_in_progress[large_future] = server_id
+            elif stop_event is not None:
+                stop_event.wait(wait_time)
+            else:
+                time.sleep(wait_time)
+
+        if in_progress or large_in_progress:
+            logger.info("Waiting for %d fetches in progress", len(in_progress) + len(large_in_progress))
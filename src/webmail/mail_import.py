@@ -0,0 +1,267 @@
+import os
+import re
+import time
+
+
+from django.db import transaction
+
+
+from .models import Message
+from .mail_parse import parse_raw_message
+from .exceptions import InvalidEmailMessageException
+from .logutils import get_logger
+
+
+logger = get_logger()
+
+
+# The messages of an import are read one by one from the mbox file or the
+# Maildir directory, parsed and saved in batches. Each reader yields the
+# position after every message, so an interrupted import is resumed from the
+# last saved batch.
+
+
+MBOX_FORMAT = "mbox"
+MAILDIR_FORMAT = "maildir"
+
+# Lines of the body starting with "From ", quoted with ">" in mbox files
+QUOTED_FROM_LINE_RE = re.compile(rb">+From ")
+
+BLANK_LINES = (b"\n", b"\r\n")
+
+
+def detect_format(path):
+    """
+    Returns `MAILDIR_FORMAT` for a directory, and `MBOX_FORMAT` for a file.
+    """
+    if os.path.isdir(path):
+        return MAILDIR_FORMAT
+    else:
+        return MBOX_FORMAT
+
+
+def iter_mbox(path, position=0):
+    """
+    Yields tuples with the bytes of each message of an mbox file and the
+    offset where the next one starts, starting at the offset `position`. Only
+    one message is kept in memory.
+
+    The messages start with a "From " line at the beginning of the file or
+    after a blank line. The lines of the body quoted with ">" are unquoted
+    like in the mboxrd format: one ">" is removed from the lines starting with
+    ">From ", ">>From ", etc. In files written in the mboxo format, the
+    lines of the body starting with ">From " lose their ">".
+    """
+    with open(path, "rb") as f:
+        f.seek(position)
+
+        lines = None
+        line_position = position
+
+        # `position` is the beginning of the file or of a message
+        after_blank_line = True
+
+        while True:
+            line = f.readline()
+
+            if not line or (after_blank_line and line.startswith(b"From ")):
+                if lines is not None:
+                    # The blank line separating the messages
+                    if lines and lines[-1] in BLANK_LINES:
+                        lines.pop()
+
+                    yield b"".join(lines), line_position
+
+                if not line:
+                    return
+
+                lines = []
+            elif lines is not None:
+                if QUOTED_FROM_LINE_RE.match(line):
+                    line = line[1:]
+
+                lines.append(line)
+
+            after_blank_line = line in BLANK_LINES
+            line_position = f.tell()
+
+
+def iter_maildir(path, position=None):
+    """
+    Yields tuples with the bytes of each message of a Maildir directory and
+    its key, the name of its file with its subdirectory, in order, after the
+    key `position`.
+    """
+    for subdir in ("cur", "new"):
+        subdir_path = os.path.join(path, subdir)
+        if not os.path.isdir(subdir_path):
+            continue
+
+        for file_name in sorted(os.listdir(subdir_path)):
+            key = subdir + "/" + file_name
+            if position is not None and key <= position:
+                continue
+
+            try:
+                with open(os.path.join(subdir_path, file_name), "rb") as f:
+                    raw_message = f.read()
+            except FileNotFoundError:
+                # Moved by a mail client while importing
+                continue
+
+            yield raw_message, key
+
+
+def iter_mail_source(path, format=None, position=None):
+    if format is None:
+        format = detect_format(path)
+
+    if format == MBOX_FORMAT:
+        return iter_mbox(path, position=position or 0)
+    elif format == MAILDIR_FORMAT:
+        return iter_maildir(path, position=position)
+    else:
+        raise ValueError("Unknown mail format: %s" % format)
+
+
+class ImportResult:
+    """
+    Progress of an import of messages.
+    """
+
+    def __init__(self, position=None):
+        # Position after the last saved batch
+        self.position = position
+        self.num_messages = 0
+        self.num_duplicates = 0
+        self.num_invalid = 0
+        self.num_bytes = 0
+        self.elapsed_time = 0
+
+    @property
+    def num_read(self):
+        return self.num_messages + self.num_duplicates + self.num_invalid
+
+    def __str__(self):
+        elapsed_time = self.elapsed_time or 1e-9
+        return "%d messages imported; %d duplicates; %d invalid; %d bytes in %.2f seconds (%.1f messages/s, %.2f MB/s)" % (self.num_messages, self.num_duplicates, self.num_invalid, self.num_bytes, self.elapsed_time, self.num_read / elapsed_time, self.num_bytes / elapsed_time / 1024 / 1024)
+
+
+def get_message_id(message):
+    """
+    Returns the Message-ID of a `ParsedMessage` or an email message, as it's
+    saved, or None if it has none.
+    """
+    message_id = message.get("Message-Id")
+    if message_id is None:
+        return None
+
+    # Like when it's saved
+    return message_id[0:255].strip() or None
+
+
+def _import_batch(mailbox, batch, result, folder_id=None, parser_pool=None):
+    raw_messages = [raw_message for raw_message, _position in batch]
+
+    if parser_pool is not None:
+        parsed_messages = parser_pool.parse(raw_messages, check_spam=False)
+    else:
+        parsed_messages = [parse_raw_message(raw_message, check_spam=False) for raw_message in raw_messages]
+
+    try:
+        new_messages = []
+        batch_message_ids = set()
+
+        for parsed_message in parsed_messages:
+            if parsed_message is None:
+                result.num_invalid += 1
+                continue
+
+            message_id = get_message_id(parsed_message)
+            if message_id is not None:
+                if message_id in batch_message_ids:
+                    result.num_duplicates += 1
+                    parsed_message.discard_attachments()
+                    continue
+
+                batch_message_ids.add(message_id)
+
+            new_messages.append((message_id, parsed_message))
+
+        with transaction.atomic():
+            # Already in the folder, imported before or received. The sent copy
+            # of a message sent to oneself is not a duplicate of the received one
+            existing_message_ids = set(
+                mailbox.messages
+                .filter(folder_id=Message.INBOX_FOLDER_ID if folder_id is None else folder_id, message_id__in=batch_message_ids)
+                .values_list("message_id", flat=True)
+            )
+
+            parsed_messages_to_save = []
+            for message_id, parsed_message in new_messages:
+                if message_id in existing_message_ids:
+                    result.num_duplicates += 1
+                    parsed_message.discard_attachments()
+                else:
+                    parsed_messages_to_save.append(parsed_message)
+
+            for msg_record in mailbox.import_parsed_emails(parsed_messages_to_save, folder_id=folder_id):
+                if isinstance(msg_record, InvalidEmailMessageException):
+                    result.num_invalid += 1
+                    logger.debug("Invalid email: %s", msg_record)
+                else:
+                    result.num_messages += 1
+    finally:
+        # The attachments in temporary files of the messages not saved
+        for parsed_message in parsed_messages:
+            if parsed_message is not None:
+                parsed_message.discard_attachments()
+
+    result.num_bytes += sum(len(raw_message) for raw_message in raw_messages)
+    result.position = batch[-1][1]
+
+
+def import_messages(mailbox, messages, folder_id=None, batch_size=200, max_batch_bytes=64 * 1024 * 1024, parser_pool=None, result=None, batch_callback=None):
+    """
+    Imports in `mailbox` the messages of the iterable `messages`, tuples with
+    the bytes of each message and its position, as returned by
+    `iter_mail_source`. The messages with the Message-ID of a message of the
+    folder are skipped.
+
+    The messages are saved in batches of up to `batch_size` messages or
+    `max_batch_bytes` bytes, each one in a transaction. After each batch,
+    `batch_callback` is called with the `ImportResult`, whose position is
+    the one to resume the import. The messages are parsed in the worker
+    processes of `parser_pool`, a `MessageParserPool`, if not None.
+    """
+    if result is None:
+        result = ImportResult()
+
+    start_time = time.monotonic() - result.elapsed_time
+
+    batch = []
+    batch_num_bytes = 0
+
+    def save_batch():
+        _import_batch(mailbox, batch, result, folder_id=folder_id, parser_pool=parser_pool)
+        result.elapsed_time = time.monotonic() - start_time
+
+        if batch_callback is not None:
+            batch_callback(result)
+
+    for raw_message, position in messages:
+        batch.append((raw_message, position))
+        batch_num_bytes += len(raw_message)
+
+        if len(batch) >= batch_size or batch_num_bytes >= max_batch_bytes:
+            save_batch()
+
+            batch = []
+            batch_num_bytes = 0
+
+    if batch:
+        save_batch()
+
+    result.elapsed_time = time.monotonic() - start_time
+
+    return result
@@ -0,0 +1,324 @@
+import email
+import mimetypes
+import os
+import shutil
+import signal
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from email.errors import MessageParseError, MessageDefect
+from email.message import Message as HeadersMessage
+from email.policy import default as email_policy, strict as email_strict_policy
+
+
+from django import db
+from django.core.files.base import ContentFile, File
+
+
+from . import utils, settings
+from .logutils import get_logger
+
+
+logger = get_logger()
+
+
+# Parsing the received messages, decoding their bodies and attachments, is
+# CPU-bound pure Python. `parse_email_message` extracts what is saved of a
+# message in a picklable `ParsedMessage`, so it can be done in worker
+# processes by `MessageParserPool` while the main process saves the results.
+
+
+MANDATORY_HEADERS = ["From", "To", "Subject"]
+
+
+def get_invalid_reason(email_message):
+    """
+    Returns why a received message can't be saved, or None if it's valid.
+    """
+    for header_name in MANDATORY_HEADERS:
+        if header_name not in email_message:
+            return "This is header is mandatory: %s" % header_name
+
+    return None
+
+
+def get_parsing_policy():
+    if settings.WEBMAIL_EMAIL_PARSING_STRICT_POLICY:
+        return email_strict_policy
+    else:
+        return email_policy
+
+
+def decode_email_content(email_message):
+    payload = email_message.get_payload(decode=True)
+
+    charset = email_message.get_content_charset()
+    if not charset:
+        charset = 'ascii'
+
+    try:
+        # Make sure that the payload can be properly decoded in the
+        # defined charset, if it can't, let's mash some things
+        # inside the payload :-\
+        content = payload.decode(charset)
+    except LookupError:
+        logger.warning(
+            "Unknown encoding %s; interpreting as ASCII!",
+            charset
+        )
+        content = payload.decode(
+            'ascii',
+            'ignore'
+        )
+    except ValueError:
+        logger.warning(
+            "Decoding error encountered; interpreting %s as ASCII!",
+            charset
+        )
+        content = payload.decode(
+            'ascii',
+            'ignore'
+        )
+
+    return content
+
+
+class ParsedAttachment:
+    """
+    Decoded attachment of a received message. Its contents are kept in memory
+    or, when parsed in a worker process, written to a temporary file at
+    `path`, so they are not sent back through a pipe.
+    """
+
+    def __init__(self, file_name, mimetype, contents=None, path=None):
+        self.file_name = file_name
+        self.mimetype = mimetype
+        self.contents = contents
+        self.path = path
+
+    def get_extension(self):
+        return os.path.splitext(self.file_name)[1] or ".bin"
+
+    def open(self):
+        """
+        Returns a Django `File` with the contents.
+        """
+        if self.path is not None:
+            return File(open(self.path, "rb"))
+        else:
+            return ContentFile(self.contents)
+
+    def discard(self):
+        """
+        Removes the temporary file, if any. Call it once the attachment is
+        saved or discarded.
+        """
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+
+class ParsedMessage:
+    """
+    What is saved of a received message: its headers, the decoded bodies and
+    the attachments. Unlike `email.message.EmailMessage`, it's cheap to
+    pickle.
+    """
+
+    def __init__(self, headers, text_plain=None, html=None, attachments=None, is_spam=False, invalid_reason=None):
+        # List of tuples with the name and the value of each header
+        self.headers = headers
+        self.text_plain = text_plain
+        self.html = html
+        self.attachments = attachments if attachments is not None else []
+        self.is_spam = is_spam
+        self.invalid_reason = invalid_reason
+
+    def get(self, name, default=None):
+        """
+        Returns the value of the first header with this name, case insensitive.
+        """
+        name = name.lower()
+        for header_name, value in self.headers:
+            if header_name.lower() == name:
+                return value
+
+        return default
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def get_headers_message(self):
+        """
+        Returns an `email.message.Message` with only the headers, for the
+        receivers of the signals expecting a message.
+        """
+        headers_message = HeadersMessage()
+        for name, value in self.headers:
+            headers_message[name] = value
+
+        return headers_message
+
+    def discard_attachments(self):
+        for attachment in self.attachments:
+            attachment.discard()
+
+
+def _parse_email_attachment(attachment, temp_dir=None):
+    attachment_content_type = attachment.get_content_type()
+
+    raw_filename = attachment.get_filename()
+
+    if raw_filename is None:
+        extension = mimetypes.guess_extension(attachment_content_type)
+
+        if not extension:
+            extension = '.bin'
+
+        file_name = "unknown" + extension
+    else:
+        file_name = utils.convert_header_to_unicode(raw_filename)
+
+    contents = attachment.get_payload(decode=True) or b''
+
+    if temp_dir is None:
+        return ParsedAttachment(file_name, attachment_content_type, contents=contents)
+
+    fd, path = tempfile.mkstemp(prefix="webmail-attachment-", dir=temp_dir)
+    with os.fdopen(fd, "wb") as f:
+        f.write(contents)
+
+    return ParsedAttachment(file_name, attachment_content_type, path=path)
+
+
+def parse_email_message(email_message, is_spam=False, temp_dir=None):
+    """
+    Returns the `ParsedMessage` of a received email message. The attachments
+    are written to temporary files in `temp_dir`, if not None.
+    """
+    headers = [(name, str(value)) for name, value in email_message.items()]
+
+    invalid_reason = get_invalid_reason(email_message)
+    if invalid_reason is not None:
+        return ParsedMessage(headers, is_spam=is_spam, invalid_reason=invalid_reason)
+
+    parsed_message = ParsedMessage(headers, is_spam=is_spam)
+
+    plain_text_body = email_message.get_body(preferencelist=('plain'))
+    html_body = email_message.get_body(preferencelist=('html'))
+
+    if plain_text_body is not None:
+        parsed_message.text_plain = decode_email_content(plain_text_body)
+
+    if html_body is not None:
+        parsed_message.html = decode_email_content(html_body)
+
+    if email_message.is_multipart():
+        if settings.WEBMAIL_STRIP_UNALLOWED_MIMETYPES and settings.WEBMAIL_ALLOWED_MIMETYPES is not None:
+            allowed_mimetypes = settings.WEBMAIL_ALLOWED_MIMETYPES
+        else:
+            allowed_mimetypes = None
+
+        try:
+            for attachment in email_message.iter_attachments():
+                if allowed_mimetypes is not None and attachment.get_content_type() not in allowed_mimetypes:
+                    continue
+
+                parsed_message.attachments.append(_parse_email_attachment(attachment, temp_dir=temp_dir))
+        except BaseException:
+            parsed_message.discard_attachments()
+            raise
+
+    return parsed_message
+
+
+def parse_raw_message(raw_message, temp_dir=None, check_spam=True):
+    """
+    Parses the bytes of a received message, also checking whether it's spam
+    if `check_spam`. Returns a `ParsedMessage`, or None if it can't be parsed.
+    """
+    # Not imported at module level, the models import this module
+    from .models import is_spam
+
+    try:
+        email_message = email.message_from_bytes(raw_message, policy=get_parsing_policy())
+    except (MessageParseError, MessageDefect):
+        return None
+
+    return parse_email_message(email_message, is_spam=check_spam and is_spam(email_message), temp_dir=temp_dir)
+
+
+def _init_worker():
+    # Control+C is handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _parse_raw_message_in_worker(raw_message, temp_dir, check_spam):
+    try:
+        return parse_raw_message(raw_message, temp_dir=temp_dir, check_spam=check_spam)
+    except Exception:
+        logger.exception("Error parsing a message")
+        return None
+
+
+class MessageParserPool:
+    """
+    Parses received messages in `processes` worker processes. The
+    attachments are passed back in temporary files, in a directory created
+    in `temp_dir`, the default temporary directory if None.
+    """
+
+    def __init__(self, processes=None, temp_dir=settings.WEBMAIL_PARSE_TEMP_DIR):
+        self.processes = processes or os.cpu_count()
+        self.base_temp_dir = temp_dir
+
+        # Removed with the attachments left in it, of the messages whose
+        # parsing was interrupted, when the pool is shut down
+        self.temp_dir = None
+
+        self._executor = None
+
+    def start(self):
+        """
+        Starts the worker processes. Call it before starting other threads,
+        the workers are forked.
+        """
+        # The workers must not share the database connections
+        db.connections.close_all()
+
+        self.temp_dir = tempfile.mkdtemp(prefix="webmail-parse-", dir=self.base_temp_dir)
+
+        self._executor = ProcessPoolExecutor(max_workers=self.processes, initializer=_init_worker)
+
+        # The workers are started with the first task, not when they are
+        # first needed by a fetch thread
+        self._executor.submit(int).result()
+
+    def parse(self, raw_messages, check_spam=True):
+        """
+        Returns the list of `ParsedMessage` of the bytes of `raw_messages`, or
+        None for the messages that can't be parsed.
+        """
+        raw_messages = list(raw_messages)
+
+        chunksize = max(1, len(raw_messages) // (self.processes * 4))
+
+        return list(self._executor.map(_parse_raw_message_in_worker, raw_messages, [self.temp_dir] * len(raw_messages), [check_spam] * len(raw_messages), chunksize=chunksize))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+        if self.temp_dir is not None:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            self.temp_dir = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
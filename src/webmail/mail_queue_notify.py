@@ -0,0 +1,238 @@
+import os
+import select
+import socket
+import uuid
+
+
+from django.db import connections, transaction
+
+try:
+    from django.db.backends.postgresql.psycopg_any import is_psycopg3
+except ImportError:
+    is_psycopg3 = False
+
+
+from . import settings
+from .logutils import get_logger
+
+
+logger = get_logger()
+
+
+# Sending processes waiting for new tasks are woken up using PostgreSQL
+# LISTEN/NOTIFY when the queue is stored in PostgreSQL. Otherwise, each waiting
+# process binds a Unix datagram socket inside WEBMAIL_MAILER_WAKEUP_SOCKET_DIR
+# and the processes adding tasks to the queue send a datagram to all of them.
+# This only works for processes on the same host. Processes on other hosts
+# still check the queue every `sleep_time_if_queue_empty` seconds.
+#
+# The processes adding tasks, like the web processes, need write access to
+# the directory and the sockets. They are created with the permissions of
+# WEBMAIL_MAILER_WAKEUP_SOCKET_MODE, by default for the group of the sending
+# processes.
+
+
+# The errors notifying the sockets are logged only once, they would repeat
+# with every queued message
+_notify_error_logged = False
+
+
+def _log_notify_error(message, *args):
+    global _notify_error_logged
+
+    if not _notify_error_logged:
+        _notify_error_logged = True
+        logger.warning(message + ". The sending processes will only check the queue periodically.", *args)
+    else:
+        logger.debug(message, *args)
+
+
+def _is_postgresql(using):
+    return connections[using].vendor == "postgresql"
+
+
+def _notify_wakeup_sockets(socket_dir):
+    try:
+        socket_names = os.listdir(socket_dir)
+    except FileNotFoundError:
+        return
+    except OSError as e:
+        _log_notify_error("Not possible to list the wakeup sockets in %s: %s", socket_dir, e)
+        return
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+
+        for socket_name in socket_names:
+            socket_path = os.path.join(socket_dir, socket_name)
+
+            try:
+                sock.sendto(b"1", socket_path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Left over by a process that was killed
+                try:
+                    os.remove(socket_path)
+                except OSError:
+                    pass
+            except BlockingIOError:
+                # The listener already has pending notifications
+                pass
+            except OSError as e:
+                _log_notify_error("Not possible to notify %s: %s", socket_path, e)
+
+
+def notify_mail_queued(using="default",
+    channel=settings.WEBMAIL_MAILER_WAKEUP_CHANNEL,
+    socket_dir=settings.WEBMAIL_MAILER_WAKEUP_SOCKET_DIR):
+    """
+    Wakes up the sending processes waiting for new tasks in the queue.
+    """
+    if not settings.WEBMAIL_MAILER_WAKEUP_ENABLED:
+        return
+
+    if _is_postgresql(using):
+        with connections[using].cursor() as cursor:
+            cursor.execute("NOTIFY %s" % connections[using].ops.quote_name(channel))
+    elif socket_dir is not None and hasattr(socket, "AF_UNIX"):
+        _notify_wakeup_sockets(socket_dir)
+
+
+def on_message_queued(sender, send_mail_task=None, **kwargs):
+    """
+    Receiver of `message_queued_signal`. Listeners are notified only when the
+    transaction adding the task is committed, otherwise they could wake up
+    before the task is visible for them.
+    """
+    using = send_mail_task._state.db if send_mail_task is not None else "default"
+
+    transaction.on_commit(lambda: notify_mail_queued(using=using), using=using)
+
+
+class QueueWakeupListener:
+    """
+    Waits for the notifications sent by `notify_mail_queued`.
+
+    Start listening before checking the queue for the last time, otherwise a
+    notification sent in between would be lost.
+    """
+
+    def __init__(self, using="default",
+        channel=settings.WEBMAIL_MAILER_WAKEUP_CHANNEL,
+        socket_dir=settings.WEBMAIL_MAILER_WAKEUP_SOCKET_DIR,
+        socket_mode=settings.WEBMAIL_MAILER_WAKEUP_SOCKET_MODE):
+        self.using = using
+        self.channel = channel
+        self.socket_dir = socket_dir
+        self.socket_mode = socket_mode
+
+        self._listen_connection = None
+        self._socket = None
+        self._socket_path = None
+
+    def listen(self):
+        if not settings.WEBMAIL_MAILER_WAKEUP_ENABLED:
+            return
+
+        if _is_postgresql(self.using):
+            # A dedicated connection, so the LISTEN is not lost when the
+            # connection used for the queries is closed or reconnected
+            self._listen_connection = connections[self.using].copy()
+            self._listen_connection.ensure_connection()
+            self._listen_connection.set_autocommit(True)
+
+            with self._listen_connection.cursor() as cursor:
+                cursor.execute("LISTEN %s" % self._listen_connection.ops.quote_name(self.channel))
+
+            logger.debug("Listening PostgreSQL notifications on channel '%s'", self.channel)
+        elif self.socket_dir is not None and hasattr(socket, "AF_UNIX"):
+            self._create_socket_dir()
+
+            self._socket_path = os.path.join(self.socket_dir, "%d-%s.sock" % (os.getpid(), uuid.uuid4().hex[:8]))
+
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.bind(self._socket_path)
+            self._socket.setblocking(False)
+
+            # Sending a datagram requires write permission on the socket
+            os.chmod(self._socket_path, self.socket_mode & 0o666)
+
+            logger.debug("Listening wakeup notifications on %s", self._socket_path)
+
+    def _create_socket_dir(self):
+        try:
+            os.makedirs(self.socket_dir)
+        except FileExistsError:
+            return
+
+        # The mode of `makedirs` would be restricted by the umask
+        os.chmod(self.socket_dir, self.socket_mode)
+
+    @property
+    def is_listening(self):
+        return self._listen_connection is not None or self._socket is not None
+
+    def wait(self, timeout):
+        """
+        Blocks until a notification is received or `timeout` seconds elapsed.
+        Returns True if a notification was received.
+        """
+        if self._listen_connection is not None:
+            return self._wait_postgresql(timeout)
+        elif self._socket is not None:
+            return self._wait_socket(timeout)
+        else:
+            # Plain polling
+            select.select([], [], [], timeout)
+            return False
+
+    def _wait_postgresql(self, timeout):
+        raw_connection = self._listen_connection.connection
+
+        if is_psycopg3:
+            for notify in raw_connection.notifies(timeout=timeout, stop_after=1):
+                return True
+            return False
+
+        if not raw_connection.notifies:
+            readable, _, _ = select.select([raw_connection], [], [], timeout)
+            if readable:
+                raw_connection.poll()
+
+        notified = bool(raw_connection.notifies)
+        raw_connection.notifies.clear()
+        return notified
+
+    def _wait_socket(self, timeout):
+        readable, _, _ = select.select([self._socket], [], [], timeout)
+        if not readable:
+            return False
+
+        # Several notifications wake up only once
+        while True:
+            try:
+                self._socket.recv(16)
+            except BlockingIOError:
+                break
+
+        return True
+
+    def close(self):
+        if self._listen_connection is not None:
+            self._listen_connection.close()
+            self._listen_connection = None
+
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+            try:
+                os.remove(self._socket_path)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self.listen()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,482 @@
+import base64
+import os
+import random
+import socket
+import socketserver
+import threading
+import time
+
+
+from django import db
+from django.core.files.base import ContentFile
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save
+from django.utils import timezone
+
+
+from .models import WebmailUser, Mailbox, SmtpServer, Message, MessageAttachment, SendMailTask
+from .signals import send_outcomes_written_signal
+from .fake_data import random_email, random_text, generate_random_subject
+from .mail_send_engine import send_all, send_all_loop
+from .mail_send_engine_async import send_all_asyncio
+from .logutils import get_logger
+
+
+logger = get_logger()
+
+
+# Benchmark of the delivery of the queue. The tasks are sent to an SMTP server
+# running in a thread of the same process, so it works offline and the
+# results depend only on the engine, the database and the injected latency.
+#
+# The benchmark writes to the database. `benchmarksendmail` runs it in a test
+# database.
+
+
+# Max length of a command line accepted by the sink
+MAX_LINE_LENGTH = 8192
+
+SINK_HOSTNAME = "benchmark-sink"
+
+
+class _SmtpSinkHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+
+        # Each reply is a separate write. With the pipelined commands of the
+        # client, Nagle's algorithm would hold the replies until the client
+        # acknowledges the previous one, something servers buffering their
+        # replies don't do.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def read_line(self):
+        """
+        Returns None if the client disconnected.
+        """
+        line = self.rfile.readline(MAX_LINE_LENGTH)
+        if not line:
+            return None
+
+        return line.decode("ascii", "replace").rstrip("\r\n")
+
+    def authenticate(self, argument):
+        mechanism, _sep, initial_response = argument.partition(" ")
+        mechanism = mechanism.upper()
+
+        # Any credentials are accepted
+        if mechanism == "PLAIN":
+            if not initial_response:
+                self.reply("334 ")
+                self.read_line()
+        elif mechanism == "LOGIN":
+            if not initial_response:
+                self.reply("334 " + base64.b64encode(b"Username:").decode("ascii"))
+                self.read_line()
+
+            self.reply("334 " + base64.b64encode(b"Password:").decode("ascii"))
+            self.read_line()
+        else:
+            self.reply("504 5.5.4 Unrecognized authentication type")
+            return
+
+        self.reply("235 2.7.0 Authentication successful")
+
+    def read_data(self):
+        """
+        Returns the size of the message, or None if the client disconnected.
+        """
+        size = 0
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return None
+
+            if line in (b".\r\n", b".\n"):
+                return size
+
+            size += len(line)
+
+    def handle(self):
+        sink = self.server.sink
+        sink.count("connections")
+
+        self.reply("220 %s ESMTP" % SINK_HOSTNAME)
+
+        while True:
+            line = self.read_line()
+            if line is None:
+                return
+
+            command, _sep, argument = line.partition(" ")
+            command = command.upper()
+
+            if command == "EHLO":
+                self.wfile.write(("250-%s\r\n250-PIPELINING\r\n250-SIZE\r\n250-8BITMIME\r\n250 AUTH PLAIN LOGIN\r\n" % SINK_HOSTNAME).encode("ascii"))
+            elif command == "HELO":
+                self.reply("250 " + SINK_HOSTNAME)
+            elif command == "AUTH":
+                self.authenticate(argument)
+            elif command in ("MAIL", "RCPT", "RSET", "NOOP"):
+                self.reply("250 2.0.0 Ok")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+
+                size = self.read_data()
+                if size is None:
+                    return
+
+                action = sink.choose_action()
+                if action == "disconnect":
+                    sink.count("disconnects")
+                    return
+
+                if sink.latency:
+                    time.sleep(sink.latency)
+
+                if action == "defer":
+                    sink.count("deferred")
+                    self.reply("451 4.3.0 Temporary failure injected by the benchmark")
+                else:
+                    sink.count("messages")
+                    sink.count("bytes", size)
+                    self.reply("250 2.0.0 Ok: queued")
+            elif command == "QUIT":
+                self.reply("221 2.0.0 Bye")
+                return
+            else:
+                self.reply("502 5.5.2 Command not recognized")
+
+
+class _SmtpSinkServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class SmtpSink:
+    """
+    SMTP server accepting and discarding all the messages, in a thread of
+    this process. Each message is answered after `latency` seconds, and a
+    fraction of them, chosen at random, are deferred with a 4xx reply
+    (`defer_rate`) or the connection is closed instead of replying
+    (`disconnect_rate`).
+    """
+
+    def __init__(self, latency=0, defer_rate=0, disconnect_rate=0, seed=None, host="127.0.0.1", port=0):
+        self.latency = latency
+        self.defer_rate = defer_rate
+        self.disconnect_rate = disconnect_rate
+        self.host = host
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+        self.counters = dict.fromkeys(["connections", "messages", "bytes", "deferred", "disconnects"], 0)
+
+        self._server = _SmtpSinkServer((host, port), _SmtpSinkHandler)
+        self._server.sink = self
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def choose_action(self):
+        with self._lock:
+            value = self._random.random()
+
+        if value < self.disconnect_rate:
+            return "disconnect"
+        elif value < self.disconnect_rate + self.defer_rate:
+            return "defer"
+        else:
+            return "accept"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="smtp-sink", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def seed_send_mail_tasks(num_tasks, smtp_host, smtp_port, num_mailboxes=1, message_size=2000, num_recipients=1, attachment_size=0):
+    """
+    Queues `num_tasks` messages with a text body of `message_size`
+    characters, `num_recipients` random recipients and, if `attachment_size`
+    is not 0, an attachment of that many random bytes. The messages are sent
+    from `num_mailboxes` mailboxes in turn, all of them with the SMTP server
+    `smtp_host`:`smtp_port`.
+    """
+    user = WebmailUser.objects.create_user(username="benchmark", password="benchmark")
+
+    mailboxes = []
+    for num_mailbox in range(num_mailboxes):
+        email = "benchmark%d@example.com" % num_mailbox
+
+        mailbox = Mailbox.objects.create(user=user, name="benchmark%d" % num_mailbox, emails=email)
+        SmtpServer.objects.create(mailbox=mailbox, ip_address=smtp_host, port=smtp_port, username="benchmark", password="benchmark", from_email=email)
+
+        mailboxes.append(mailbox)
+
+    for num_task in range(num_tasks):
+        mailbox = mailboxes[num_task % num_mailboxes]
+
+        message = Message(
+            mailbox=mailbox,
+            from_email=mailbox.emails,
+            subject=generate_random_subject(),
+            to=[random_email() for i in range(num_recipients)],
+            text_plain=random_text(message_size))
+
+        if attachment_size:
+            message.save()
+
+            file_name = "attachment%d.bin" % num_task
+            MessageAttachment.objects.create(file=ContentFile(os.urandom(attachment_size), file_name), file_name=file_name, mimetype="application/octet-stream", message=message)
+
+        message.dispatch()
+
+
+def delete_benchmark_data():
+    """
+    Deletes the files stored by the benchmark: the attachments and, through
+    the deletion of the tasks, their payloads in the spool.
+    """
+    for attachment in MessageAttachment.objects.filter(message__mailbox__user__username="benchmark"):
+        attachment.delete()
+
+    SendMailTask.objects.filter(mailbox__user__username="benchmark").delete()
+
+
+class _QueryCounter:
+    """
+    Counts the queries of all the database connections, including the ones
+    opened by other threads like the one of the asyncio engine.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+
+        return execute(sql, params, many, context)
+
+    def _add_to(self, connection):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def _on_connection_created(self, sender, connection, **kwargs):
+        self._add_to(connection)
+
+    def __enter__(self):
+        for connection in db.connections.all():
+            self._add_to(connection)
+
+        connection_created.connect(self._on_connection_created)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        connection_created.disconnect(self._on_connection_created)
+
+        for connection in db.connections.all():
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+
+class _TaskLatencyRecorder:
+    """
+    Measures the time of each delivery attempt, from the creation of its
+    `SendMailTaskBatch` until its results are written to the database.
+    """
+
+    def __init__(self, num_tasks, stop_event):
+        self.num_tasks = num_tasks
+        self.stop_event = stop_event
+
+        self.latencies = []
+        self.num_finished = 0
+        self.last_finished_at = None
+
+        self._lock = threading.Lock()
+
+    def _finish(self, latency=None):
+        now = time.monotonic()
+
+        with self._lock:
+            if latency is not None:
+                self.latencies.append(latency)
+
+            self.num_finished += 1
+            self.last_finished_at = now
+
+            if self.num_finished >= self.num_tasks:
+                self.stop_event.set()
+
+    def _on_outcomes_written(self, sender, batches, **kwargs):
+        now = timezone.now()
+
+        for batch in batches:
+            self._finish((now - batch.processed_at).total_seconds())
+
+    def _on_task_saved(self, sender, instance, update_fields=None, **kwargs):
+        # Cancelled without a delivery attempt
+        if update_fields and "status" in update_fields and instance.status == SendMailTask.STATUS_CANCELLED:
+            self._finish()
+
+    def __enter__(self):
+        send_outcomes_written_signal.connect(self._on_outcomes_written)
+        post_save.connect(self._on_task_saved, sender=SendMailTask)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        send_outcomes_written_signal.disconnect(self._on_outcomes_written)
+        post_save.disconnect(self._on_task_saved, sender=SendMailTask)
+
+
+def _percentile(sorted_values, percent):
+    # Nearest-rank method
+    if not sorted_values:
+        return None
+
+    index = max(0, int(round(percent / 100 * len(sorted_values) + 0.5)) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+class SendBenchmarkResult:
+    def __init__(self, engine, loop, num_tasks, elapsed_time, stats, latencies, num_queries, sink_counters):
+        self.engine = engine
+        self.loop = loop
+        self.num_tasks = num_tasks
+        self.elapsed_time = elapsed_time
+        self.stats = stats
+        self.latencies = sorted(latencies)
+        self.num_queries = num_queries
+        self.sink_counters = sink_counters
+
+    @property
+    def messages_per_second(self):
+        return self.stats.num_succeed / self.elapsed_time if self.elapsed_time else 0
+
+    @property
+    def queries_per_task(self):
+        return self.num_queries / self.stats.num_tasks_processed if self.stats.num_tasks_processed else 0
+
+    def get_latency_percentile(self, percent):
+        return _percentile(self.latencies, percent)
+
+    def to_dict(self):
+        return {
+            "engine": self.engine,
+            "loop": self.loop,
+            "num_tasks": self.num_tasks,
+            "elapsed_time": self.elapsed_time,
+            "messages_per_second": self.messages_per_second,
+            "latency_p50": self.get_latency_percentile(50),
+            "latency_p99": self.get_latency_percentile(99),
+            "num_queries": self.num_queries,
+            "queries_per_task": self.queries_per_task,
+            "num_tasks_processed": self.stats.num_tasks_processed,
+            "num_succeed": self.stats.num_succeed,
+            "num_failed": self.stats.num_failed,
+            "num_deferred": self.stats.num_deferred,
+            "num_cancelled": self.stats.num_cancelled,
+            "num_rate_limited": self.stats.num_rate_limited,
+            "sink": dict(self.sink_counters),
+        }
+
+    def __str__(self):
+        def format_latency(percent):
+            latency = self.get_latency_percentile(percent)
+            return "-" if latency is None else "%.1f ms" % (latency * 1000)
+
+        return "\n".join([
+            "Engine: %s%s" % (self.engine, " (loop)" if self.loop else ""),
+            "Tasks: %s" % self.stats,
+            "Elapsed: %.2f seconds" % self.elapsed_time,
+            "Throughput: %.1f messages/second" % self.messages_per_second,
+            "Latency per task: p50 %s, p99 %s" % (format_latency(50), format_latency(99)),
+            "Database queries: %d (%.1f per task)" % (self.num_queries, self.queries_per_task),
+            "SMTP sink: %(connections)d connections, %(messages)d messages accepted (%(bytes)d bytes), %(deferred)d deferred, %(disconnects)d disconnects" % self.sink_counters,
+        ])
+
+
+def run_send_benchmark(
+    num_tasks=1000,
+    engine="sync",
+    loop=False,
+    num_mailboxes=1,
+    message_size=2000,
+    num_recipients=1,
+    attachment_size=0,
+    latency=0,
+    defer_rate=0,
+    disconnect_rate=0,
+    seed=None,
+    **send_kwargs):
+    """
+    Queues `num_tasks` messages (see `seed_send_mail_tasks`) and sends them to
+    an `SmtpSink` with `engine`, "sync" or "asyncio", in a single delivery run
+    or, if `loop` is True, with `send_all_loop` until all the tasks are
+    processed. The rest of the keyword arguments are passed to the engine.
+
+    Deferred tasks are not retried. Returns a `SendBenchmarkResult`.
+    """
+    if engine == "asyncio":
+        send_function = send_all_asyncio
+    elif engine == "sync":
+        send_function = None
+    else:
+        raise ValueError("Unknown engine '%s'" % engine)
+
+    with SmtpSink(latency=latency, defer_rate=defer_rate, disconnect_rate=disconnect_rate, seed=seed) as sink:
+        logger.info("Queueing %d messages", num_tasks)
+
+        seed_send_mail_tasks(num_tasks, sink.host, sink.port,
+            num_mailboxes=num_mailboxes,
+            message_size=message_size,
+            num_recipients=num_recipients,
+            attachment_size=attachment_size)
+
+        stop_event = threading.Event()
+
+        with _QueryCounter() as query_counter, _TaskLatencyRecorder(num_tasks, stop_event) as latency_recorder:
+            start_time = time.monotonic()
+
+            if loop:
+                stats = send_all_loop(stop_event=stop_event, send_function=send_function, **send_kwargs)
+            else:
+                stats = (send_function or send_all)(**send_kwargs)
+
+            end_time = latency_recorder.last_finished_at or time.monotonic()
+
+        delete_benchmark_data()
+
+    return SendBenchmarkResult(
+        engine=engine,
+        loop=loop,
+        num_tasks=num_tasks,
+        elapsed_time=end_time - start_time,
+        stats=stats,
+        latencies=latency_recorder.latencies,
+        num_queries=query_counter.count,
+        sink_counters=sink.counters)
@@ -1,92 +1,58 @@
 import contextlib
-import smtplib
+import functools
 import time
-from socket import error as socket_error
 
 
-from django.db import NotSupportedError, OperationalError, transaction
-from django.db.models import Q
 from django.utils import timezone
 
 
 from .models import SendMailTask, NoSmtpServerConfiguredException
+from .smtp_transport import SmtpConnectionPool
+from .send_rate_limit import SendRateLimiter
+from .send_scheduler import get_send_scheduler
+from .retry_policy import RetryPolicy
+from .send_outcome_writer import SendOutcomeWriter
+from .send_lock import get_send_lock
+from .mail_queue_notify import QueueWakeupListener
 from .logutils import get_logger
-from . import settings, lockfile
+from . import settings, lockfile, metrics
 
 
 logger = get_logger()
 
 
-def prioritize_sending_email_tasks_ids():
-    """
-    Returns the messages in the queue in the order they should be sent.
-    """
-    for task_data in SendMailTask.objects.non_deferred().order_by('priority', 'created_at').values("id"):
-        yield task_data["id"]
-
-
-@contextlib.contextmanager
-def sender_context(send_mail_task_id):
-    """
-    Makes a context manager appropriate for sending a message.
-    Entering the context using `with` may return a `None` object if the message
-    has been sent/deleted already.
-    """
-    # We wrap each message sending inside a transaction (otherwise
-    # select_for_update doesn't work).
-
-    # We also do `nowait` for databases that support it. The result of this is
-    # that if two processes (which might be on different machines) both attempt
-    # to send the same queue, the loser for the first message will immediately
-    # get an error, and will be able to try the second message. This means the
-    # work for sending the messages will be distributed between the two
-    # processes. Otherwise, the losing process has to wait for the winning
-    # process to finish and release the lock, and the winning process will
-    # almost always win the next message etc.
-    with transaction.atomic():
-        try:
-            try:
-                yield SendMailTask.objects.filter(id=send_mail_task_id).select_for_update(nowait=True).get()
-            except NotSupportedError:
-                # MySQL does not support the 'nowait' argument
-                yield SendMailTask.objects.filter(id=send_mail_task_id).select_for_update().get()
-        except SendMailTask.DoesNotExist:
-            # Deleted by someone else
-            yield None
-        except OperationalError:
-            # Locked by someone else
-            yield None
-
-
-def get_sending_email_context_managers():
-    """
-    Returns a series of context managers that are used for sending mails in the queue.
-    Entering the context manager returns the actual message
-    """
-    for task_id in prioritize_sending_email_tasks_ids():
-        yield sender_context(task_id)
+# Seconds between checks of the stop event while waiting for new messages
+STOP_CHECK_INTERVAL = 1
 
 
 def acquire_lock(
     lock_path=settings.WEBMAIL_MAILER_LOCK_PATH,    
-    lock_wait_timeout=settings.WEBMAIL_MAILER_LOCK_WAIT_TIMEOUT):
+    lock_wait_timeout=settings.WEBMAIL_MAILER_LOCK_WAIT_TIMEOUT,
+    lock_backend=settings.WEBMAIL_MAILER_LOCK_BACKEND):
     # lock_path: allows for a different lockfile path. The default is a file
-    # in the current working directory.
+    # in the current working directory. With the database backend, it's the
+    # name of the lock.
 
     # lock_wait_timeout: lock timeout value. how long to wait for the lock to become available.
     # default behavior is to never wait for the lock to be available.
 
 
-    lock = lockfile.FileLock(lock_path)
+    lock = get_send_lock(lock_backend, lock_path)
+
+    start_time = time.monotonic()
 
     try:
         lock.acquire(lock_wait_timeout)
     except lockfile.AlreadyLocked:
+        metrics.LOCK_WAIT_SECONDS.observe(time.monotonic() - start_time, result="already_locked")
         logger.debug("Not possible to acquire the lock. Lock already in place. quitting.")
         return False, lock
     except lockfile.LockTimeout:
+        metrics.LOCK_WAIT_SECONDS.observe(time.monotonic() - start_time, result="timeout")
         logger.debug("Not possible to acquire the lock. Waiting for the lock timed out. quitting.")
         return False, lock
+
+    metrics.LOCK_WAIT_SECONDS.observe(time.monotonic() - start_time, result="acquired")
     logger.debug("Lock acquired.")
     return True, lock
 
@@ -97,20 +63,142 @@ def release_lock(lock):
     logger.debug("Lock released.")
 
 
+class SendMailStats:
+    """
+    Counters of a delivery run.
+    """
+
+    def __init__(self):
+        self.num_tasks_processed = 0
+        self.num_succeed = 0
+        self.num_failed = 0
+        self.num_deferred = 0
+        self.num_cancelled = 0
+        self.num_rate_limited = 0
+        self.elapsed_time = 0
+
+    def __iadd__(self, other):
+        self.num_tasks_processed += other.num_tasks_processed
+        self.num_succeed += other.num_succeed
+        self.num_failed += other.num_failed
+        self.num_deferred += other.num_deferred
+        self.num_cancelled += other.num_cancelled
+        self.num_rate_limited += other.num_rate_limited
+        self.elapsed_time += other.elapsed_time
+        return self
+
+    def __str__(self):
+        return "%d total processed; %s succeed; %d failed: %d deferred; %d cancelled; %d postponed by rate limits." % (self.num_tasks_processed, self.num_succeed, self.num_failed, self.num_deferred, self.num_cancelled, self.num_rate_limited)
+
+
+def is_round_finished_for(stats, stop_event, max_processed_tasks_in_batch=None, max_succeed_tasks_in_batch=None, max_failed_tasks_in_batch=None, max_failed_or_deferred_tasks_in_batch=None):
+    """
+    Whether a delivery run with the counters `stats` has to stop.
+    """
+    if stop_event is not None and stop_event.is_set():
+        logger.info("Stop requested, stopping for this round")
+        return True
+
+    # Allow sending a fixed/limited amount of emails in each delivery run
+
+    if max_processed_tasks_in_batch is not None and stats.num_tasks_processed >= max_processed_tasks_in_batch:
+        logger.warning("Max number of email sending tasks processed (%s) reached, stopping for this round", max_processed_tasks_in_batch)
+        return True
+
+    if max_succeed_tasks_in_batch is not None and stats.num_succeed >= max_succeed_tasks_in_batch:
+        logger.info("Max succeed tasks (%s) sending email reached, stopping for this round", max_succeed_tasks_in_batch)
+        return True
+
+    if max_failed_tasks_in_batch is not None and stats.num_failed >= max_failed_tasks_in_batch:
+        logger.warning("Max failed tasks (%s) sending email reached, stopping for this round", max_failed_tasks_in_batch)
+        return True
+
+    if max_failed_or_deferred_tasks_in_batch is not None and stats.num_failed + stats.num_deferred >= max_failed_or_deferred_tasks_in_batch:
+        logger.warning("Max failed or deferred (%s) reached sending email, stopping for this round", max_failed_or_deferred_tasks_in_batch)
+        return True
+
+    return False
+
+
+def finish_task(send_email_task, success, stats, retry_delay, delete_completed_tasks, outcome_writer=None):
+    """
+    Moves the task to its next status after a delivery attempt and updates
+    `stats`. A failed task is retried after `retry_delay` seconds, or marked
+    as failed if None.
+
+    The task is saved by `outcome_writer`, if provided, otherwise right away.
+    """
+    if success:
+        stats.num_succeed += 1
+        metrics.TASKS.inc(outcome="succeeded")
+
+        if delete_completed_tasks:
+            if outcome_writer is None:
+                send_email_task.delete()
+            else:
+                outcome_writer.delete_task(send_email_task)
+        else:
+            send_email_task.set_status_completed(outcome_writer=outcome_writer)
+    else:
+        if retry_delay is not None:
+            send_email_task.defer(outcome_writer=outcome_writer, seconds=retry_delay)
+            logger.info("Sending email task #%d deferred due to failure. Next attempt in %d seconds", send_email_task.id, retry_delay)
+
+            stats.num_deferred += 1
+            metrics.TASKS.inc(outcome="deferred")
+        else:
+            send_email_task.set_status_failed(outcome_writer=outcome_writer)
+            stats.num_failed += 1
+            metrics.TASKS.inc(outcome="failed")
+
+
 def send_all(
     max_processed_tasks_in_batch=settings.WEBMAIL_MAILER_MAX_PROCESSED_TASKS_IN_BATCH,
     max_succeed_tasks_in_batch=settings.WEBMAIL_MAILER_MAX_SUCCEED_TASKS_IN_BATCH,
     max_failed_tasks_in_batch=settings.WEBMAIL_MAILER_MAX_FAILED_TASKS_IN_BATCH,
     max_failed_or_deferred_tasks_in_batch=settings.WEBMAIL_MAILER_MAX_FAILED_OR_DEFERRED_TASKS_IN_BATCH,
     max_times_mail_deferred=settings.WEBMAIL_MAILER_MAX_TIMES_MAIL_DEFERRED,
-    sleep_time_if_no_lock_acquired=settings.WEBMAIL_MAILER_SLEEP_TIME_IF_NO_LOCK_ACQUIRED,
     throttle_time=settings.WEBMAIL_MAILER_THROTTLE_TIME, 
     delete_completed_tasks=settings.WEBMAIL_MAILER_DELETE_COMPLETED_TASKS, 
     defer_duration=settings.WEBMAIL_MAILER_DEFER_DURATION, 
-    lock_path=settings.WEBMAIL_MAILER_LOCK_PATH, 
-    lock_wait_timeout=settings.WEBMAIL_MAILER_LOCK_WAIT_TIMEOUT):
+    claim_batch_size=settings.WEBMAIL_MAILER_CLAIM_BATCH_SIZE,
+    scheduler=settings.WEBMAIL_MAILER_SCHEDULER,
+    lease_duration=settings.WEBMAIL_MAILER_LEASE_DURATION,
+    smtp_connection_idle_timeout=settings.WEBMAIL_MAILER_SMTP_CONNECTION_IDLE_TIMEOUT,
+    outcome_flush_size=settings.WEBMAIL_MAILER_OUTCOME_FLUSH_SIZE,
+    outcome_flush_interval=settings.WEBMAIL_MAILER_OUTCOME_FLUSH_INTERVAL,
+    connection_pool=None,
+    stop_event=None):
     """
     Send all eligible messages in the queue.
+
+    Tasks are claimed in batches of `claim_batch_size` with a lease of
+    `lease_duration` seconds, renewed while the batch is being sent. Several
+    processes, even on different machines, can run at the same time: each task
+    is claimed by only one of them.
+
+    `scheduler` chooses the order of the tasks: "fifo", by priority and
+    creation date, or "fair", sharing the delivery between the mailboxes with
+    tasks of the same priority (see `send_scheduler`).
+
+    Tasks of SMTP servers or recipient domains that reached their rate limit
+    (see `SendRateLimiter`) return to the queue until they can be sent, and the
+    run goes on with the next tasks. `throttle_time` is the min seconds between
+    messages through SMTP servers without a configured rate limit.
+
+    Failed tasks are retried with an exponential backoff (see `RetryPolicy`)
+    of at most `defer_duration` hours, unless the error is permanent or they
+    were already deferred `max_times_mail_deferred` times.
+
+    SMTP sessions are kept open and reused between tasks sent through the same
+    SMTP server. If no `connection_pool` is provided, a new one is created and
+    all its sessions are closed at the end of the run.
+
+    The results of the tasks are written in batches of `outcome_flush_size`,
+    or after `outcome_flush_interval` seconds (see `SendOutcomeWriter`).
+
+    If `stop_event` is set while running, the run stops after the task being
+    processed. Returns a `SendMailStats` instance.
     """
 
 
@@ -118,115 +206,213 @@ def send_all(
 
     start_time = time.time()
 
-    num_succeed = 0
-    num_failed = 0
-    num_deferred = 0
+    stats = SendMailStats()
 
-    num_cancelled = 0
+    if connection_pool is None:
+        connection_pool = SmtpConnectionPool(idle_timeout=smtp_connection_idle_timeout)
+        close_connection_pool = True
+    else:
+        close_connection_pool = False
 
-    num_tasks_processed = 0
+    num_requeued = SendMailTask.objects.requeue_expired_leases()
+    if num_requeued:
+        logger.warning("%d email sending tasks with an expired lease returned to the queue", num_requeued)
 
-    lock = None
+    rate_limiter = SendRateLimiter(throttle_time=throttle_time)
+    send_scheduler = get_send_scheduler(scheduler)
+    retry_policy = RetryPolicy(max_delay=defer_duration * 3600, max_times_deferred=max_times_mail_deferred)
+    outcome_writer = SendOutcomeWriter(flush_size=outcome_flush_size, flush_interval=outcome_flush_interval)
 
-    try:
-        for sending_email_context_manager in get_sending_email_context_managers():
-            while True:
-                acquired, lock = acquire_lock(lock_path=lock_path, lock_wait_timeout=lock_wait_timeout)
-                if acquired:
-                    break
-                else:
-                    time.sleep(sleep_time_if_not_acquired_file_lock)
+    lease_token = None
 
-            num_tasks_processed += 1
+    # Leases of the batches already processed whose results are not written
+    # yet. Their tasks are still in progress, the leases are renewed until
+    # the results are flushed.
+    unwritten_lease_tokens = []
 
-            with sending_email_context_manager as send_email_task:
-                if send_email_task is None:
-                    release_lock(lock)
-                    lock = None
+    def is_round_finished():
+        return is_round_finished_for(stats, stop_event,
+            max_processed_tasks_in_batch=max_processed_tasks_in_batch,
+            max_succeed_tasks_in_batch=max_succeed_tasks_in_batch,
+            max_failed_tasks_in_batch=max_failed_tasks_in_batch,
+            max_failed_or_deferred_tasks_in_batch=max_failed_or_deferred_tasks_in_batch)
 
-                    continue
+    try:
+        while not is_round_finished():
+            limit = claim_batch_size
+            if max_processed_tasks_in_batch is not None:
+                limit = min(limit, max_processed_tasks_in_batch - stats.num_tasks_processed)
+
+            with metrics.CLAIM_SECONDS.time():
+                lease_token, send_email_tasks = SendMailTask.objects.claim(limit=limit, lease_duration=lease_duration, scheduler=send_scheduler)
 
-                send_email_task.set_status_in_progress()
+            if not send_email_tasks:
+                break
 
-                release_lock(lock)
-                lock = None
+            lease_renewed_at = time.monotonic()
 
-                logger.info("Running email send task #%d" % send_email_task.id)
+            for num_processed_in_batch, send_email_task in enumerate(send_email_tasks):
+                if num_processed_in_batch and is_round_finished():
+                    break
 
-                if max_times_mail_deferred is not None and send_email_task.num_deferred_times >= max_times_mail_deferred:
-                    notify_failure = True
-                    defer = False
-                else:
-                    notify_failure = False
-                    defer = True
+                # Heartbeat: renew the lease of the rest of the batch, and of
+                # the tasks whose results are not written, before it's close
+                # to expire
+                if time.monotonic() - lease_renewed_at >= lease_duration / 2:
+                    for unwritten_lease_token in unwritten_lease_tokens:
+                        SendMailTask.objects.extend_lease(unwritten_lease_token, lease_duration=lease_duration)
+
+                    SendMailTask.objects.extend_lease(lease_token, lease_duration=lease_duration)
+                    lease_renewed_at = time.monotonic()
 
                 try:
-                    success = send_email_task.send(notify_failure=notify_failure)
+                    smtp_server = send_email_task.get_smtp_server()
                 except NoSmtpServerConfiguredException:
-                    num_cancelled += 1
+                    stats.num_tasks_processed += 1
+                    stats.num_cancelled += 1
+                    metrics.TASKS.inc(outcome="cancelled")
                     send_email_task.set_status_cancelled()
                     continue
 
-                if success:
-                    num_succeed += 1
+                wait_time = rate_limiter.acquire(send_email_task, smtp_server)
+                if wait_time > 0:
+                    send_email_task.postpone(seconds=wait_time)
+                    stats.num_rate_limited += 1
+                    metrics.TASKS.inc(outcome="rate_limited")
+                    continue
 
-                    if delete_completed_tasks:
-                        send_email_task.delete()
-                    else:
-                        send_email_task.set_status_completed()
-                else:
-                    if defer:
-                        send_email_task.defer(hours=defer_duration)
-                        logger.info("Sending email task #%d deferred due to failure", send_email_task.id)
+                stats.num_tasks_processed += 1
 
-                        num_deferred += 1
-                    else:
-                        send_email_task.set_status_failed()
-                        num_failed += 1
+                logger.info("Running email send task #%d" % send_email_task.id)
 
-            # Allow sending a fixed/limited amount of emails in each delivery run
+                # After a partial failure, only the failed recipients
+                recipient_list = send_email_task.get_pending_recipients()
 
-            if max_processed_tasks_in_batch is not None and num_tasks_processed >= max_processed_tasks_in_batch:
-                logger.warning("Max number of email sending tasks processed (%s) reached, stopping for this round", max_processed_tasks_in_batch)
-                break
+                batch = send_email_task.start_batch(recipient_list, outcome_writer=outcome_writer)
 
-            if max_succeed_tasks_in_batch is not None and num_succeed >= max_succeed_tasks_in_batch:
-                logger.info("Max succeed tasks (%s) sending email reached, stopping for this round", max_succeed_tasks_in_batch)
-                break
+                recipients_with_errors = None
+                exception = None
+                retry_delay = None
 
-            if max_failed_tasks_in_batch is not None and num_failed >= max_failed_tasks_in_batch:
-                logger.warning("Max failed tasks (%s) sending email reached, stopping for this round", max_failed_tasks_in_batch)
-                break
+                try:
+                    recipients_with_errors = smtp_server.send_mail(recipient_list, send_email_task.get_mail_payload(), connection_pool=connection_pool)
+                except Exception as e:
+                    exception = e
+                    retry_delay = retry_policy.get_retry_delay(send_email_task, exception)
+
+                success = send_email_task.record_send_result(batch, recipient_list,
+                    recipients_with_errors=recipients_with_errors,
+                    exception=exception,
+                    notify_failure=retry_delay is None,
+                    outcome_writer=outcome_writer)
+
+                finish_task(send_email_task, success, stats,
+                    retry_delay=retry_delay,
+                    delete_completed_tasks=delete_completed_tasks,
+                    outcome_writer=outcome_writer)
+
+                if outcome_writer.flush_if_needed():
+                    unwritten_lease_tokens.clear()
+
+                metrics.flush(force=False)
+
+            else:
+                if len(outcome_writer):
+                    unwritten_lease_tokens.append(lease_token)
+
+                lease_token = None
+                continue
+
+            # Tasks of the batch not processed because the round is finished.
+            # The processed ones are still in progress until their results are
+            # written.
+            outcome_writer.flush()
+            SendMailTask.objects.release_lease(lease_token)
+            lease_token = None
+            break
+    finally:
+        if close_connection_pool:
+            connection_pool.close_all()
 
-            if max_failed_or_deferred_tasks_in_batch is not None and num_failed + num_deferred >= max_failed_or_deferred_tasks_in_batch:
-                logger.warning("Max failed or deferred (%s) reached sending email, stopping for this round", max_failed_or_deferred_tasks_in_batch)
-                break
+        metrics.flush()
 
-            # When delivering, wait some time between emails to avoid server overload
-            # defaults to 0 for no waiting
-            if throttle_time:
-                logger.debug("Throttling email delivery. Sleeping %s seconds", throttle_time)
-                time.sleep(throttle_time)
-    finally:
-        if lock is not None:
-            release_lock(lock)
+        # If writing the results fails, the lease is not released: the tasks
+        # return to the queue when it expires
+        outcome_writer.flush()
 
-    if num_tasks_processed == 0:
+        if lease_token is not None:
+            SendMailTask.objects.release_lease(lease_token)
+
+    stats.elapsed_time = time.time() - start_time
+
+    if stats.num_tasks_processed == 0:
         logger.info("No message in the queue. No mail processed.")
     else:
-        logger.info("Mail sent resume: %d total processed; %s succeed; %d failed: %d deferred; %d cancelled.\nDone in %.2f seconds", num_tasks_processed, num_succeed, num_failed, num_deferred, num_cancelled, (time.time() - start_time))
+        logger.info("Mail sent resume: %s\nDone in %.2f seconds", stats, stats.elapsed_time)
+
+    return stats
 
 
-def send_all_loop(sleep_time_if_queue_empty=settings.WEBMAIL_MAILER_SLEEP_TIME_IF_QUEUE_EMPTY, **kwargs):
+def send_all_loop(sleep_time_if_queue_empty=settings.WEBMAIL_MAILER_SLEEP_TIME_IF_QUEUE_EMPTY, stop_event=None, send_function=None, **kwargs):
     """
-    Loop indefinitely, checking queue at intervals of EMPTY_QUEUE_SLEEP and
-    sending messages if any are on queue.
+    Loop indefinitely sending the messages in the queue.
+
+    When there is nothing to send, the loop sleeps until a new message is queued
+    (see `mail_queue_notify`) or the next deferred task is due, whichever comes
+    first. The queue is checked again at least every `sleep_time_if_queue_empty`
+    seconds, in case the notification could not reach this process.
+
+    PARAM stop_event: optional event used to leave the loop.
+    PARAM send_function: function doing each delivery run, `send_all` by default.
 
-    PARAM queue_empty_sleep_time: when queue is empty, how long to wait (in seconds) before checking again
+    Returns the accumulated `SendMailStats`.
     """
 
-    while True:
-        while not SendMailTask.objects.all():
-            logger.debug("sleeping for %s seconds before checking queue again" % sleep_time)
-            time.sleep(sleep_time_if_queue_empty)
-        send_all(**kwargs)
+    if send_function is None:
+        connection_pool = SmtpConnectionPool(
+            idle_timeout=kwargs.pop("smtp_connection_idle_timeout", settings.WEBMAIL_MAILER_SMTP_CONNECTION_IDLE_TIMEOUT))
+        send_function = functools.partial(send_all, connection_pool=connection_pool)
+    else:
+        # The engine manages its own SMTP sessions
+        connection_pool = None
+
+    stats = SendMailStats()
+
+    def is_stop_requested():
+        return stop_event is not None and stop_event.is_set()
+
+    # Listening starts before checking the queue, so no notification is lost
+    # between the check and the wait
+    with QueueWakeupListener() as wakeup_listener, connection_pool or contextlib.nullcontext():
+        while not is_stop_requested():
+            stats += send_function(stop_event=stop_event, **kwargs)
+
+            next_scheduled_time = SendMailTask.objects.next_scheduled_time()
+            if next_scheduled_time is None:
+                sleep_time = sleep_time_if_queue_empty
+            else:
+                sleep_time = min(sleep_time_if_queue_empty, (next_scheduled_time - timezone.now()).total_seconds())
+
+            if sleep_time <= 0:
+                continue
+
+            # No reason to keep SMTP sessions open while there is nothing to send
+            if connection_pool is not None:
+                connection_pool.close_all()
+
+            logger.debug("Waiting up to %.1f seconds for new messages in the queue" % sleep_time)
+
+            # Wake up periodically to check whether a stop was requested
+            while sleep_time > 0 and not is_stop_requested():
+                if stop_event is None:
+                    wait_time = sleep_time
+                else:
+                    wait_time = min(sleep_time, STOP_CHECK_INTERVAL)
+
+                if wakeup_listener.wait(wait_time):
+                    logger.debug("New messages queued.")
+                    break
+
+                sleep_time -= wait_time
+
+    return stats
@@ -0,0 +1,293 @@
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import time
+
+
+from django import db
+
+
+from .models import SendMailTask, NoSmtpServerConfiguredException
+from .async_smtp_transport import AsyncSmtpConnectionPool
+from .send_rate_limit import SendRateLimiter
+from .send_scheduler import get_send_scheduler
+from .retry_policy import RetryPolicy
+from .send_outcome_writer import SendOutcomeWriter
+from .mail_send_engine import SendMailStats, STOP_CHECK_INTERVAL, is_round_finished_for, finish_task
+from .logutils import get_logger
+from . import settings, metrics
+
+
+logger = get_logger()
+
+
+# Alternative to `mail_send_engine.send_all` for when the latency of the SMTP
+# servers is the bottleneck: many SMTP sessions are in progress at the same
+# time in a single process.
+#
+# The Django ORM is not allowed in the event loop, so all the database queries
+# run in one dedicated thread. They are short compared with an SMTP session,
+# and a single thread uses a single database connection.
+
+
+class _DatabaseExecutor:
+    def __init__(self, thread_name_prefix="sendmail-db"):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=thread_name_prefix)
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def shutdown(self):
+        # The connection belongs to the thread of the executor
+        self._executor.submit(db.connections.close_all).result()
+        self._executor.shutdown()
+
+
+async def send_all_async(
+    max_processed_tasks_in_batch=settings.WEBMAIL_MAILER_MAX_PROCESSED_TASKS_IN_BATCH,
+    max_succeed_tasks_in_batch=settings.WEBMAIL_MAILER_MAX_SUCCEED_TASKS_IN_BATCH,
+    max_failed_tasks_in_batch=settings.WEBMAIL_MAILER_MAX_FAILED_TASKS_IN_BATCH,
+    max_failed_or_deferred_tasks_in_batch=settings.WEBMAIL_MAILER_MAX_FAILED_OR_DEFERRED_TASKS_IN_BATCH,
+    max_times_mail_deferred=settings.WEBMAIL_MAILER_MAX_TIMES_MAIL_DEFERRED,
+    throttle_time=settings.WEBMAIL_MAILER_THROTTLE_TIME,
+    delete_completed_tasks=settings.WEBMAIL_MAILER_DELETE_COMPLETED_TASKS,
+    defer_duration=settings.WEBMAIL_MAILER_DEFER_DURATION,
+    claim_batch_size=settings.WEBMAIL_MAILER_CLAIM_BATCH_SIZE,
+    scheduler=settings.WEBMAIL_MAILER_SCHEDULER,
+    lease_duration=settings.WEBMAIL_MAILER_LEASE_DURATION,
+    smtp_connection_idle_timeout=settings.WEBMAIL_MAILER_SMTP_CONNECTION_IDLE_TIMEOUT,
+    outcome_flush_size=settings.WEBMAIL_MAILER_OUTCOME_FLUSH_SIZE,
+    outcome_flush_interval=settings.WEBMAIL_MAILER_OUTCOME_FLUSH_INTERVAL,
+    max_concurrent_sessions=settings.WEBMAIL_MAILER_ASYNC_MAX_CONCURRENT_SESSIONS,
+    max_sessions_per_smtp_server=settings.WEBMAIL_MAILER_ASYNC_MAX_SESSIONS_PER_SMTP_SERVER,
+    stop_event=None):
+    """
+    Send all eligible messages in the queue, up to `max_concurrent_sessions`
+    at the same time and at most `max_sessions_per_smtp_server` through the
+    same SMTP server.
+
+    Tasks go through the same status transitions and delivery bookkeeping as
+    in `send_all`. The limits of the run are checked before starting each
+    task, so the tasks already in progress when one is reached are finished.
+
+    Rate limited tasks return to the queue like in `send_all`. Returns a
+    `SendMailStats` instance.
+    """
+
+    logger.debug("Started processing tasks.")
+
+    start_time = time.time()
+
+    stats = SendMailStats()
+
+    database = _DatabaseExecutor()
+    connection_pool = AsyncSmtpConnectionPool(idle_timeout=smtp_connection_idle_timeout)
+
+    rate_limiter = SendRateLimiter(throttle_time=throttle_time)
+    send_scheduler = get_send_scheduler(scheduler)
+    retry_policy = RetryPolicy(max_delay=defer_duration * 3600, max_times_deferred=max_times_mail_deferred)
+
+    # Only used in the thread of `database`
+    outcome_writer = SendOutcomeWriter(flush_size=outcome_flush_size, flush_interval=outcome_flush_interval)
+
+    sessions_semaphore = asyncio.Semaphore(max_concurrent_sessions)
+    smtp_server_semaphores = collections.defaultdict(lambda: asyncio.Semaphore(max_sessions_per_smtp_server))
+
+    # Number of tasks not finished yet of each lease
+    active_leases = collections.Counter()
+
+    # Leases whose tasks are all finished, but their results are not written
+    # yet. The tasks are still in progress until they are.
+    unwritten_leases = set()
+
+    # Leases with tasks not processed because the round finished first
+    unfinished_leases = set()
+
+    num_claimed = 0
+    round_finished = False
+
+    def is_round_finished():
+        nonlocal round_finished
+
+        if not round_finished:
+            round_finished = is_round_finished_for(stats, stop_event,
+                max_processed_tasks_in_batch=max_processed_tasks_in_batch,
+                max_succeed_tasks_in_batch=max_succeed_tasks_in_batch,
+                max_failed_tasks_in_batch=max_failed_tasks_in_batch,
+                max_failed_or_deferred_tasks_in_batch=max_failed_or_deferred_tasks_in_batch)
+
+        return round_finished
+
+    async def renew_leases():
+        # Heartbeat: renew the leases before they are close to expire
+        while True:
+            await asyncio.sleep(lease_duration / 2)
+
+            for lease_token in set(active_leases).union(unwritten_leases):
+                await database.run(SendMailTask.objects.extend_lease, lease_token, lease_duration=lease_duration)
+
+    async def process_task(send_email_task):
+        """
+        Returns False if the task was not processed.
+        """
+        try:
+            smtp_server = await database.run(send_email_task.get_smtp_server)
+        except NoSmtpServerConfiguredException:
+            stats.num_tasks_processed += 1
+            stats.num_cancelled += 1
+            metrics.TASKS.inc(outcome="cancelled")
+            await database.run(send_email_task.set_status_cancelled)
+            return True
+
+        async with smtp_server_semaphores[smtp_server.pk], sessions_semaphore:
+            if is_round_finished():
+                return False
+
+            # Checked once the session is available, otherwise the tokens
+            # would be spent while waiting
+            wait_time = await database.run(rate_limiter.acquire, send_email_task, smtp_server)
+            if wait_time > 0:
+                await database.run(send_email_task.postpone, seconds=wait_time)
+                stats.num_rate_limited += 1
+                metrics.TASKS.inc(outcome="rate_limited")
+                return True
+
+            stats.num_tasks_processed += 1
+
+            logger.info("Running email send task #%d" % send_email_task.id)
+
+            # After a partial failure, only the failed recipients
+            recipient_list = await database.run(send_email_task.get_pending_recipients)
+
+            batch = await database.run(send_email_task.start_batch, recipient_list, outcome_writer=outcome_writer)
+
+            recipients_with_errors = None
+            exception = None
+            retry_delay = None
+
+            try:
+                # Not spooled payloads are loaded from the database
+                multipart_mail_message = await database.run(send_email_task.get_mail_payload)
+
+                recipients_with_errors = await connection_pool.send_mail(smtp_server, smtp_server.get_sender_email(), recipient_list, multipart_mail_message)
+            except Exception as e:
+                exception = e
+                retry_delay = retry_policy.get_retry_delay(send_email_task, exception)
+
+            success = await database.run(send_email_task.record_send_result, batch, recipient_list,
+                recipients_with_errors=recipients_with_errors,
+                exception=exception,
+                notify_failure=retry_delay is None,
+                outcome_writer=outcome_writer)
+
+            await database.run(finish_task, send_email_task, success, stats,
+                retry_delay=retry_delay,
+                delete_completed_tasks=delete_completed_tasks,
+                outcome_writer=outcome_writer)
+
+        return True
+
+    async def run_task(send_email_task, lease_token):
+        try:
+            if not await process_task(send_email_task):
+                unfinished_leases.add(lease_token)
+        except Exception:
+            logger.exception("Unexpected error processing email send task #%d", send_email_task.id)
+            unfinished_leases.add(lease_token)
+        finally:
+            active_leases[lease_token] -= 1
+            if active_leases[lease_token] == 0:
+                del active_leases[lease_token]
+                unwritten_leases.add(lease_token)
+
+    heartbeat = asyncio.create_task(renew_leases())
+
+    in_flight = set()
+
+    try:
+        num_requeued = await database.run(SendMailTask.objects.requeue_expired_leases)
+        if num_requeued:
+            logger.warning("%d email sending tasks with an expired lease returned to the queue", num_requeued)
+
+        queue_empty = False
+
+        while True:
+            # Keep the sessions busy: claim new tasks as soon as there are
+            # free slots
+            if not is_round_finished() and not queue_empty and len(in_flight) < max_concurrent_sessions:
+                limit = min(claim_batch_size, max_concurrent_sessions - len(in_flight))
+                if max_processed_tasks_in_batch is not None:
+                    limit = min(limit, max_processed_tasks_in_batch - num_claimed)
+
+                if limit > 0:
+                    with metrics.CLAIM_SECONDS.time():
+                        lease_token, send_email_tasks = await database.run(SendMailTask.objects.claim, limit=limit, lease_duration=lease_duration, scheduler=send_scheduler)
+
+                    if send_email_tasks:
+                        num_claimed += len(send_email_tasks)
+                        active_leases[lease_token] += len(send_email_tasks)
+
+                        for send_email_task in send_email_tasks:
+                            in_flight.add(asyncio.create_task(run_task(send_email_task, lease_token)))
+
+                        continue
+                    else:
+                        queue_empty = True
+
+            if not in_flight:
+                break
+
+            done, in_flight = await asyncio.wait(in_flight, timeout=STOP_CHECK_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+
+            # The results of the tasks of these leases were added before
+            flushed_leases = set(unwritten_leases)
+            if await database.run(outcome_writer.flush_if_needed):
+                unwritten_leases.difference_update(flushed_leases)
+
+            metrics.flush(force=False)
+
+            if done:
+                # The tasks just finished could have queued new tasks
+                queue_empty = False
+    finally:
+        heartbeat.cancel()
+
+        for in_flight_task in in_flight:
+            in_flight_task.cancel()
+
+        await asyncio.gather(heartbeat, *in_flight, return_exceptions=True)
+
+        await connection_pool.close_all()
+
+        metrics.flush()
+
+        try:
+            # The processed tasks are in progress until their results are
+            # written. If it fails, the leases are not released and the tasks
+            # return to the queue when they expire.
+            await database.run(outcome_writer.flush)
+
+            # Tasks claimed but not processed
+            for lease_token in unfinished_leases.union(active_leases):
+                await database.run(SendMailTask.objects.release_lease, lease_token)
+        finally:
+            database.shutdown()
+
+    stats.elapsed_time = time.time() - start_time
+
+    if stats.num_tasks_processed == 0:
+        logger.info("No message in the queue. No mail processed.")
+    else:
+        logger.info("Mail sent resume: %s\nDone in %.2f seconds", stats, stats.elapsed_time)
+
+    return stats
+
+
+def send_all_asyncio(**kwargs):
+    """
+    Runs `send_all_async` in a new event loop. Same interface than
+    `mail_send_engine.send_all`.
+    """
+    return asyncio.run(send_all_async(**kwargs))
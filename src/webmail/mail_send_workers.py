@@ -0,0 +1,119 @@
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+
+from django import db
+
+
+from .mail_send_engine import SendMailStats, send_all, send_all_loop
+from .logutils import get_logger
+
+
+logger = get_logger()
+
+
+def _worker_main(worker_num, forever, send_function, stop_event, results_queue, send_kwargs):
+    # Ask the running task to finish and stop gracefully. The supervisor
+    # sets the same event, so a Ctrl+C on the terminal (sent to the whole
+    # process group) is handled the same way.
+    def request_stop(signum, frame):
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    logger.info("Worker #%d started.", worker_num)
+
+    stats = SendMailStats()
+
+    try:
+        if forever:
+            stats = send_all_loop(stop_event=stop_event, send_function=send_function, **send_kwargs)
+        else:
+            stats = (send_function or send_all)(stop_event=stop_event, **send_kwargs)
+    except Exception:
+        logger.exception("Worker #%d terminated with an unexpected error.", worker_num)
+    finally:
+        db.connections.close_all()
+
+        results_queue.put((worker_num, os.getpid(), stats))
+
+
+def send_all_multiprocess(processes, forever=False, send_function=None, **kwargs):
+    """
+    Forks `processes` workers, each one claiming and sending tasks of the queue
+    independently, and waits for all of them.
+
+    SIGTERM or SIGINT received by the supervisor makes the workers stop after the
+    task they are sending. Each worker does its delivery runs with
+    `send_function`, `send_all` by default. The keyword arguments are passed to
+    it or to `send_all_loop` if `forever` is True.
+    """
+    start_time = time.time()
+
+    mp_context = multiprocessing.get_context("fork")
+
+    stop_event = mp_context.Event()
+    results_queue = mp_context.Queue()
+
+    # Every worker has to open its own database connection.
+    db.connections.close_all()
+
+    def request_stop(signum, frame):
+        logger.info("Signal %d received. Waiting for workers to finish their current task.", signum)
+        stop_event.set()
+
+    # Installed before forking, so a signal received while the workers are
+    # started doesn't kill the supervisor and leave them orphaned. The
+    # workers started after it see the stop event already set.
+    previous_handlers = {
+        signum: signal.signal(signum, request_stop) for signum in (signal.SIGTERM, signal.SIGINT)
+    }
+
+    workers = []
+    workers_stats = {}
+
+    try:
+        for worker_num in range(1, processes + 1):
+            worker = mp_context.Process(
+                target=_worker_main,
+                name="sendmail-worker-%d" % worker_num,
+                args=(worker_num, forever, send_function, stop_event, results_queue, kwargs))
+            worker.start()
+
+            workers.append(worker)
+
+        while len(workers_stats) < len(workers):
+            try:
+                worker_num, pid, worker_stats = results_queue.get(timeout=1)
+            except queue.Empty:
+                # Workers killed without the chance of reporting their stats
+                if not any(worker.is_alive() for worker in workers) and results_queue.empty():
+                    break
+            else:
+                workers_stats[worker_num] = (pid, worker_stats)
+
+        for worker in workers:
+            worker.join()
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+
+    stats = SendMailStats()
+    for pid, worker_stats in workers_stats.values():
+        stats += worker_stats
+
+    # Workers run at the same time
+    stats.elapsed_time = time.time() - start_time
+
+    workers_resume = "\n".join(
+        "  Worker #%d (PID %d): %s Done in %.2f seconds" % (worker_num, pid, worker_stats, worker_stats.elapsed_time)
+        for worker_num, (pid, worker_stats) in sorted(workers_stats.items())
+    )
+
+    logger.info("Mail sent resume: %s\n%s\nDone in %.2f seconds with %d processes", stats, workers_resume, stats.elapsed_time, processes)
+
+    return stats
@@ -0,0 +1,249 @@
+import contextlib
+import gzip
+import hashlib
+import os
+import tempfile
+import time
+from email.parser import BytesHeaderParser
+
+
+from . import settings
+from .logutils import get_logger
+
+
+logger = get_logger()
+
+
+# The MIME payloads of the outgoing messages are stored in the spool directory
+# instead of in the rows of the queue. Files are named by the SHA-256 of the
+# uncompressed payload, and distributed in subdirectories by its first
+# characters. A reference is the name of the file: "<sha256>.eml" or
+# "<sha256>.eml.gz" if compressed.
+
+
+UNCOMPRESSED_SUFFIX = ".eml"
+COMPRESSED_SUFFIX = ".eml.gz"
+
+class InvalidSpoolReference(ValueError):
+    pass
+
+
+class SpooledMailMessage:
+    """
+    Payload of a message stored in the spool. It's passed instead of the bytes
+    of the message to the SMTP transports, which read it in chunks while
+    sending it.
+    """
+
+    def __init__(self, spool, ref, size):
+        self.spool = spool
+        self.ref = ref
+        self.size = size
+
+    def open(self):
+        return self.spool.open(self.ref)
+
+    def read(self):
+        with self.open() as f:
+            return f.read()
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return "<SpooledMailMessage %s (%d bytes)>" % (self.ref, self.size)
+
+
+class SpoolWriter:
+    """
+    File-like object returned by `MailSpool.create`. The payload is written to
+    a temporary file in the spool, and moved to its final path by `commit`.
+    """
+
+    def __init__(self, spool, compress):
+        self.spool = spool
+        self.compress = compress
+
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+        os.makedirs(spool.directory, exist_ok=True)
+
+        fd, self._temp_path = tempfile.mkstemp(dir=spool.directory, prefix=".tmp-")
+        self._raw_file = os.fdopen(fd, "wb")
+
+        if compress:
+            self._file = gzip.GzipFile(fileobj=self._raw_file, mode="wb", compresslevel=settings.WEBMAIL_MAILER_SPOOL_COMPRESS_LEVEL, mtime=0)
+        else:
+            self._file = self._raw_file
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def _close(self):
+        if self._file is not self._raw_file:
+            self._file.close()
+        self._raw_file.close()
+
+    def commit(self):
+        """
+        Returns the reference of the stored payload and its size.
+        """
+        self._close()
+
+        ref = self._hash.hexdigest() + (COMPRESSED_SUFFIX if self.compress else UNCOMPRESSED_SUFFIX)
+        path = self.spool.get_path(ref)
+
+        # The same content can be already stored. Replacing it is harmless and
+        # atomic. The subdirectory could be removed by `MailSpool.delete` in
+        # the meantime if it was empty.
+        for attempt in range(3):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            try:
+                os.replace(self._temp_path, path)
+                break
+            except FileNotFoundError:
+                if attempt == 2 or not os.path.exists(self._temp_path):
+                    raise
+
+        return ref, self.size
+
+    def abort(self):
+        self._close()
+
+        try:
+            os.remove(self._temp_path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+
+
+class MailSpool:
+    def __init__(self, directory=None, compress=None):
+        if directory is None:
+            directory = settings.WEBMAIL_MAILER_SPOOL_DIR
+
+        if compress is None:
+            compress = settings.WEBMAIL_MAILER_SPOOL_COMPRESS
+
+        self.directory = directory
+        self.compress = compress
+
+    @property
+    def is_enabled(self):
+        return self.directory is not None
+
+    def get_path(self, ref):
+        if not (ref.endswith(UNCOMPRESSED_SUFFIX) or ref.endswith(COMPRESSED_SUFFIX)) or os.sep in ref or (os.altsep and os.altsep in ref) or ref.startswith("."):
+            raise InvalidSpoolReference(ref)
+
+        return os.path.join(self.directory, ref[:2], ref[2:4], ref)
+
+    def create(self):
+        """
+        Returns a `SpoolWriter` to store a new payload writing it in chunks.
+        """
+        return SpoolWriter(self, self.compress)
+
+    def store(self, data):
+        """
+        Stores the payload `data` and returns its reference and size.
+        """
+        with self.create() as writer:
+            writer.write(data)
+            return writer.commit()
+
+    def open(self, ref):
+        """
+        Returns a binary file with the uncompressed payload.
+        """
+        path = self.get_path(ref)
+
+        if ref.endswith(COMPRESSED_SUFFIX):
+            return gzip.open(path, "rb")
+        else:
+            return open(path, "rb")
+
+    def get_message(self, ref, size):
+        return SpooledMailMessage(self, ref, size)
+
+    def iter_refs(self, min_age=0):
+        """
+        Yields the references of the payloads in the spool modified more than
+        `min_age` seconds ago.
+        """
+        if not os.path.isdir(self.directory):
+            return
+
+        max_mtime = time.time() - min_age
+
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.startswith(".") or not (filename.endswith(UNCOMPRESSED_SUFFIX) or filename.endswith(COMPRESSED_SUFFIX)):
+                    continue
+
+                try:
+                    mtime = os.path.getmtime(os.path.join(dirpath, filename))
+                except FileNotFoundError:
+                    continue
+
+                if mtime <= max_mtime:
+                    yield filename
+
+    def exists(self, ref):
+        return os.path.exists(self.get_path(ref))
+
+    def delete(self, ref):
+        path = self.get_path(ref)
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return
+
+        logger.debug("Payload %s removed from the spool", ref)
+
+        # Remove the subdirectories left empty
+        for directory in (os.path.dirname(path), os.path.dirname(os.path.dirname(path))):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+
+
+def iter_payload_lines(multipart_mail_message):
+    """
+    Yields the lines of a payload, either bytes or a `SpooledMailMessage`, read
+    in chunks from the spool.
+    """
+    if isinstance(multipart_mail_message, SpooledMailMessage):
+        with multipart_mail_message.open() as f:
+            for line in f:
+                yield line
+    else:
+        yield from bytes(multipart_mail_message).splitlines(keepends=True)
+
+
+def read_payload_headers(multipart_mail_message):
+    """
+    Parses only the headers of a payload, without reading the body.
+    """
+    header_lines = []
+
+    with contextlib.closing(iter_payload_lines(multipart_mail_message)) as lines:
+        for line in lines:
+            if line in (b"\r\n", b"\n"):
+                break
+
+            header_lines.append(line)
+
+    return BytesHeaderParser().parsebytes(b"".join(header_lines))
@@ -0,0 +1,163 @@
+import json
+
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, teardown_databases
+
+
+from webmail.mail_send_benchmark import run_send_benchmark
+from webmail.logutils import get_logger
+from webmail import settings, metrics
+
+
+class Command(BaseCommand):
+    help = "Measure the throughput of the delivery of the queue, sending messages to a local SMTP server. Runs in a test database."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-n', '--tasks',
+            type=int,
+            default=1000,
+            help='Number of messages queued',
+        )
+        parser.add_argument(
+            '--engine',
+            choices=["sync", "asyncio"],
+            default=settings.WEBMAIL_MAILER_ENGINE
+        )
+        parser.add_argument(
+            '--loop',
+            action="store_true",
+            default=False,
+            help='Send with the loop of "sendmail --forever" instead of a single run',
+        )
+        parser.add_argument(
+            '--mailboxes',
+            type=int,
+            default=1,
+            help='Number of mailboxes sending the messages, each one with its SMTP server configuration',
+        )
+        parser.add_argument(
+            '--message-size',
+            type=int,
+            default=2000,
+            help='Characters of the body of each message',
+        )
+        parser.add_argument(
+            '--recipients',
+            type=int,
+            default=1,
+            help='Number of recipients of each message',
+        )
+        parser.add_argument(
+            '--attachment-size',
+            type=int,
+            default=0,
+            help='Bytes of the attachment of each message. No attachment if 0',
+        )
+        parser.add_argument(
+            '--latency',
+            type=float,
+            default=0,
+            help='Seconds the SMTP server takes to accept each message',
+        )
+        parser.add_argument(
+            '--defer-rate',
+            type=float,
+            default=0,
+            help='Fraction of messages answered with a 4xx reply',
+        )
+        parser.add_argument(
+            '--disconnect-rate',
+            type=float,
+            default=0,
+            help='Fraction of messages where the SMTP server closes the connection instead of replying',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            help='Seed of the random choice of the deferred and disconnected messages',
+        )
+        parser.add_argument(
+            '--claim-batch-size',
+            type=int,
+            default=settings.WEBMAIL_MAILER_CLAIM_BATCH_SIZE
+        )
+        parser.add_argument(
+            '--outcome-flush-size',
+            type=int,
+            default=settings.WEBMAIL_MAILER_OUTCOME_FLUSH_SIZE,
+            help='Delivery attempts whose results are written to the database together',
+        )
+        parser.add_argument(
+            '--scheduler',
+            choices=["fifo", "fair"],
+            default=settings.WEBMAIL_MAILER_SCHEDULER
+        )
+        parser.add_argument(
+            '--max-concurrent-sessions',
+            type=int,
+            default=settings.WEBMAIL_MAILER_ASYNC_MAX_CONCURRENT_SESSIONS
+        )
+        parser.add_argument(
+            '--max-sessions-per-smtp-server',
+            type=int,
+            default=settings.WEBMAIL_MAILER_ASYNC_MAX_SESSIONS_PER_SMTP_SERVER
+        )
+        parser.add_argument(
+            '--json',
+            action="store_true",
+            default=False,
+            help='Print the results as JSON, to compare them between versions',
+        )
+        parser.add_argument(
+            '-l', '--log-level',
+            choices=["info", "debug", "warning", "error"],
+            default="error"
+        )
+
+    def handle(self, *args, **options):
+        get_logger().setLevel(options["log_level"].upper())
+
+        if options["tasks"] < 1 or options["mailboxes"] < 1 or options["recipients"] < 1:
+            raise CommandError("The number of tasks, mailboxes and recipients must be at least 1")
+
+        if not 0 <= options["defer_rate"] + options["disconnect_rate"] <= 1:
+            raise CommandError("The sum of the defer and disconnect rates must be between 0 and 1")
+
+        send_kwargs = dict(
+            claim_batch_size=options["claim_batch_size"],
+            outcome_flush_size=options["outcome_flush_size"],
+            scheduler=options["scheduler"],
+            throttle_time=0)
+
+        if options["engine"] == "asyncio":
+            send_kwargs["max_concurrent_sessions"] = options["max_concurrent_sessions"]
+            send_kwargs["max_sessions_per_smtp_server"] = options["max_sessions_per_smtp_server"]
+
+        # The metrics of the sending processes are not affected
+        metrics.set_metrics_dir(None)
+
+        old_config = setup_databases(verbosity=0, interactive=False)
+
+        try:
+            result = run_send_benchmark(
+                num_tasks=options["tasks"],
+                engine=options["engine"],
+                loop=options["loop"],
+                num_mailboxes=options["mailboxes"],
+                message_size=options["message_size"],
+                num_recipients=options["recipients"],
+                attachment_size=options["attachment_size"],
+                latency=options["latency"],
+                defer_rate=options["defer_rate"],
+                disconnect_rate=options["disconnect_rate"],
+                seed=options["seed"],
+                **send_kwargs)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(result.to_dict(), indent=2))
+        else:
+            self.stdout.write(str(result))
@@ -1,8 +1,14 @@
-from django.core.management.base import BaseCommand
+import signal
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
 
 from webmail.models import Pop3MailServer
+from webmail.mail_fetch import fetch_all, fetch_forever
+from webmail.mail_parse import MessageParserPool
 from webmail.logutils import get_logger
-from webmail.exceptions import InvalidEmailMessageException
+from webmail import settings
 
 
 class Command(BaseCommand):
@@ -15,6 +21,48 @@ class Command(BaseCommand):
             help = "List of mailbox Id's or username:mailbox_name items. If no mailbox specified, all active pop3 mail servers will be selected"
         )
 
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            help='Number of POP3 mail servers fetched at the same time',
+            default=settings.WEBMAIL_FETCH_CONCURRENCY
+        )
+
+        parser.add_argument(
+            '--timeout',
+            type=float,
+            help='Seconds without an answer of a POP3 mail server before giving up with it',
+            default=settings.WEBMAIL_POP3_TIMEOUT
+        )
+
+        parser.add_argument(
+            '--max-message-size',
+            type=int,
+            help='Messages larger than this number of bytes are fetched apart, after the rest of messages of the server',
+            default=settings.WEBMAIL_POP3_MAX_MESSAGE_SIZE
+        )
+
+        parser.add_argument(
+            '--large-message-concurrency',
+            type=int,
+            help='Number of POP3 mail servers whose large messages are fetched at the same time',
+            default=1
+        )
+
+        parser.add_argument(
+            '--parse-processes',
+            type=int,
+            help='Number of worker processes parsing the fetched messages. With 0 they are parsed by the fetch threads',
+            default=settings.WEBMAIL_PARSE_PROCESSES
+        )
+
+        parser.add_argument(
+            '--forever',
+            action="store_true",
+            default=False,
+            help='Poll the POP3 mail servers forever, more often the ones receiving more messages (SIGTERM or Control+C to terminate)',
+        )
+
         parser.add_argument(
             '-l', '--log-level',
             choices=["info", "debug", "warning", "error"],
@@ -24,7 +72,7 @@ class Command(BaseCommand):
     def handle(self, **options):
         mailbox_names_or_ids = options["mailbox_names_or_ids"]
         if len(mailbox_names_or_ids) == 0:
-            pop3_mail_servers = Pop3MailServer.objects.filter(active=True)
+            pop3_mail_servers = Pop3MailServer.objects.filter(active=True).select_related("mailbox__user")
         else:
             pop3_mail_servers = []
 
@@ -56,26 +104,66 @@ class Command(BaseCommand):
             self.stderr.write("Nothing to do")
             return
 
+        if options["concurrency"] < 1 or options["large_message_concurrency"] < 1:
+            raise CommandError("The concurrency must be at least 1")
+
+        if options["parse_processes"] < 0:
+            raise CommandError("The number of parse processes can't be negative")
+
+        fetch_kwargs = dict(
+            concurrency=options["concurrency"],
+            timeout=options["timeout"],
+            max_message_size=options["max_message_size"],
+            large_message_concurrency=options["large_message_concurrency"])
+
         logger = get_logger(options['log_level'].upper())
 
-        for pop3_mail_server in pop3_mail_servers:
-            mailbox = pop3_mail_server.mailbox
+        if options["parse_processes"] > 0:
+            # Started before the fetch threads
+            with MessageParserPool(options["parse_processes"]) as parser_pool:
+                self.fetch(pop3_mail_servers, options["forever"], parser_pool=parser_pool, **fetch_kwargs)
+        else:
+            self.fetch(pop3_mail_servers, options["forever"], **fetch_kwargs)
 
-            logger.info(
-                'Gathering messages for user "%s" from mailbox "%s"',
-                mailbox.user.username,
-                mailbox.name
-            )
+    def fetch(self, pop3_mail_servers, forever=False, **fetch_kwargs):
+        logger = get_logger()
 
-            try:
-                for msg_record in pop3_mail_server.get_new_mail():
-                    if isinstance(msg_record, InvalidEmailMessageException):
-                        logger.warn("Invalid email: %s" % str(msg_record))
-                    else:
-                        logger.info(
-                            'Received %s (from %s)',
-                            msg_record.subject,
-                            msg_record.from_email
-                        )
-            except OSError as exc:
-                self.stderr.write("OS Error %s: %s" % exc.args)
+        if forever:
+            self.fetch_forever(pop3_mail_servers, **fetch_kwargs)
+            return
+
+        start_time = time.monotonic()
+
+        results = fetch_all(pop3_mail_servers, **fetch_kwargs)
+
+        for result in results:
+            if result.error is not None:
+                self.stderr.write("Error fetching %s: %s" % (result.name, result.error))
+
+        logger.info(
+            "Fetch resume:\n%s\nDone in %.2f seconds: %d messages; %d bytes; %d servers with errors",
+            "\n".join("  %s" % result for result in results),
+            time.monotonic() - start_time,
+            sum(result.num_messages for result in results),
+            sum(result.num_bytes for result in results),
+            sum(1 for result in results if result.error is not None)
+        )
+
+    def fetch_forever(self, pop3_mail_servers, **fetch_kwargs):
+        logger = get_logger()
+
+        if isinstance(pop3_mail_servers, list):
+            # The selected servers, reloaded to know their current state
+            server_ids = [pop3_mail_server.id for pop3_mail_server in pop3_mail_servers]
+            pop3_mail_servers = Pop3MailServer.objects.filter(id__in=server_ids).select_related("mailbox__user")
+
+        stop_event = threading.Event()
+
+        def request_stop(signum, frame):
+            logger.info("Signal %d received. Waiting for the fetches in progress.", signum)
+            stop_event.set()
+
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+
+        fetch_forever(pop3_mail_servers.all, stop_event=stop_event, **fetch_kwargs)
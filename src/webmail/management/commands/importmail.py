@@ -0,0 +1,174 @@
+import json
+import os
+import signal
+import time
+
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+from webmail.models import Mailbox, Message
+from webmail.mail_import import MBOX_FORMAT, MAILDIR_FORMAT, ImportResult, detect_format, iter_mail_source, import_messages
+from webmail.mail_parse import MessageParserPool
+from webmail.logutils import get_logger
+from webmail import settings
+
+
+logger = get_logger()
+
+
+# Seconds between progress messages
+PROGRESS_LOG_INTERVAL = 10
+
+
+class Command(BaseCommand):
+    help = "Import the messages of an mbox file or a Maildir directory into a mailbox"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'username',
+            help="Username"
+        )
+        parser.add_argument(
+            'mailbox_name',
+            help="The name of the mailbox that will receive the messages"
+        )
+        parser.add_argument(
+            'path',
+            help="mbox file or Maildir directory"
+        )
+
+        parser.add_argument(
+            '--format',
+            choices=[MBOX_FORMAT, MAILDIR_FORMAT],
+            default=None,
+            help="Format of the messages. By default, Maildir for a directory and mbox for a file"
+        )
+
+        parser.add_argument(
+            '--folder',
+            choices=Message.FOLDER_NAMES,
+            default="inbox",
+            help="Folder of the imported messages"
+        )
+
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=200,
+            help="Number of messages saved in each transaction"
+        )
+
+        parser.add_argument(
+            '--parse-processes',
+            type=int,
+            default=settings.WEBMAIL_PARSE_PROCESSES,
+            help="Number of worker processes parsing the messages. With 0 they are parsed by the command process"
+        )
+
+        parser.add_argument(
+            '--checkpoint',
+            default=None,
+            help="File where the progress is saved after each batch. If it exists, the import is resumed from it"
+        )
+
+    def handle(self, username, mailbox_name, path, **options):
+        try:
+            mailbox = Mailbox.objects.get(user__username=username, name=mailbox_name)
+        except Mailbox.DoesNotExist:
+            raise CommandError("Mailbox does not exist")
+
+        if not os.path.exists(path):
+            raise CommandError("No such file or directory: %s" % path)
+
+        if options["batch_size"] < 1:
+            raise CommandError("The batch size must be at least 1")
+
+        if options["parse_processes"] < 0:
+            raise CommandError("The number of parse processes can't be negative")
+
+        format = options["format"] or detect_format(path)
+        path = os.path.abspath(path)
+
+        checkpoint_path = options["checkpoint"]
+        result = self.load_checkpoint(checkpoint_path, path, format, mailbox)
+
+        if result.position is not None:
+            logger.info("Resuming the import after %d messages, at position %s", result.num_read, result.position)
+
+        messages = iter_mail_source(path, format=format, position=result.position)
+
+        last_log_time = time.monotonic()
+
+        def batch_saved(result):
+            nonlocal last_log_time
+
+            if checkpoint_path is not None:
+                self.save_checkpoint(checkpoint_path, path, format, mailbox, result)
+
+            now = time.monotonic()
+            if now - last_log_time >= PROGRESS_LOG_INTERVAL:
+                last_log_time = now
+                logger.info("%s so far", result)
+
+        import_kwargs = dict(
+            folder_id=Message.FOLDER_ID_BY_NAME[options["folder"]],
+            batch_size=options["batch_size"],
+            result=result,
+            batch_callback=batch_saved)
+
+        # The batch in progress is rolled back, and resumed from the checkpoint
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+        try:
+            if options["parse_processes"] > 0:
+                with MessageParserPool(options["parse_processes"]) as parser_pool:
+                    import_messages(mailbox, messages, parser_pool=parser_pool, **import_kwargs)
+            else:
+                import_messages(mailbox, messages, **import_kwargs)
+        except KeyboardInterrupt:
+            logger.info("Import interrupted: %s", result)
+            if checkpoint_path is not None:
+                logger.info("Run the command again with the same checkpoint to resume it")
+            raise CommandError("Import interrupted")
+
+        logger.info("Import done: %s", result)
+
+    def load_checkpoint(self, checkpoint_path, path, format, mailbox):
+        if checkpoint_path is None or not os.path.exists(checkpoint_path):
+            return ImportResult()
+
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+
+        if checkpoint["path"] != path or checkpoint["format"] != format or checkpoint["mailbox_id"] != mailbox.id:
+            raise CommandError("The checkpoint %s is of the import of %s into another mailbox" % (checkpoint_path, checkpoint["path"]))
+
+        result = ImportResult(position=checkpoint["position"])
+        result.num_messages = checkpoint["num_messages"]
+        result.num_duplicates = checkpoint["num_duplicates"]
+        result.num_invalid = checkpoint["num_invalid"]
+        result.num_bytes = checkpoint["num_bytes"]
+        result.elapsed_time = checkpoint["elapsed_time"]
+
+        return result
+
+    def save_checkpoint(self, checkpoint_path, path, format, mailbox, result):
+        checkpoint = {
+            "path": path,
+            "format": format,
+            "mailbox_id": mailbox.id,
+            "position": result.position,
+            "num_messages": result.num_messages,
+            "num_duplicates": result.num_duplicates,
+            "num_invalid": result.num_invalid,
+            "num_bytes": result.num_bytes,
+            "elapsed_time": result.elapsed_time,
+        }
+
+        # Replaced at once, an interrupted write doesn't lose the checkpoint
+        temp_path = checkpoint_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(checkpoint, f)
+
+        os.replace(temp_path, checkpoint_path)
@@ -0,0 +1,99 @@
+import asyncio
+import signal
+
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+from webmail.lmtp_server import LmtpServer
+from webmail.logutils import get_logger
+from webmail import settings
+
+
+class Command(BaseCommand):
+    help = "Receive the mail delivered by the MTA over LMTP (SIGTERM or Control+C to terminate)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--host',
+            default=settings.WEBMAIL_LMTP_HOST,
+            help='Address of the TCP socket'
+        )
+
+        parser.add_argument(
+            '--port',
+            type=int,
+            default=settings.WEBMAIL_LMTP_PORT,
+            help='Port of the TCP socket'
+        )
+
+        parser.add_argument(
+            '--unix-socket',
+            default=settings.WEBMAIL_LMTP_UNIX_SOCKET,
+            help='Path of a Unix socket to listen on, instead of the TCP socket'
+        )
+
+        parser.add_argument(
+            '--socket-mode',
+            default="660",
+            help='Permissions of the Unix socket, in octal. The MTA must be able to write to it'
+        )
+
+        parser.add_argument(
+            '--hostname',
+            default=None,
+            help='Hostname of the greeting. By default, the fully qualified name of the host'
+        )
+
+        parser.add_argument(
+            '--max-message-size',
+            type=int,
+            default=settings.WEBMAIL_LMTP_MAX_MESSAGE_SIZE,
+            help='Messages larger than this number of bytes are rejected'
+        )
+
+        parser.add_argument(
+            '--timeout',
+            type=float,
+            default=settings.WEBMAIL_LMTP_TIMEOUT,
+            help='Seconds waiting for a command or data from the MTA before closing the connection'
+        )
+
+        parser.add_argument(
+            '-l', '--log-level',
+            choices=["info", "debug", "warning", "error"],
+            default="info"
+        )
+
+    def handle(self, **options):
+        try:
+            socket_mode = int(options["socket_mode"], 8)
+        except ValueError:
+            raise CommandError("Invalid socket mode: %s" % options["socket_mode"])
+
+        logger = get_logger(options['log_level'].upper())
+
+        lmtp_server = LmtpServer(
+            hostname=options["hostname"],
+            max_message_size=options["max_message_size"],
+            timeout=options["timeout"])
+
+        async def serve():
+            stop_event = asyncio.Event()
+
+            def request_stop(signum):
+                logger.info("Signal %d received. Waiting for the deliveries in progress.", signum)
+                stop_event.set()
+
+            loop = asyncio.get_running_loop()
+            loop.add_signal_handler(signal.SIGTERM, request_stop, signal.SIGTERM)
+            loop.add_signal_handler(signal.SIGINT, request_stop, signal.SIGINT)
+
+            await lmtp_server.serve(
+                host=options["host"],
+                port=options["port"],
+                unix_socket=options["unix_socket"],
+                socket_mode=socket_mode,
+                stop_event=stop_event)
+
+        asyncio.run(serve())
@@ -1,18 +1,49 @@
+import time
+
+
 from django.core.management.base import BaseCommand
 
 
 from webmail.models import SendMailTask
 from webmail.logutils import get_logger
+from webmail import settings
 
 logger = get_logger()
 
 
+# Seconds between progress messages
+PROGRESS_LOG_INTERVAL = 10
+
+
 class Command(BaseCommand):
     help = "Delete mailer log"
 
     def add_arguments(self, parser):
         parser.add_argument('days', type=int, help="Number of days that a log is considered old")
+        parser.add_argument('--chunk-size', type=int, default=settings.WEBMAIL_MAILER_PURGE_CHUNK_SIZE, help="Maximum number of tasks deleted in each transaction")
+        parser.add_argument('--pause', type=float, default=settings.WEBMAIL_MAILER_PURGE_PAUSE, help="Seconds to wait between chunks")
+        parser.add_argument('--max-runtime', type=float, default=None, help="Stop after this number of seconds. The next purge goes on with the rest")
+
+    def handle(self, days, chunk_size, pause, max_runtime, **options):
+        start_time = time.monotonic()
+        last_log_time = start_time
+
+        def log_progress(count):
+            nonlocal last_log_time
+
+            now = time.monotonic()
+            if now - last_log_time >= PROGRESS_LOG_INTERVAL:
+                last_log_time = now
+                logger.info("%s tasks deleted so far (%.1f tasks/s)" % (count, count / (now - start_time)))
+
+        count = SendMailTask.objects.purge_old_entries(days, chunk_size=chunk_size, pause=pause, max_runtime=max_runtime, progress_callback=log_progress)
+
+        elapsed_time = time.monotonic() - start_time
+        logger.info("%s tasks deleted in %.1f seconds" % (count, elapsed_time))
+
+        if max_runtime is not None and elapsed_time >= max_runtime:
+            logger.info("Max runtime reached, there could be old tasks left")
 
-    def handle(self, days, **options):
-        count = SendMailTask.objects.purge_old_entries(days)
-        logger.info("%s tasks deleted " % count)
+        count = SendMailTask.objects.delete_orphan_spool_payloads()
+        if count:
+            logger.info("%s orphan payloads deleted from the spool" % count)
@@ -1,27 +1,48 @@
 import logging
 import tempfile
 import sys
+import time
 
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 
-from webmail.mail_send_engine import send_all, send_all_loop
+from webmail.mail_send_engine import send_all, send_all_loop, acquire_lock, release_lock
+from webmail.mail_send_engine_async import send_all_asyncio
+from webmail.mail_send_workers import send_all_multiprocess
+from webmail.models import SendMailTask
 from webmail.logutils import get_logger
-from webmail import settings
+from webmail import settings, metrics
 
 
 class Command(BaseCommand):
     help = "Do one pass through the mail queue, attempting to send all mail, or send email forever."
 
     def add_arguments(self, parser):
-# TODO
-#        parser.add_argument(
-#            '-p', '--processes',
-#            type=int,
-#            default=1,
-#            help='Number of processes used to send emails',
-#        )
+        parser.add_argument(
+            '-p', '--processes',
+            type=int,
+            default=1,
+            help='Number of processes used to send emails',
+        )
+        parser.add_argument(
+            '--engine',
+            choices=["sync", "asyncio"],
+            help='Delivery engine. asyncio sends several messages at the same time in each process',
+            default=settings.WEBMAIL_MAILER_ENGINE
+        )
+        parser.add_argument(
+            '--max-concurrent-sessions',
+            type=int,
+            help='Max number of SMTP sessions at the same time in each process with the asyncio engine',
+            default=settings.WEBMAIL_MAILER_ASYNC_MAX_CONCURRENT_SESSIONS
+        )
+        parser.add_argument(
+            '--max-sessions-per-smtp-server',
+            type=int,
+            help='Max number of SMTP sessions at the same time with the same SMTP server in each process with the asyncio engine',
+            default=settings.WEBMAIL_MAILER_ASYNC_MAX_SESSIONS_PER_SMTP_SERVER
+        )
         parser.add_argument(
             '--forever',
             action="store_true",
@@ -36,6 +57,13 @@ class Command(BaseCommand):
             default=settings.WEBMAIL_MAILER_LOCK_PATH
         )
 
+        parser.add_argument(
+            '--lock-backend',
+            choices=["file", "database"],
+            help='Lock held during the run: a lock file (file) or an advisory lock of PostgreSQL or MySQL, for processes on several hosts (database)',
+            default=settings.WEBMAIL_MAILER_LOCK_BACKEND
+        )
+
         parser.add_argument(
             '--lock-wait-timeout',
             type=int,
@@ -48,6 +76,27 @@ class Command(BaseCommand):
             default=settings.WEBMAIL_MAILER_SLEEP_TIME_IF_NO_LOCK_ACQUIRED
         )
 
+        parser.add_argument(
+            '--claim-batch-size',
+            type=int,
+            help='Number of tasks claimed from the queue at once',
+            default=settings.WEBMAIL_MAILER_CLAIM_BATCH_SIZE
+        )
+
+        parser.add_argument(
+            '--scheduler',
+            choices=["fifo", "fair"],
+            help='Order of the tasks: by priority and creation date (fifo), or sharing the delivery between mailboxes (fair)',
+            default=settings.WEBMAIL_MAILER_SCHEDULER
+        )
+
+        parser.add_argument(
+            '--lease-duration',
+            type=int,
+            help='Seconds before the claimed tasks of a crashed process return to the queue',
+            default=settings.WEBMAIL_MAILER_LEASE_DURATION
+        )
+
         parser.add_argument(
             '--max-processed-tasks-in-batch',
             type=int,
@@ -74,7 +123,8 @@ class Command(BaseCommand):
 
         parser.add_argument(
             '--throttle-time',
-            type=int,
+            type=float,
+            help='Min seconds between emails sent through the same SMTP server, if it has no rate limit configured',
             default=settings.WEBMAIL_MAILER_THROTTLE_TIME
         )
 
@@ -93,40 +143,55 @@ class Command(BaseCommand):
         parser.add_argument(
             '--defer-duration',
             type=int,
-            help='How many hours to wait before retrying again this task',
+            help='Max hours to wait before retrying a failed task. The wait grows exponentially with each attempt up to this value',
             default=settings.WEBMAIL_MAILER_DEFER_DURATION
         )
 
+        parser.add_argument(
+            '--smtp-connection-idle-timeout',
+            type=int,
+            help='How many seconds an unused SMTP session is kept open to be reused by next tasks',
+            default=settings.WEBMAIL_MAILER_SMTP_CONNECTION_IDLE_TIMEOUT
+        )
+
         parser.add_argument(
             '--sleep-time-if-queue-empty',
             type=int,
             default=settings.WEBMAIL_MAILER_SLEEP_TIME_IF_QUEUE_EMPTY
         )
 
+        parser.add_argument(
+            '--stats',
+            action="store_true",
+            default=False,
+            help='Show the state of the queue and the metrics of the sending processes, and exit',
+        )
+
         parser.add_argument(
             '-l', '--log-level',
             choices=["info", "debug", "warning", "error"],
             default="debug"
         )
 
-    def handle(self, *args, max_processed_tasks_in_batch=None, max_succeed_tasks_in_batch=None, max_failed_tasks_in_batch=None, max_failed_or_deferred_tasks_in_batch=None, max_defer_email=None, throttle_time=None, delete_completed_tasks=None, max_times_mail_deferred=None, defer_duration=None, lock_wait_timeout=None, lock_path=None, sleep_time_if_no_lock_acquired=None, sleep_time_if_queue_empty=None, **options):
+    def handle(self, *args, max_processed_tasks_in_batch=None, max_succeed_tasks_in_batch=None, max_failed_tasks_in_batch=None, max_failed_or_deferred_tasks_in_batch=None, max_defer_email=None, throttle_time=None, delete_completed_tasks=None, max_times_mail_deferred=None, defer_duration=None, lock_wait_timeout=None, lock_path=None, sleep_time_if_no_lock_acquired=None, sleep_time_if_queue_empty=None, smtp_connection_idle_timeout=None, claim_batch_size=None, lease_duration=None, max_concurrent_sessions=None, max_sessions_per_smtp_server=None, **options):
         # allow a sysadmin to pause the sending of mail temporarily.        
         logger = get_logger(options['log_level'].upper())
 
+        if options["stats"]:
+            self.show_stats()
+            return
+
         if settings.WEBMAIL_MAILER_PAUSE_SEND:
             self.stdout.write("Mailer paused!")
             sys.exit()
 
         forever = options["forever"]
+        processes = options["processes"]
 
-        kwargs = {}
-        if lock_path is not None:
-            kwargs["lock_path"] = lock_path
+        if processes < 1:
+            raise CommandError("The number of processes must be at least 1")
 
         kwargs = dict(
-                lock_path=lock_path,
-                lock_wait_timeout=lock_wait_timeout,
-                sleep_time_if_no_lock_acquired=sleep_time_if_no_lock_acquired,
                 max_processed_tasks_in_batch=max_processed_tasks_in_batch,
                 max_succeed_tasks_in_batch=max_succeed_tasks_in_batch,
                 max_failed_tasks_in_batch=max_failed_tasks_in_batch,
@@ -134,10 +199,94 @@ class Command(BaseCommand):
                 max_times_mail_deferred=max_times_mail_deferred,
                 throttle_time=throttle_time,
                 delete_completed_tasks=delete_completed_tasks,
-                defer_duration=defer_duration)
+                defer_duration=defer_duration,
+                claim_batch_size=claim_batch_size,
+                scheduler=options["scheduler"],
+                lease_duration=lease_duration,
+                smtp_connection_idle_timeout=smtp_connection_idle_timeout)
+
+        if options["engine"] == "asyncio":
+            if max_concurrent_sessions < 1 or max_sessions_per_smtp_server < 1:
+                raise CommandError("The number of SMTP sessions must be at least 1")
+
+            send_function = send_all_asyncio
+
+            kwargs["max_concurrent_sessions"] = max_concurrent_sessions
+            kwargs["max_sessions_per_smtp_server"] = max_sessions_per_smtp_server
+        else:
+            send_function = None
 
         if forever:
             kwargs["sleep_time_if_queue_empty"] = sleep_time_if_queue_empty
-            send_all_loop(**kwargs)
-        else:
-            send_all(**kwargs)
+
+        # The lock prevents overlapping runs of this command, like the ones
+        # started by cron. Tasks are claimed from the queue with a lease, so
+        # the lock is held only once for the whole run.
+        while True:
+            acquired, lock = acquire_lock(lock_path=lock_path, lock_wait_timeout=lock_wait_timeout, lock_backend=options["lock_backend"])
+
+            # Before starting the worker processes, which don't inherit the
+            # metrics of this one
+            metrics.flush()
+
+            if acquired:
+                break
+            elif forever:
+                time.sleep(sleep_time_if_no_lock_acquired)
+            else:
+                return
+
+        try:
+            if processes > 1:
+                send_all_multiprocess(processes, forever=forever, send_function=send_function, **kwargs)
+            elif forever:
+                send_all_loop(send_function=send_function, **kwargs)
+            else:
+                (send_function or send_all)(**kwargs)
+        finally:
+            release_lock(lock)
+
+    def show_stats(self):
+        collected_metrics = {metric.name: metric for metric in metrics.collect()}
+
+        self.stdout.write("Queue:")
+
+        queue_depth = collected_metrics["webmail_sendmail_queue_depth"].values
+        oldest_task_age = collected_metrics["webmail_sendmail_queue_oldest_task_age_seconds"].values
+
+        for priority, label in SendMailTask.PRIORITY_CHOICES:
+            key = (str(priority),)
+            self.stdout.write("  %-8s %6d queued; oldest task queued %.1f seconds ago" % (label, queue_depth[key], oldest_task_age[key]))
+
+        self.stdout.write("  %6d in progress" % collected_metrics["webmail_sendmail_tasks_in_progress"].values[()])
+
+        if settings.WEBMAIL_MAILER_METRICS_DIR is None:
+            self.stdout.write("The metrics of the sending processes are not recorded: WEBMAIL_MAILER_METRICS_DIR is not set")
+            return
+
+        self.stdout.write("Tasks:")
+
+        tasks = collected_metrics["webmail_sendmail_tasks_total"].values
+        for outcome in ("succeeded", "failed", "deferred", "cancelled", "rate_limited"):
+            self.stdout.write("  %-13s %d" % (outcome, tasks.get((outcome,), 0)))
+
+        self.stdout.write("Latency (seconds):               count     mean      p50      p99")
+
+        for name, title in [
+            ("webmail_smtp_connect_seconds", "SMTP connect"),
+            ("webmail_smtp_auth_seconds", "SMTP AUTH"),
+            ("webmail_smtp_data_seconds", "SMTP DATA"),
+            ("webmail_sendmail_claim_seconds", "Claim"),
+            ("webmail_sendmail_lock_wait_seconds", "Lock wait")]:
+            histogram = collected_metrics[name]
+
+            for key in sorted(histogram.values):
+                count = histogram.get_count(key)
+                if not count:
+                    continue
+
+                description = title
+                if key:
+                    description += " (%s)" % ", ".join("%s %s" % label for label in zip(histogram.labelnames, key))
+
+                self.stdout.write("  %-30s %6d %8.3f %8.3f %8.3f" % (description, count, histogram.get_sum(key) / count, histogram.get_quantile(key, 0.5), histogram.get_quantile(key, 0.99)))
@@ -0,0 +1,560 @@
+import json
+import math
+import os
+import socket
+import tempfile
+import threading
+import time
+
+
+from . import settings, lockfile
+from .logutils import get_logger
+
+
+logger = get_logger()
+
+
+# Metrics of the delivery of the outgoing messages.
+#
+# Each sending process keeps its counters and histograms in memory, and writes
+# them from time to time to its own file in `WEBMAIL_MAILER_METRICS_DIR`. The
+# metrics endpoint and `sendmail --stats` add up the files of all the
+# processes. The files of the processes that finished are merged into an
+# archive file, so the counters never go backwards.
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+ARCHIVE_FILE_SUFFIX = "-archive.json"
+
+# The asyncio engine updates the metrics from the event loop and from the
+# thread of the database queries
+_lock = threading.Lock()
+
+
+def _labels_key(labelnames, labels):
+    if set(labels) != set(labelnames):
+        raise ValueError("Expected labels %s, got %s" % (", ".join(labelnames), ", ".join(labels)))
+
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        # Tuple of label values to value
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _labels_key(self.labelnames, labels)
+
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get_state(self):
+        with _lock:
+            return [[list(key), value] for key, value in self.values.items()]
+
+    def merge_state(self, state):
+        for key, value in state:
+            key = tuple(key)
+            self.values[key] = self.values.get(key, 0) + value
+
+    def iter_samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+
+        # Tuple of label values to [count of each bucket (not cumulative),
+        # count over the last bucket, sum]
+        self.values = {}
+
+    def _new_value(self):
+        return [0] * (len(self.buckets) + 1) + [0]
+
+    def observe(self, amount, **labels):
+        key = _labels_key(self.labelnames, labels)
+
+        for index, upper_bound in enumerate(self.buckets):
+            if amount <= upper_bound:
+                break
+        else:
+            index = len(self.buckets)
+
+        with _lock:
+            value = self.values.get(key)
+            if value is None:
+                value = self.values[key] = self._new_value()
+
+            value[index] += 1
+            value[-1] += amount
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def get_state(self):
+        with _lock:
+            return [[list(key), list(value)] for key, value in self.values.items()]
+
+    def merge_state(self, state):
+        for key, value in state:
+            key = tuple(key)
+
+            # Metrics written with other buckets are not comparable
+            if len(value) != len(self.buckets) + 2:
+                continue
+
+            current_value = self.values.get(key)
+            if current_value is None:
+                self.values[key] = list(value)
+            else:
+                for index, amount in enumerate(value):
+                    current_value[index] += amount
+
+    def get_count(self, key):
+        return sum(self.values[key][:-1])
+
+    def get_sum(self, key):
+        return self.values[key][-1]
+
+    def get_quantile(self, key, quantile):
+        """
+        Estimation of the quantile from the buckets, interpolating inside the
+        bucket like the function `histogram_quantile` of Prometheus.
+        """
+        counts = self.values[key][:-1]
+
+        total = sum(counts)
+        if not total:
+            return None
+
+        rank = quantile * total
+        cumulative_count = 0
+
+        for index, count in enumerate(counts):
+            if cumulative_count + count >= rank and count:
+                if index == len(self.buckets):
+                    # Above the last bucket
+                    return self.buckets[-1]
+
+                lower_bound = self.buckets[index - 1] if index else 0
+                upper_bound = self.buckets[index]
+
+                return lower_bound + (upper_bound - lower_bound) * (rank - cumulative_count) / count
+
+            cumulative_count += count
+
+        return self.buckets[-1]
+
+    def iter_samples(self):
+        for key, value in sorted(self.values.items()):
+            labels = dict(zip(self.labelnames, key))
+
+            cumulative_count = 0
+            for upper_bound, count in zip(self.buckets + (math.inf,), value):
+                cumulative_count += count
+                yield self.name + "_bucket", dict(labels, le=_format_value(upper_bound)), cumulative_count
+
+            yield self.name + "_count", labels, cumulative_count
+            yield self.name + "_sum", labels, value[-1]
+
+
+class Gauge:
+    """
+    Value computed when the metrics are collected. Not stored.
+    """
+    type = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def set(self, value, **labels):
+        self.values[_labels_key(self.labelnames, labels)] = value
+
+    def iter_samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start_time = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.monotonic() - self.start_time, **self.labels)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets=buckets))
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError("Duplicated metric %s" % metric.name)
+
+        self.metrics[metric.name] = metric
+        return metric
+
+    def copy(self):
+        """
+        Returns a registry with the same metrics and without values.
+        """
+        registry = MetricsRegistry()
+
+        for metric in self.metrics.values():
+            if isinstance(metric, Histogram):
+                registry.histogram(metric.name, metric.documentation, metric.labelnames, buckets=metric.buckets)
+            else:
+                registry.counter(metric.name, metric.documentation, metric.labelnames)
+
+        return registry
+
+    def reset(self):
+        with _lock:
+            for metric in self.metrics.values():
+                metric.values.clear()
+
+    def get_state(self):
+        return {name: metric.get_state() for name, metric in self.metrics.items() if metric.values}
+
+    def merge_state(self, state):
+        for name, metric_state in state.items():
+            if name in self.metrics:
+                self.metrics[name].merge_state(metric_state)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return "%d.0" % value
+
+    return repr(value)
+
+
+def _escape_label_value(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render_prometheus(metrics):
+    """
+    Text exposition format of Prometheus for the list of metrics.
+    """
+    lines = []
+
+    for metric in metrics:
+        lines.append("# HELP %s %s" % (metric.name, metric.documentation.replace("\\", "\\\\").replace("\n", "\\n")))
+        lines.append("# TYPE %s %s" % (metric.name, metric.type))
+
+        for sample_name, labels, value in metric.iter_samples():
+            if labels:
+                sample_name += "{%s}" % ",".join('%s="%s"' % (name, _escape_label_value(label_value)) for name, label_value in labels.items())
+
+            lines.append("%s %s" % (sample_name, _format_value(value)))
+
+    return "\n".join(lines) + "\n"
+
+
+def _is_process_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+class MetricsFileStore:
+    """
+    Directory with the metrics files of the sending processes.
+    """
+
+    def __init__(self, directory=settings.WEBMAIL_MAILER_METRICS_DIR):
+        self.directory = directory
+        self.hostname = socket.gethostname()
+
+    @property
+    def is_enabled(self):
+        return self.directory is not None
+
+    def _get_process_path(self, pid):
+        return os.path.join(self.directory, "%s-%d.json" % (self.hostname, pid))
+
+    def _get_archive_path(self):
+        return os.path.join(self.directory, self.hostname + ARCHIVE_FILE_SUFFIX)
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logger.warning("Invalid metrics file %s", path)
+            return None
+
+    def _write(self, path, state):
+        os.makedirs(self.directory, exist_ok=True)
+
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(state, f)
+
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def write(self, registry):
+        self._write(self._get_process_path(os.getpid()), registry.get_state())
+
+    def compact(self, registry):
+        """
+        Merges the files of the processes of this host that are not running
+        anymore into the archive file. `registry` provides the definitions
+        of the metrics.
+        """
+        if not os.path.isdir(self.directory):
+            return
+
+        prefix = self.hostname + "-"
+
+        finished_process_paths = []
+        for filename in os.listdir(self.directory):
+            if not filename.startswith(prefix) or not filename.endswith(".json"):
+                continue
+
+            try:
+                pid = int(filename[len(prefix):-len(".json")])
+            except ValueError:
+                continue
+
+            if not _is_process_running(pid):
+                finished_process_paths.append(os.path.join(self.directory, filename))
+
+        if not finished_process_paths:
+            return
+
+        lock = lockfile.FileLock(os.path.join(self.directory, self.hostname + "-compact"))
+        try:
+            lock.acquire()
+        except lockfile.AlreadyLocked:
+            # Another process is compacting the same files
+            return
+
+        try:
+            archive_registry = registry.copy()
+
+            archive_state = self._read(self._get_archive_path())
+            if archive_state is not None:
+                archive_registry.merge_state(archive_state)
+
+            for path in finished_process_paths:
+                state = self._read(path)
+                if state is not None:
+                    archive_registry.merge_state(state)
+
+            self._write(self._get_archive_path(), archive_registry.get_state())
+
+            for path in finished_process_paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        finally:
+            lock.release()
+
+    def read_all(self, registry):
+        """
+        Returns a new registry with the sum of the metrics of all the files.
+        """
+        total_registry = registry.copy()
+
+        if not os.path.isdir(self.directory):
+            return total_registry
+
+        for filename in sorted(os.listdir(self.directory)):
+            if filename.startswith(".") or not filename.endswith(".json"):
+                continue
+
+            state = self._read(os.path.join(self.directory, filename))
+            if state is not None:
+                total_registry.merge_state(state)
+
+        return total_registry
+
+
+registry = MetricsRegistry()
+
+TASKS = registry.counter(
+    "webmail_sendmail_tasks_total",
+    "Email sending tasks processed, by outcome.",
+    ["outcome"])
+
+SMTP_CONNECT_SECONDS = registry.histogram(
+    "webmail_smtp_connect_seconds",
+    "Time to open an SMTP session: TCP connection, TLS and EHLO.",
+    ["smtp_server"])
+
+SMTP_AUTH_SECONDS = registry.histogram(
+    "webmail_smtp_auth_seconds",
+    "Time of the SMTP authentication.",
+    ["smtp_server"])
+
+SMTP_DATA_SECONDS = registry.histogram(
+    "webmail_smtp_data_seconds",
+    "Time from the DATA command to the reply of the server accepting or rejecting the message.",
+    ["smtp_server"])
+
+CLAIM_SECONDS = registry.histogram(
+    "webmail_sendmail_claim_seconds",
+    "Time to claim a batch of tasks from the queue.")
+
+LOCK_WAIT_SECONDS = registry.histogram(
+    "webmail_sendmail_lock_wait_seconds",
+    "Time waiting for the lock of the sendmail command, by result.",
+    ["result"])
+
+
+_store = MetricsFileStore()
+_last_flush_time = None
+
+
+def _reset_after_fork():
+    # The values of the parent process are written by the parent
+    global _lock, _last_flush_time
+
+    _lock = threading.Lock()
+    registry.reset()
+    _last_flush_time = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def set_metrics_dir(directory):
+    """
+    Changes the directory where this process writes its metrics. None
+    disables writing them.
+    """
+    global _store, _last_flush_time
+
+    _store = MetricsFileStore(directory)
+    _last_flush_time = None
+
+
+def flush(force=True):
+    """
+    Writes the metrics of this process to its file. Without `force`, only if
+    more than `WEBMAIL_MAILER_METRICS_FLUSH_INTERVAL` seconds passed since the
+    last time.
+    """
+    global _last_flush_time
+
+    if not _store.is_enabled:
+        return
+
+    now = time.monotonic()
+    if not force and _last_flush_time is not None and now - _last_flush_time < settings.WEBMAIL_MAILER_METRICS_FLUSH_INTERVAL:
+        return
+
+    try:
+        if _last_flush_time is None:
+            _store.compact(registry)
+
+        _store.write(registry)
+    except OSError:
+        logger.exception("Not possible to write the metrics to %s", _store.directory)
+
+    _last_flush_time = now
+
+
+def get_queue_metrics():
+    """
+    Gauges of the current state of the queue, from the database.
+    """
+    from django.db.models import Count, Min
+    from django.utils import timezone
+
+    from .models import SendMailTask
+
+    queue_depth = Gauge(
+        "webmail_sendmail_queue_depth",
+        "Tasks waiting in the queue, by priority.",
+        ["priority"])
+
+    oldest_task_age = Gauge(
+        "webmail_sendmail_queue_oldest_task_age_seconds",
+        "Age of the oldest task waiting in the queue, by priority.",
+        ["priority"])
+
+    in_progress = Gauge(
+        "webmail_sendmail_tasks_in_progress",
+        "Tasks claimed by a sending process.")
+
+    now = timezone.now()
+
+    rows = SendMailTask.objects.filter(status=SendMailTask.STATUS_QUEUED).order_by().values("priority").annotate(num_tasks=Count("id"), oldest_created_at=Min("created_at"))
+    rows = {row["priority"]: row for row in rows}
+
+    for priority, _label in SendMailTask.PRIORITY_CHOICES:
+        row = rows.get(priority)
+
+        queue_depth.set(row["num_tasks"] if row else 0, priority=priority)
+        oldest_task_age.set((now - row["oldest_created_at"]).total_seconds() if row else 0, priority=priority)
+
+    in_progress.set(SendMailTask.objects.filter(status=SendMailTask.STATUS_IN_PROGRESS).count())
+
+    return [queue_depth, oldest_task_age, in_progress]
+
+
+def collect():
+    """
+    Returns the list of the metrics of all the sending processes, and the
+    state of the queue.
+    """
+    if _store.is_enabled:
+        try:
+            _store.compact(registry)
+        except OSError:
+            logger.exception("Not possible to compact the metrics files in %s", _store.directory)
+
+        total_registry = _store.read_all(registry)
+    else:
+        total_registry = registry
+
+    return list(total_registry.metrics.values()) + get_queue_metrics()
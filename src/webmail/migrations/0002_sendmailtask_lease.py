@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webmail', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sendmailtask',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, editable=False, null=True, verbose_name='Lease expires at'),
+        ),
+        migrations.AddField(
+            model_name='sendmailtask',
+            name='lease_token',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=32, null=True, verbose_name='Lease token'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webmail', '0002_sendmailtask_lease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SendRateLimitBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True, verbose_name='Key')),
+                ('theoretical_arrival_time', models.FloatField(verbose_name='Theoretical arrival time')),
+            ],
+            options={
+                'verbose_name': 'Send Rate Limit Bucket',
+                'verbose_name_plural': 'Send Rate Limit Buckets',
+            },
+        ),
+        migrations.AddField(
+            model_name='smtpserver',
+            name='max_messages_burst',
+            field=models.PositiveIntegerField(default=1, help_text='Messages that can be sent at once before applying the rate limit.', verbose_name='Max messages in a burst'),
+        ),
+        migrations.AddField(
+            model_name='smtpserver',
+            name='max_messages_per_minute',
+            field=models.PositiveIntegerField(blank=True, help_text='Sending quota of the SMTP server. Leave it empty for no limit.', null=True, verbose_name='Max messages per minute'),
+        ),
+    ]
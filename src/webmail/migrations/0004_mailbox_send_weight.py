@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webmail', '0003_send_rate_limit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailbox',
+            name='send_weight',
+            field=models.PositiveSmallIntegerField(default=1, help_text='Share of the outgoing mail delivery of this mailbox compared with others with the fair scheduler', verbose_name='Send weight'),
+        ),
+    ]
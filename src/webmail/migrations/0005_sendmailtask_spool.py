@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:05
+
+from django.db import migrations, models
+from django.db.models.functions import Length
+
+
+def set_payload_size(apps, schema_editor):
+    SendMailTask = apps.get_model('webmail', 'SendMailTask')
+    SendMailTask.objects.using(schema_editor.connection.alias).update(payload_size=Length('multipart_mail_message'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webmail', '0004_mailbox_send_weight'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sendmailtask',
+            name='payload_size',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True, verbose_name='Payload size'),
+        ),
+        migrations.AddField(
+            model_name='sendmailtask',
+            name='spool_ref',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=80, null=True, verbose_name='Spool reference'),
+        ),
+        migrations.AlterField(
+            model_name='sendmailtask',
+            name='multipart_mail_message',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_payload_size, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:16
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def set_scheduled_time(apps, schema_editor):
+    # Queued tasks never deferred had no scheduled time. The tasks in
+    # progress get one too, in case they return to the queue.
+    SendMailTask = apps.get_model('webmail', 'SendMailTask')
+    SendMailTask.objects.using(schema_editor.connection.alias).filter(status__in=[0, 1], scheduled_time=None).update(scheduled_time=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webmail', '0005_sendmailtask_spool'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='sendmailtask',
+            index=models.Index(fields=['status', 'scheduled_time', 'priority', 'created_at'], name='webmail_sendtask_eligible_idx'),
+        ),
+        migrations.RunPython(set_scheduled_time, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webmail', '0006_sendmailtask_retry_schedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sendmailtaskerrorrecipient',
+            name='retry',
+            field=models.BooleanField(default=False, verbose_name='Retry'),
+        ),
+        migrations.AlterField(
+            model_name='sendmailtaskerrorrecipient',
+            name='code',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='Code'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webmail', '0007_sendmailtaskerrorrecipient_retry'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='sendmailtask',
+            index=models.Index(fields=['status', 'last_sent_at'], name='webmail_sendtask_purge_idx'),
+        ),
+    ]
@@ -0,0 +1,138 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:30
+
+import email.header
+import gzip
+import os
+from email.parser import BytesHeaderParser
+from email.utils import parseaddr
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+# The helpers of the application are copied here, the migration must keep
+# working when they change
+
+
+def convert_header_to_unicode(header):
+    default_charset = getattr(settings, 'WEBMAIL_DEFAULT_CHARSET', 'iso8859-1')
+
+    def decode(value, encoding):
+        if isinstance(value, str):
+            return value
+        if not encoding or encoding == 'unknown-8bit':
+            encoding = default_charset
+        return value.decode(encoding, 'replace')
+
+    try:
+        return ''.join(decode(value, encoding) for value, encoding in email.header.decode_header(header))
+    except (UnicodeDecodeError, LookupError):
+        return header
+
+
+def open_spooled_payload(spool_ref):
+    spool_dir = getattr(settings, 'WEBMAIL_MAILER_SPOOL_DIR', None)
+    if spool_dir is None or os.sep in spool_ref or spool_ref.startswith('.'):
+        raise FileNotFoundError(spool_ref)
+
+    path = os.path.join(spool_dir, spool_ref[:2], spool_ref[2:4], spool_ref)
+
+    if spool_ref.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    else:
+        return open(path, 'rb')
+
+
+def read_headers(lines):
+    header_lines = []
+    for line in lines:
+        if line in (b'\r\n', b'\n'):
+            break
+
+        header_lines.append(line)
+
+    return BytesHeaderParser().parsebytes(b''.join(header_lines))
+
+
+def read_payload_headers(task, tasks):
+    """
+    Returns the headers of the payload of the task, or None if it's missing.
+    Only the headers are read.
+    """
+    if task.spool_ref:
+        try:
+            with open_spooled_payload(task.spool_ref) as f:
+                return read_headers(f)
+        except OSError:
+            return None
+
+    payload = tasks.filter(id=task.id).values_list('multipart_mail_message', flat=True).first()
+    if payload is None:
+        return None
+
+    return read_headers(bytes(payload).splitlines(keepends=True))
+
+
+def get_sender_email(from_name, from_email):
+    # Like `SmtpServer.get_sender_email`
+    if from_name:
+        from_email = '%s <%s>' % (from_name, from_email)
+
+    return from_email or getattr(settings, 'WEBMAIL_DEFAULT_FROM_EMAIL', None)
+
+
+def set_summary(apps, schema_editor):
+    SendMailTask = apps.get_model('webmail', 'SendMailTask')
+    SmtpServer = apps.get_model('webmail', 'SmtpServer')
+
+    using = schema_editor.connection.alias
+    tasks = SendMailTask.objects.using(using)
+
+    # Sent with the sender of the SMTP server of the mailbox, like the new
+    # tasks
+    sender_emails = {
+        mailbox_id: get_sender_email(from_name, from_email)
+        for mailbox_id, from_name, from_email in SmtpServer.objects.using(using).values_list('mailbox_id', 'from_name', 'from_email')
+    }
+
+    for task in tasks.only('id', 'mailbox', 'email_recipients', 'spool_ref').iterator():
+        task.num_recipients = len(task.email_recipients)
+
+        headers = read_payload_headers(task, tasks)
+        if headers is not None:
+            task.subject = convert_header_to_unicode(headers.get('Subject', ''))[0:1000]
+
+        sender_email = sender_emails.get(task.mailbox_id)
+        if not sender_email and headers is not None:
+            # Without SMTP server, the From of the message
+            sender_email = convert_header_to_unicode(headers.get('From', ''))
+
+        task.envelope_sender = parseaddr(sender_email or '')[1][0:254]
+
+        task.save(update_fields=['subject', 'envelope_sender', 'num_recipients'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webmail', '0008_sendmailtask_purge_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sendmailtask',
+            name='envelope_sender',
+            field=models.CharField(blank=True, default='', editable=False, max_length=254, verbose_name='Envelope sender'),
+        ),
+        migrations.AddField(
+            model_name='sendmailtask',
+            name='num_recipients',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Number of recipients'),
+        ),
+        migrations.AddField(
+            model_name='sendmailtask',
+            name='subject',
+            field=models.CharField(blank=True, default='', editable=False, max_length=1000, verbose_name='Subject'),
+        ),
+        migrations.RunPython(set_summary, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webmail', '0009_sendmailtask_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pop3mailserver',
+            name='leave_messages_on_server',
+            field=models.BooleanField(default=False, help_text="Don't delete the messages from the server after fetching them. Only the new messages are downloaded.", verbose_name='Leave messages on server'),
+        ),
+        migrations.CreateModel(
+            name='Pop3SeenMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uid_hash', models.BigIntegerField(verbose_name='Hash of the unique id')),
+                ('pop3_mail_server', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='seen_messages', to='webmail.pop3mailserver')),
+            ],
+            options={
+                'verbose_name': 'Pop3 Seen Message',
+                'verbose_name_plural': 'Pop3 Seen Messages',
+                'constraints': [models.UniqueConstraint(fields=('pop3_mail_server', 'uid_hash'), name='webmail_pop3seen_uid_uniq')],
+            },
+        ),
+    ]
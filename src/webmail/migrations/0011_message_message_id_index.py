@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webmail', '0010_pop3_leave_messages_on_server'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='message_id',
+            field=models.CharField(db_index=True, max_length=255, verbose_name='Message ID'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:16
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webmail', '0011_message_message_id_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='sendmailtask',
+            name='scheduled_time',
+            field=models.DateTimeField(blank=True, db_index=True, default=django.utils.timezone.now, null=True, verbose_name='The scheduled sending time'),
+        ),
+    ]
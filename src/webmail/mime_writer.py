@@ -0,0 +1,137 @@
+import base64
+import mimetypes
+import random
+import sys
+from email import generator
+from email.mime.base import MIMEBase
+
+
+CRLF = b"\r\n"
+
+# Multiple of 57, the bytes encoded in each line of 76 base64 characters
+BASE64_READ_CHUNK_SIZE = 57 * 1024
+
+DEFAULT_ATTACHMENT_MIME_TYPE = "application/octet-stream"
+
+
+# Django builds a message with all the attachments read in memory, and the
+# email package flattens each MIME part into a buffer before writing it. Both
+# copies are avoided here for the attachments stored in files: the message
+# is built with empty placeholder parts, and `write_message` writes the base64
+# of the files in chunks when it reaches them.
+
+
+class StreamedAttachmentPart(MIMEBase):
+    """
+    Attachment part whose content is read from `file` when written with
+    `write_message`. Always encoded with base64.
+    """
+
+    def __init__(self, file, filename, mimetype=None):
+        if not mimetype:
+            mimetype = mimetypes.guess_type(filename)[0] or DEFAULT_ATTACHMENT_MIME_TYPE
+
+        maintype, subtype = mimetype.split("/", 1)
+
+        super().__init__(maintype, subtype)
+
+        self["Content-Transfer-Encoding"] = "base64"
+
+        # Same header as the attachments created by Django
+        try:
+            filename.encode("ascii")
+        except UnicodeEncodeError:
+            filename = ("utf-8", "", filename)
+
+        self.add_header("Content-Disposition", "attachment", filename=filename)
+
+        self.file = file
+
+
+def can_stream_attachment(mimetype):
+    """
+    Text and message attachments are encoded by Django depending on their
+    content, so they are not streamed.
+    """
+    return not mimetype or mimetype.split("/", 1)[0] not in ("text", "message")
+
+
+def _make_boundary():
+    # Same format as email.generator, which also checks that the boundary
+    # is not found in the content. The content is not in memory here, but a
+    # base64 encoded attachment can't contain it.
+    token = random.randrange(sys.maxsize)
+    return "=" * 15 + ("%0*d" % (len(repr(sys.maxsize - 1)), token)) + "=="
+
+
+def _write_base64(fp, file):
+    file.open("rb")
+
+    try:
+        for chunk in file.chunks(chunk_size=BASE64_READ_CHUNK_SIZE):
+            fp.write(base64.encodebytes(chunk).replace(b"\n", CRLF))
+    finally:
+        file.close()
+
+
+def _write_headers(fp, msg, policy):
+    for name, value in msg.raw_items():
+        fp.write(policy.fold_binary(name, value))
+
+    fp.write(CRLF)
+
+
+def _write_lines(fp, text):
+    # Like the generator of the email package, with the line endings
+    # converted and none added to the last line
+    if isinstance(text, str):
+        text = text.encode("ascii", "surrogateescape")
+
+    for line in text.splitlines(keepends=True):
+        stripped_line = line.rstrip(b"\r\n")
+        if stripped_line != line:
+            line = stripped_line + CRLF
+
+        fp.write(line)
+
+
+def write_message(fp, msg, policy=None):
+    """
+    Writes the message `msg` to the binary file `fp` like
+    `msg.as_bytes(linesep="\\r\\n")`, with the content of the
+    `StreamedAttachmentPart` parts read in chunks from their files.
+    """
+    if policy is None:
+        policy = msg.policy.clone(linesep="\r\n")
+
+    if isinstance(msg, StreamedAttachmentPart):
+        _write_headers(fp, msg, policy)
+        _write_base64(fp, msg.file)
+    elif msg.is_multipart():
+        boundary = msg.get_boundary()
+        if boundary is None:
+            boundary = _make_boundary()
+            msg.set_boundary(boundary)
+
+        boundary = boundary.encode("ascii")
+
+        _write_headers(fp, msg, policy)
+
+        if msg.preamble is not None:
+            _write_lines(fp, msg.preamble)
+            fp.write(CRLF)
+
+        for num_part, part in enumerate(msg.get_payload()):
+            if num_part:
+                fp.write(CRLF)
+
+            fp.write(b"--" + boundary + CRLF)
+            write_message(fp, part, policy=policy)
+
+        fp.write(CRLF + b"--" + boundary + b"--" + CRLF)
+
+        if msg.epilogue is not None:
+            _write_lines(fp, msg.epilogue)
+    else:
+        # Parts without attachments are small
+        generator.BytesGenerator(fp, mangle_from_=False, policy=policy).flatten(msg)
@@ -1,9 +1,10 @@
+import contextlib
 import datetime
 import time
 import uuid
 import email.header
 from email.utils import parseaddr
-from email import message_from_string
+from email import message_from_bytes
 # from quopri import encode as encode_quopri
 from io import BytesIO
 import mimetypes
@@ -20,26 +21,34 @@ from importlib import import_module
 from django.core.files.base import ContentFile, File
 from django.core.mail.message import EmailMessage as DjangoEmailMessage, EmailMultiAlternatives as DjangoEmailMultiAlternatives
 from django.contrib.sessions.backends.base import SessionBase as SessionStoreBase
-from django.db import models, transaction
-from django.db.models import Q
+from django.db import connections, models, transaction
+from django.db.models import F, Q, Min
 from django.utils.translation import gettext_lazy as _
 from django.utils.crypto import get_random_string, salted_hmac
 from django.utils.functional import cached_property
 from django.utils.text import get_text_list
 from django.utils import timezone
+from django.db.models.signals import post_delete
 from django.dispatch import receiver as signal_receiver
 from django.urls import reverse as reverse_url
 
 
 from . import utils, settings
-from .signals import inbound_email_received_signal, user_logged_in_signal
+from .signals import inbound_email_received_signal, user_logged_in_signal, message_queued_signal
+from .mail_queue_notify import on_message_queued
 from .validators import validate_email_with_name, username_validator, hexdigits_validator
 from .pop3_transport import Pop3Transport
+from .mail_parse import get_invalid_reason, parse_email_message
+from .smtp_transport import SmtpTransport, SmtpConnectionPool, SMTPRecipientChunksFailed
+from .mail_spool import MailSpool
+from .mime_writer import StreamedAttachmentPart, can_stream_attachment, write_message
+from .send_scheduler import FifoSendScheduler
+from .retry_policy import classify_send_error, PERMANENT_ERROR
 from .fields import CommaSeparatedEmailField
 from .srp import salted_verification_key
 from .srp.srp_defaults import DEFAULT_BIT_GROUP_NUMBER
 from .logutils import get_logger
-from .exceptions import NoSmtpServerConfiguredException, InvalidEmailMessageException
+from .exceptions import NoSmtpServerConfiguredException, InvalidEmailMessageException, MessageTooLargeException
 
 
 logger = get_logger()
@@ -314,6 +323,8 @@ def register_access_log(sender, request, user, **kw):
 
 user_logged_in_signal.connect(register_access_log, sender=WebmailUser)
 
+message_queued_signal.connect(on_message_queued)
+
 
 class AnonymousUser:
     id = None
@@ -395,6 +406,8 @@ class Mailbox(models.Model):
     
     is_default = models.BooleanField(default=False)
 
+    send_weight = models.PositiveSmallIntegerField(_("Send weight"), default=1, help_text=_("Share of the outgoing mail delivery of this mailbox compared with others with the fair scheduler"))
+
     created_at = models.DateTimeField(auto_now_add=True)
 
     objects = models.Manager()
@@ -413,14 +426,74 @@ class Mailbox(models.Model):
     def process_incomming_email(self, email_message):
         """Process a message incoming to this mailbox."""
 
-        inbound_email_received_signal.send(sender=Mailbox, email_message=email_message, mailbox=self)
+        result = self.process_incomming_emails([email_message])[0]
+        if isinstance(result, InvalidEmailMessageException):
+            raise result
 
-        if is_spam(email_message):
-            folder_id = Message.SPAM_FOLDER_ID
-        else:
+        return result
+
+    def process_incomming_emails(self, email_messages):
+        """
+        Process a batch of messages incoming to this mailbox, saved in one
+        transaction. Returns a list with the saved message, or the
+        `InvalidEmailMessageException` raised by the invalid ones, for each
+        message.
+        """
+        parsed_messages = []
+
+        for email_message in email_messages:
+            inbound_email_received_signal.send(sender=Mailbox, email_message=email_message, mailbox=self)
+
+            parsed_messages.append(parse_email_message(email_message, is_spam=is_spam(email_message)))
+
+        return self._save_parsed_emails(parsed_messages)
+
+    def process_parsed_emails(self, parsed_messages):
+        """
+        Like `process_incomming_emails`, for the `ParsedMessage` returned by a
+        `MessageParserPool`, already checked for spam. The receivers of
+        `inbound_email_received_signal` get only the headers of the message.
+        """
+        for parsed_message in parsed_messages:
+            inbound_email_received_signal.send(sender=Mailbox, email_message=parsed_message.get_headers_message(), mailbox=self)
+
+        return self._save_parsed_emails(parsed_messages)
+
+    def import_parsed_emails(self, parsed_messages, folder_id=None):
+        """
+        Saves in one transaction a batch of `ParsedMessage` imported from
+        another system in the folder `folder_id`, the inbox by default.
+        Returns the same list as `process_incomming_emails`.
+        """
+        if folder_id is None:
             folder_id = Message.INBOX_FOLDER_ID
 
-        return self.import_email(email_message, folder_id=folder_id)
+        return self._save_parsed_emails(parsed_messages, folder_id=folder_id)
+
+    def _save_parsed_emails(self, parsed_messages, folder_id=None):
+        results = [None] * len(parsed_messages)
+        built_messages = []
+
+        for i, parsed_message in enumerate(parsed_messages):
+            if folder_id is not None:
+                message_folder_id = folder_id
+            elif parsed_message.is_spam:
+                message_folder_id = Message.SPAM_FOLDER_ID
+            else:
+                message_folder_id = Message.INBOX_FOLDER_ID
+
+            try:
+                built_messages.append((i, Message.build_from_parsed_message(mailbox=self, parsed_message=parsed_message, folder_id=message_folder_id, my_email_list=self.emails)))
+            except InvalidEmailMessageException as e:
+                results[i] = e
+
+        if built_messages:
+            msg_records = Message.save_raw_email_messages([built_message for _i, built_message in built_messages])
+
+            for (i, _built_message), msg_record in zip(built_messages, msg_records):
+                results[i] = msg_record
+
+        return results
 
     def import_email(self, email_message, folder_id=None):
         if folder_id is None:
@@ -483,6 +556,12 @@ class Pop3MailServer(models.Model):
 
     use_ssl = models.BooleanField(_("Use SSL"), default=False)
 
+    leave_messages_on_server = models.BooleanField(
+        _("Leave messages on server"),
+        help_text=_("Don't delete the messages from the server after fetching them. Only the new messages are downloaded."),
+        default=False
+    )
+
     active = models.BooleanField(
         _('Active'),
         help_text=(_(
@@ -502,42 +581,198 @@ class Pop3MailServer(models.Model):
         db_table = "webmail_pop3mailserver"
 
 
-    def get_connection(self):
+    def get_connection(self, timeout=settings.WEBMAIL_POP3_TIMEOUT):
         """Returns the transport instance for this mailbox."""
 
         conn = Pop3Transport(
                 self.ip_address,
                 port=self.port if self.port else None,
-                ssl=self.use_ssl
+                ssl=self.use_ssl,
+                timeout=timeout
             )
         conn.connect(self.username, self.password)
         
         return conn
 
-    def get_new_mail(self, condition=None):
-        """Connect to this transport and fetch new messages."""
+    def get_new_mail(self, condition=None, connection=None, max_message_size=None, min_message_size=None, batch_size=settings.WEBMAIL_FETCH_BATCH_SIZE, parser_pool=None):
+        """Connect to this transport and fetch new messages.
+
+        `condition` receives only the headers of each message, the messages
+        not accepted are not downloaded. The messages larger than
+        `max_message_size` bytes are left in the server and a
+        `MessageTooLargeException` is yielded for each one, to fetch them apart
+        passing that size as `min_message_size`: then only the messages larger
+        than it are fetched.
+
+        The messages are saved in batches of `batch_size`, each one in a
+        transaction, and deleted from the server only after it's committed.
+        With a `MessageParserPool` in `parser_pool`, the messages of each batch
+        are parsed in its worker processes.
+        """
 
         mailbox = self.mailbox
 
         new_mail = []
-        connection = self.get_connection()
+        if connection is None:
+            connection = self.get_connection()
         if not connection:
             return
-        for email_message in connection.get_message(condition):
-            try:
-                msg = mailbox.process_incomming_email(email_message)
-            except InvalidEmailMessageException as e:
-                yield e
+
+        message_sizes = connection.list_sizes()
+
+        if self.leave_messages_on_server:
+            messages = self._get_unseen_messages(connection)
+        else:
+            messages = [(message_number, None) for message_number in sorted(message_sizes)]
+
+        batch = []
+        batch_num_bytes = 0
+
+        for message_number, uid_hash in messages:
+            size = message_sizes.get(message_number, 0)
+
+            if min_message_size is not None and size <= min_message_size:
+                continue
+
+            if max_message_size is not None and size > max_message_size:
+                yield MessageTooLargeException(message_number, size)
+                continue
+
+            if condition is not None and not condition(connection.retrieve_headers(message_number)):
+                email_message = None
+            elif parser_pool is not None:
+                # Parsed with the rest of the batch
+                email_message = connection.retrieve_raw_message(message_number)
             else:
-                yield msg
+                email_message = connection.retrieve_message(message_number)
+
+            # Messages that can't be parsed or not accepted are left in the
+            # server. When leaving all the messages in the server, they are
+            # marked as seen too, otherwise they would be downloaded in every
+            # poll.
+            if email_message is None and uid_hash is None:
+                continue
+
+            batch.append((message_number, uid_hash, email_message))
+            batch_num_bytes += size
+
+            # The parsed messages of a batch are kept in memory
+            if len(batch) >= batch_size or batch_num_bytes >= settings.WEBMAIL_POP3_MAX_MESSAGE_SIZE:
+                yield from self._save_new_mail(connection, batch, parser_pool=parser_pool)
+
+                batch = []
+                batch_num_bytes = 0
+
+        if batch:
+            yield from self._save_new_mail(connection, batch, parser_pool=parser_pool)
+
+        connection.quit()
 
         self.last_polling = timezone.now()
         self.save(update_fields=['last_polling'])
 
+    def _save_new_mail(self, connection, batch, parser_pool=None):
+        """
+        Saves a batch of tuples with the number, the hash of the unique id if
+        the messages are left in the server, and the parsed message, if
+        accepted, or its bytes with `parser_pool`. Yields the results of
+        `Mailbox.process_incomming_emails`.
+        """
+        if parser_pool is not None:
+            raw_batch = batch
+            parsed_messages = iter(parser_pool.parse([raw_message for _message_number, _uid_hash, raw_message in raw_batch if raw_message is not None]))
+
+            batch = []
+            for message_number, uid_hash, raw_message in raw_batch:
+                parsed_message = next(parsed_messages) if raw_message is not None else None
+
+                # Left in the server, like the messages that can't be parsed
+                if parsed_message is None and uid_hash is None:
+                    continue
+
+                batch.append((message_number, uid_hash, parsed_message))
+
+        email_messages = [email_message for _message_number, _uid_hash, email_message in batch if email_message is not None]
+
+        try:
+            with transaction.atomic():
+                if parser_pool is not None:
+                    results = self.mailbox.process_parsed_emails(email_messages)
+                else:
+                    results = self.mailbox.process_incomming_emails(email_messages)
+
+                seen_messages = [Pop3SeenMessage(pop3_mail_server=self, uid_hash=uid_hash) for _message_number, uid_hash, _email_message in batch if uid_hash is not None]
+                if seen_messages:
+                    Pop3SeenMessage.objects.bulk_create(seen_messages)
+        finally:
+            if parser_pool is not None:
+                # The attachments in temporary files of the messages not saved
+                for parsed_message in email_messages:
+                    parsed_message.discard_attachments()
+
+        # Only when they are saved
+        for message_number, uid_hash, _email_message in batch:
+            if uid_hash is None:
+                connection.delete_message(message_number)
+
+        yield from results
+
+    def _get_unseen_messages(self, connection):
+        """
+        Returns a list of tuples with the number and the hash of the unique id
+        (UIDL) of the messages in the server not in the index of messages
+        already seen.
+        """
+        server_uid_hashes = [(message_number, Pop3SeenMessage.get_uid_hash(uid)) for message_number, uid in connection.list_uids()]
+
+        seen_uid_hashes = set(self.seen_messages.values_list("uid_hash", flat=True))
+
+        # The messages deleted from the server are forgotten, so the index
+        # doesn't grow forever
+        deleted_uid_hashes = list(seen_uid_hashes.difference(uid_hash for _message_number, uid_hash in server_uid_hashes))
+        for i in range(0, len(deleted_uid_hashes), 500):
+            self.seen_messages.filter(uid_hash__in=deleted_uid_hashes[i:i + 500]).delete()
+
+        unseen_messages = []
+        for message_number, uid_hash in server_uid_hashes:
+            if uid_hash in seen_uid_hashes:
+                continue
+
+            # Same message listed twice
+            seen_uid_hashes.add(uid_hash)
+
+            unseen_messages.append((message_number, uid_hash))
+
+        return unseen_messages
+
     def __str__(self):
         return '%s@%s:%s' % (self.username, self.ip_address, self.port)
 
 
+class Pop3SeenMessage(models.Model):
+    """
+    Message already downloaded from a POP3 server that leaves the messages on
+    the server. Only a 64 bits hash of its unique id (UIDL) is stored.
+    """
+    pop3_mail_server = models.ForeignKey(Pop3MailServer, on_delete=models.CASCADE, related_name="seen_messages")
+    uid_hash = models.BigIntegerField(_("Hash of the unique id"))
+
+    class Meta:
+        verbose_name = _('Pop3 Seen Message')
+        verbose_name_plural = _('Pop3 Seen Messages')
+        constraints = [
+            models.UniqueConstraint(fields=["pop3_mail_server", "uid_hash"], name="webmail_pop3seen_uid_uniq"),
+        ]
+
+    @staticmethod
+    def get_uid_hash(uid):
+        digest = hashlib.sha256(uid.encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big", signed=True)
+
+    def __str__(self):
+        return str(self.uid_hash)
+
+
 class SmtpServer(models.Model):
     """
     All the needed information to connect to a SMTP server and send emails.
@@ -575,56 +810,57 @@ class SmtpServer(models.Model):
     use_tls = models.BooleanField(_("Use TLS"), default=False)
     use_ssl = models.BooleanField(_("Use SSL"), default=False)
 
+    max_messages_per_minute = models.PositiveIntegerField(_("Max messages per minute"), blank=True, null=True, help_text=_("Sending quota of the SMTP server. Leave it empty for no limit."))
+    max_messages_burst = models.PositiveIntegerField(_("Max messages in a burst"), default=1, help_text=_("Messages that can be sent at once before applying the rate limit."))
+
     def __str__(self):
         return '%s@%s:%s' % (self.username, self.ip_address, self.port)
 
+    def get_send_rate_limit(self, throttle_time=settings.WEBMAIL_MAILER_THROTTLE_TIME):
+        """
+        Returns a tuple with the max messages per second and the burst, or None
+        if sending through this server is not limited. Without a configured
+        rate, it's one message every `throttle_time` seconds.
+        """
+        if self.max_messages_per_minute:
+            return self.max_messages_per_minute / 60, max(self.max_messages_burst, 1)
+        elif throttle_time:
+            return 1 / throttle_time, 1
+        else:
+            return None
+
     def get_from_email_header_value(self):
         if self.from_name:
             return "%s <%s>" % (self.from_name, self.from_email)
         else:
             return self.from_email
 
-    def send_mail(self, recipient_list, multipart_mail_message):
-        from_email = self.get_from_email_header_value() or settings.WEBMAIL_DEFAULT_FROM_EMAIL
+    def get_connection(self):
+        """Returns an authenticated transport instance for this SMTP server."""
 
-        if self.use_ssl:
-            smtp = smtplib.SMTP_SSL(
-                keyfile = self.ssl_keyfile, certfile = self.ssl_certfile
+        conn = SmtpTransport(
+                self.ip_address,
+                port=self.port if self.port else None,
+                ssl=self.use_ssl,
+                tls=self.use_tls,
+                metrics_label=self.pk
             )
-        else:
-            smtp = smtplib.SMTP()
-
-        smtp.connect(host = self.ip_address or "localhost", port=self.port)
+        conn.connect(self.username, self.password)
 
+        return conn
 
-        # TLS/SSL are mutually exclusive, so only attempt TLS over
-        # non-secure connections.
-        if not self.use_ssl and self.use_tls:
-            smtp.ehlo()
-            smtp.starttls(keyfile = self.ssl_keyfile, certfile = self.ssl_certfile)
-            smtp.ehlo()
+    def get_sender_email(self):
+        return self.get_from_email_header_value() or settings.WEBMAIL_DEFAULT_FROM_EMAIL
 
-        # authenticate
-        smtp.login(user = self.username, password = self.password)
+    def send_mail(self, recipient_list, multipart_mail_message, connection_pool=None):
+        from_email = self.get_sender_email()
 
-        #
-        # Send email
-        #
-        statusdict = smtp.sendmail(
-            from_email,
-            recipient_list,
-            multipart_mail_message
-        )
+        if connection_pool is not None:
+            return connection_pool.send_mail(self, from_email, recipient_list, multipart_mail_message)
 
-        try:
-            smtp.quit()
-        except (ssl.SSLError, smtplib.SMTPServerDisconnected):
-            # This happens when calling quit() on a TLS connection
-            # sometimes, or when the connection was already disconnected
-            # by the server.
-            smtp.close()
-        
-        return statusdict
+        # The same session is used for all the chunks of recipients
+        with SmtpConnectionPool(idle_timeout=None) as connection_pool:
+            return connection_pool.send_mail(self, from_email, recipient_list, multipart_mail_message)
 
     class Meta:
         verbose_name = _('SMTP Server')
@@ -755,7 +991,8 @@ class Message(models.Model):
 
     message_id = models.CharField(
         _('Message ID'),
-        max_length=255
+        max_length=255,
+        db_index=True
     )
 
     in_reply_to = models.ForeignKey(
@@ -823,110 +1060,48 @@ class Message(models.Model):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._cached_email_message = None
-
-    @classmethod
-    def _get_email_content_decoded(cls, email_message):
-        payload = email_message.get_payload(decode=True)
-
-        charset = email_message.get_charset()
-        if not charset:
-            charset = 'ascii'
-
-        try:
-            # Make sure that the payload can be properly decoded in the
-            # defined charset, if it can't, let's mash some things
-            # inside the payload :-\
-            content = payload.decode(charset)
-        except LookupError:
-            logger.warning(
-                "Unknown encoding %s; interpreting as ASCII!",
-                charset
-            )
-            content = payload.decode(
-                'ascii',
-                'ignore'
-            )
-        except ValueError:
-            logger.warning(
-                "Decoding error encountered; interpreting %s as ASCII!",
-                charset
-            )
-            content = payload.decode(
-                'ascii',
-                'ignore'
-            )
-
-        return content
-
-    @classmethod
-    def _process_email_attachment(cls, attachment, msg_record, allowed_mimetypes=None):
-#            ctype, encoding = mimetypes.guess_type(attachment.file_attachment.path)
-
-#            if ctype is None or encoding is not None:
-#                ctype = 'application/octet-stream'
-
-        attachment_content_type = attachment.get_content_type()
-
-        if allowed_mimetypes is not None and not attachment_content_type in allowed_mimetypes:
-            return
-        else:
-            raw_filename = attachment.get_filename()
-
-            if raw_filename is None:
-                extension = mimetypes.guess_extension(attachment_content_type)
-
-                if not extension:
-                    extension = '.bin'
-
-                file_name = "unknown" + extension
-            else:
-                file_name = utils.convert_header_to_unicode(raw_filename)
-
-            record_attachment = MessageAttachment()
-            record_attachment.file_name = file_name
-
-            # TODO: Revisar esta parte
-            record_attachment.file.save(
-                uuid.uuid4().hex + extension,
-                ContentFile(
-                    BytesIO(
-                        attachment.get_payload(decode=True)
-                    ).getvalue()
-                )
-            )
-            record_attachment.message = msg_record
-
-#            headers = {}
-#            for key, value in attachment.items():
-#                headers[key] = value
-
-#            record_attachment.headers = headers
-            record_attachment.mimetype = attachment_content_type
-            record_attachment.save()
+        # Message-ID of the message it replies to, for the received messages
+        # not saved yet
+        self.in_reply_to_message_id = None
 
     @staticmethod
     def validate_email_message(email_message):
-        for header_name in ["From", "To", "Subject"]:
-            if header_name not in email_message:
-                raise InvalidEmailMessageException("This is header is mandatory: %s" % header_name, email_message)
+        invalid_reason = get_invalid_reason(email_message)
+        if invalid_reason is not None:
+            raise InvalidEmailMessageException(invalid_reason, email_message)
 
     @classmethod
-    def process_raw_email_message(cls, mailbox, email_message, folder_id=None, my_email_list=None):
+    def build_from_raw_email_message(cls, mailbox, email_message, folder_id=None, my_email_list=None):
+        """
+        Returns the unsaved record of a received email message and the list of
+        its attachments, without querying the database. They are saved by
+        `save_raw_email_messages`.
+        """
         cls.validate_email_message(email_message)
 
+        return cls.build_from_parsed_message(mailbox, parse_email_message(email_message), folder_id=folder_id, my_email_list=my_email_list)
+
+    @classmethod
+    def build_from_parsed_message(cls, mailbox, parsed_message, folder_id=None, my_email_list=None):
+        """
+        Like `build_from_raw_email_message`, for a `ParsedMessage`.
+        """
+        if parsed_message.invalid_reason is not None:
+            raise InvalidEmailMessageException(parsed_message.invalid_reason, parsed_message.get_headers_message())
+
         msg_record = cls()
 
         msg_record.mailbox = mailbox
-        if 'Subject' in email_message:
+        if 'Subject' in parsed_message:
             msg_record.subject = (
-                utils.convert_header_to_unicode(email_message['Subject'])[0:255]
+                utils.convert_header_to_unicode(parsed_message.get('Subject'))[0:255]
             )
 
-        if 'Message-Id' in email_message:
-            msg_record.message_id = email_message['Message-Id'][0:255].strip()
+        if 'Message-Id' in parsed_message:
+            msg_record.message_id = parsed_message.get('Message-Id')[0:255].strip()
 
-        if 'From' in email_message:
-            from_header = utils.convert_header_to_unicode(email_message['From'])
+        if 'From' in parsed_message:
+            from_header = utils.convert_header_to_unicode(parsed_message.get('From'))
 
             from_email = parseaddr(from_header)[1].lower()
             msg_record.from_email = from_email
@@ -937,8 +1112,8 @@ class Message(models.Model):
                         msg_record.from_me = True
                         break
 
-        if 'To' in email_message:            
-            to_header = utils.convert_header_to_unicode(email_message['To'])
+        if 'To' in parsed_message:
+            to_header = utils.convert_header_to_unicode(parsed_message.get('To'))
 
             msg_record.to = parse_addresses_from_header(to_header)
 
@@ -951,57 +1126,124 @@ class Message(models.Model):
                         msg_record.to_me_email = my_email
                         break
 
-        elif 'Delivered-To' in email_message:
+        elif 'Delivered-To' in parsed_message:
             delivered_to_header = utils.convert_header_to_unicode(
-                email_message['Delivered-To']
+                parsed_message.get('Delivered-To')
             )
             msg_record.to = parse_addresses_from_header(delivered_to_header)
 
-        if 'CC' in email_message:            
+        if 'CC' in parsed_message:
             cc_header = utils.convert_header_to_unicode(
-                email_message['CC']
+                parsed_message.get('CC')
             )
             msg_record.cc = parse_addresses_from_header(cc_header)
 
-        if 'BCC' in email_message:            
-            bcc = utils.convert_header_to_unicode(
-                email_message['BCC']
+        if 'BCC' in parsed_message:
+            bcc_header = utils.convert_header_to_unicode(
+                parsed_message.get('BCC')
             )
             msg_record.bcc = parse_addresses_from_header(bcc_header)
 
-        plain_text_body = email_message.get_body(preferencelist=('plain'))
-        html_body = email_message.get_body(preferencelist=('html'))
-
-        if plain_text_body is not None:
-            msg_record.text_plain = cls._get_email_content_decoded(plain_text_body)
+        msg_record.text_plain = parsed_message.text_plain
+        msg_record.html = parsed_message.html
 
-        if html_body is not None:
-            msg_record.html = cls._get_email_content_decoded(html_body)
-
-        if email_message['In-Reply-To']:
-            try:
-                msg_record.in_reply_to = Message.objects.get(
-                    message_id=email_message['In-Reply-To'].strip()
-                )
-            except Message.DoesNotExist:
-                pass
+        # Resolved when saved
+        if parsed_message.get('In-Reply-To'):
+            msg_record.in_reply_to_message_id = parsed_message.get('In-Reply-To').strip()
+        else:
+            msg_record.in_reply_to_message_id = None
 
         msg_record.folder_id = folder_id
 
         msg_record.original_email_headers = {
             k.capitalize(): str(email.header.make_header(email.header.decode_header(s)))
-            for k,s in email_message.items()
+            for k,s in parsed_message.headers
         }
-        msg_record.save()
 
-        if email_message.is_multipart():
-            if settings.WEBMAIL_STRIP_UNALLOWED_MIMETYPES and settings.WEBMAIL_ALLOWED_MIMETYPES is not None:
-                allowed_mimetypes = settings.WEBMAIL_ALLOWED_MIMETYPES
+        attachments = []
 
-            for attachment in email_message.iter_attachments():
-                cls._process_email_attachment(attachment, msg_record, allowed_mimetypes=allowed_mimetypes)
+        for parsed_attachment in parsed_message.attachments:
+            record_attachment = MessageAttachment()
+            record_attachment.file_name = parsed_attachment.file_name
+            record_attachment.mimetype = parsed_attachment.mimetype
 
-        return msg_record
+            attachments.append((record_attachment, uuid.uuid4().hex + parsed_attachment.get_extension(), parsed_attachment))
+
+        return msg_record, attachments
+
+    @classmethod
+    def save_raw_email_messages(cls, built_messages):
+        """
+        Saves in one transaction the messages returned by
+        `build_from_raw_email_message`, a list of tuples with the message
+        record and its attachments. The messages they reply to are looked up
+        in one query, and the messages and the attachments are inserted in
+        bulk.
+
+        Returns the list of saved messages.
+        """
+        msg_records = [msg_record for msg_record, _attachments in built_messages]
+
+        in_reply_to_message_ids = {msg_record.in_reply_to_message_id for msg_record in msg_records if msg_record.in_reply_to_message_id}
+
+        written_attachments = []
+
+        try:
+            with transaction.atomic():
+                replied_messages = {}
+                if in_reply_to_message_ids:
+                    for message_id, pk in Message.objects.filter(message_id__in=in_reply_to_message_ids).values_list("message_id", "id"):
+                        replied_messages.setdefault(message_id, pk)
+
+                for msg_record in msg_records:
+                    msg_record.in_reply_to_id = replied_messages.get(msg_record.in_reply_to_message_id)
+
+                if connections[Message.objects.db].features.can_return_rows_from_bulk_insert:
+                    Message.objects.bulk_create(msg_records)
+                else:
+                    for msg_record in msg_records:
+                        msg_record.save()
+
+                # Replies to messages of the same batch
+                batch_messages = {}
+                for msg_record in msg_records:
+                    if msg_record.message_id:
+                        batch_messages.setdefault(msg_record.message_id, msg_record)
+
+                batch_replies = []
+                for msg_record in msg_records:
+                    if msg_record.in_reply_to_id is None and msg_record.in_reply_to_message_id in batch_messages:
+                        msg_record.in_reply_to = batch_messages[msg_record.in_reply_to_message_id]
+                        batch_replies.append(msg_record)
+
+                if batch_replies:
+                    Message.objects.bulk_update(batch_replies, ["in_reply_to"])
+
+                for msg_record, attachments in built_messages:
+                    for record_attachment, storage_name, parsed_attachment in attachments:
+                        record_attachment.message = msg_record
+                        with parsed_attachment.open() as f:
+                            record_attachment.file.save(storage_name, f, save=False)
+                        written_attachments.append(record_attachment)
+
+                if written_attachments:
+                    MessageAttachment.objects.bulk_create(written_attachments)
+        except BaseException:
+            # The files of the attachments are not transactional
+            for record_attachment in written_attachments:
+                record_attachment.file.delete(save=False)
+            raise
+        finally:
+            for _msg_record, attachments in built_messages:
+                for _record_attachment, _storage_name, parsed_attachment in attachments:
+                    parsed_attachment.discard()
+
+        return msg_records
+
+    @classmethod
+    def process_raw_email_message(cls, mailbox, email_message, folder_id=None, my_email_list=None):
+        built_message = cls.build_from_raw_email_message(mailbox, email_message, folder_id=folder_id, my_email_list=my_email_list)
+        return cls.save_raw_email_messages([built_message])[0]
 
     @property
     def folder(self):
@@ -1120,10 +1362,13 @@ class Message(models.Model):
             return msg
 
     # build_message
-    def prepare_email_message(self):
+    def prepare_email_message(self, stream_attachments=False):
         """
         Returns a django ``EmailMessage`` or django ``EmailMultiAlternatives`` object,
         depending on whether html is empty.
+
+        With `stream_attachments`, the attachments are not read: they are
+        written from their files with `mime_writer.write_message`.
         """
 
 #        mail = DjangoEmailMultiAlternatives(subject, message, self.from_email, recipient_list, connection=connection)
@@ -1142,8 +1387,7 @@ class Message(models.Model):
             if text_plain is not None:
                 msg = DjangoEmailMultiAlternatives(
                     subject=self.subject, body=text_plain, from_email=self.from_email,
-                    to=self.to, bcc=self.bcc, cc=self.cc,
-                    connection=connection)
+                    to=self.to, bcc=self.bcc, cc=self.cc)
                 msg.attach_alternative(self.html, "text/html")
             else:
                 msg = DjangoEmailMessage(
@@ -1159,8 +1403,11 @@ class Message(models.Model):
 
         # TODO: Comprobar como se lee un archivo
         for attachment in self.attachments.all():
-            msg.attach(attachment.file_name, attachment.file.read(), mimetype=attachment.mimetype or None)
-            attachment.file.close()
+            if stream_attachments and can_stream_attachment(attachment.mimetype):
+                msg.attach(StreamedAttachmentPart(attachment.file, attachment.file_name, mimetype=attachment.mimetype or None))
+            else:
+                msg.attach(attachment.file_name, attachment.file.read(), mimetype=attachment.mimetype or None)
+                attachment.file.close()
 
         if self.message_id:
             msg.extra_headers['Message-Id'] = self.message_id
@@ -1168,7 +1415,8 @@ class Message(models.Model):
         if self.in_reply_to and self.in_reply_to.message_id:
             msg.extra_headers['In-Reply-To'] = self.in_reply_to.message_id
 
-        self._cached_email_message = msg
+        if not stream_attachments:
+            self._cached_email_message = msg
 
         return msg
 
@@ -1180,7 +1428,7 @@ class Message(models.Model):
         while True:
             try:
                 Message.objects.get(message_id=uid + str(i))
-            except Message.DoesNotExists:
+            except Message.DoesNotExist:
                 uid = uid + str(i)
 
                 break
@@ -1221,7 +1469,11 @@ class Message(models.Model):
 
         logger.info("Adding message to task queue.")
 
-        SendMailTask.objects.create_from_message(message=self, priority=priority)
+        send_mail_task = SendMailTask.objects.create_from_message(message=self, priority=priority)
+
+        message_queued_signal.send(sender=Message, message=self, send_mail_task=send_mail_task)
+
+        return send_mail_task
 
 
     def to_dict(self):
@@ -1395,16 +1647,50 @@ class UploadAttachmentSession(models.Model):
 
 class SendMailTaskManager(models.Manager):
     def create_from_message(self, message, priority=None):
-        multipart_mail_message = message.email_message.message().as_bytes(linesep='\r\n')
+        """
+        Queues the message. Its MIME payload is written to the spool, or
+        stored in the task itself if `WEBMAIL_MAILER_SPOOL_DIR` is not set.
+        """
+        # The attachments are encoded in chunks while written
+        email_message = message.prepare_email_message(stream_attachments=True).message()
+
+        mail_spool = MailSpool()
+
+        if mail_spool.is_enabled:
+            with mail_spool.create() as writer:
+                write_message(writer, email_message)
+                spool_ref, payload_size = writer.commit()
+
+            multipart_mail_message = None
+        else:
+            buffer = BytesIO()
+            write_message(buffer, email_message)
+            multipart_mail_message = buffer.getvalue()
+
+            spool_ref = None
+            payload_size = len(multipart_mail_message)
 
         if priority is None:
             priority = SendMailTask.PRIORITY_MEDIUM
 
+        try:
+            sender_email = message.mailbox.smtp_server.get_sender_email()
+        except SmtpServer.DoesNotExist:
+            sender_email = message.from_email
+
+        email_recipients = message.recipients
+
         return super().create(
             mailbox=message.mailbox,
-            email_recipients=message.recipients,
+            email_recipients=email_recipients,
+            subject=message.subject,
+            envelope_sender=parseaddr(sender_email)[1],
+            num_recipients=len(email_recipients),
             multipart_mail_message = multipart_mail_message,
-            priority=priority)
+            spool_ref=spool_ref,
+            payload_size=payload_size,
+            priority=priority,
+            scheduled_time=timezone.now())
 
     def high_priority(self):
         """
@@ -1428,32 +1714,212 @@ class SendMailTaskManager(models.Manager):
         """
         the messages in the queue not deferred
         """
-        return self.filter(
-                    status=SendMailTask.STATUS_QUEUED) \
-                .filter(
-                    Q(scheduled_time__lte=timezone.now()) | Q(scheduled_time=None))
+        # Range scan of the index on (status, scheduled_time, priority,
+        # created_at). All the queued tasks have a scheduled time.
+        return self.filter(status=SendMailTask.STATUS_QUEUED, scheduled_time__lte=timezone.now())
 
     def deferred(self):
         """
         the deferred messages in the queue
         """
-        return self.filter(
-                    status=SendMailTask.STATUS_QUEUED) \
-                .filter(
-                    scheduled_time__isnull=False, scheduled_time__gt=timezone.now())
+        return self.filter(status=SendMailTask.STATUS_QUEUED, scheduled_time__gt=timezone.now())
+
+    def claim(self, limit=1, lease_duration=settings.WEBMAIL_MAILER_LEASE_DURATION, scheduler=None):
+        """
+        Atomically claims the next `limit` eligible tasks chosen by `scheduler`
+        (see `send_scheduler`), by default ordered by priority and creation
+        date, and marks them as in progress with a lease of `lease_duration`
+        seconds.
+
+        Returns a tuple with the lease token and the list of claimed tasks.
+        Tasks whose lease expires before being processed return to the queue
+        with `requeue_expired_leases`.
+
+        Other processes claiming at the same time skip the locked rows on
+        databases supporting `SELECT ... FOR UPDATE SKIP LOCKED`. On the others,
+        only the tasks still queued when updated are claimed.
+        """
+        lease_token = uuid.uuid4().hex
+        lease_expires_at = timezone.now() + datetime.timedelta(seconds=lease_duration)
+
+        skip_locked = connections[self.db].features.has_select_for_update_skip_locked
+
+        if scheduler is None:
+            scheduler = FifoSendScheduler()
+
+        while True:
+            # Without row locks, the condition on the status of the update is
+            # enough to claim each task only once, and a transaction would only
+            # make concurrent claims fail on databases like SQLite.
+            with transaction.atomic(using=self.db) if skip_locked else contextlib.nullcontext():
+                # The payload of the tasks not spooled is loaded only when sent
+                queryset = self.non_deferred().defer("multipart_mail_message")
+
+                tasks = scheduler.select(queryset, limit, skip_locked=skip_locked)
+                if not tasks:
+                    return lease_token, []
+
+                # The scheduled time is kept in case the task returns to the
+                # queue
+                num_claimed = self.filter(id__in=[task.id for task in tasks], status=SendMailTask.STATUS_QUEUED).update(
+                    status=SendMailTask.STATUS_IN_PROGRESS,
+                    lease_token=lease_token,
+                    lease_expires_at=lease_expires_at)
+
+            if num_claimed == len(tasks):
+                break
+
+            # Some tasks were claimed by others in the meantime
+            claimed_ids = set(self.filter(lease_token=lease_token).values_list("id", flat=True))
+            tasks = [task for task in tasks if task.id in claimed_ids]
+
+            if tasks:
+                break
+
+            # All of them were taken by others, try with the next ones
+
+        for task in tasks:
+            task.status = SendMailTask.STATUS_IN_PROGRESS
+            task.lease_token = lease_token
+            task.lease_expires_at = lease_expires_at
+
+        return lease_token, tasks
+
+    def extend_lease(self, lease_token, lease_duration=settings.WEBMAIL_MAILER_LEASE_DURATION):
+        """
+        Heartbeat of the process sending the tasks claimed with `lease_token`.
+        """
+        return self.filter(lease_token=lease_token, status=SendMailTask.STATUS_IN_PROGRESS).update(
+            lease_expires_at=timezone.now() + datetime.timedelta(seconds=lease_duration))
 
-    def purge_old_entries(self, days):
+    def release_lease(self, lease_token):
+        """
+        Returns to the queue the tasks claimed with `lease_token` that are not
+        processed yet.
+        """
+        return self.filter(lease_token=lease_token, status=SendMailTask.STATUS_IN_PROGRESS).update(
+            status=SendMailTask.STATUS_QUEUED,
+            lease_token=None,
+            lease_expires_at=None)
+
+    def requeue_expired_leases(self):
+        """
+        Returns to the queue the tasks claimed by processes that died or hang
+        before processing them.
+        """
+        return self.filter(status=SendMailTask.STATUS_IN_PROGRESS, lease_expires_at__lt=timezone.now()).update(
+            status=SendMailTask.STATUS_QUEUED,
+            lease_token=None,
+            lease_expires_at=None)
+
+    def next_scheduled_time(self):
+        """
+        Returns when the next queued task will be eligible for sending, or None
+        if the queue is empty.
+        """
+        return self.filter(status=SendMailTask.STATUS_QUEUED).aggregate(
+            next_scheduled_time=Min("scheduled_time"))["next_scheduled_time"]
+
+    def purge_old_entries(self, days, chunk_size=settings.WEBMAIL_MAILER_PURGE_CHUNK_SIZE, pause=settings.WEBMAIL_MAILER_PURGE_PAUSE, max_runtime=None, progress_callback=None):
+        """
+        Deletes the completed and failed tasks last sent more than `days` days
+        ago and the cancelled tasks, with their batches, exception logs and
+        failed recipients.
+
+        The tasks are deleted in chunks of at most `chunk_size`, each one in
+        its own transaction, waiting `pause` seconds between chunks, so the
+        tables are never locked for long while other processes are sending.
+        If `max_runtime` is set, it stops after that many seconds, and the next
+        purge goes on with the rest. `progress_callback` is called after each
+        chunk with the number of tasks deleted so far.
+
+        Returns the number of tasks deleted.
+        """
         last_sent_date_limit = timezone.now() - datetime.timedelta(days=days)
-        query = self.filter(
-            Q(last_sent_at__lt=last_sent_date_limit) | Q(status=SendMailTask.STATUS_CANCELLED)
-        ).exclude(status__in=[SendMailTask.STATUS_QUEUED, SendMailTask.STATUS_IN_PROGRESS])
 
-        count = query.count()
-        query.delete()
+        # Both conditions are served by the index on the status and the last
+        # sent date
+        querysets = [
+            self.filter(status__in=[SendMailTask.STATUS_COMPLETED, SendMailTask.STATUS_FAILED], last_sent_at__lt=last_sent_date_limit),
+            self.filter(status=SendMailTask.STATUS_CANCELLED),
+        ]
+
+        start_time = time.monotonic()
+        count = 0
+
+        for queryset in querysets:
+            while True:
+                if max_runtime is not None and time.monotonic() - start_time >= max_runtime:
+                    return count
+
+                task_ids = list(queryset.values_list("id", flat=True)[:chunk_size])
+                if not task_ids:
+                    break
+
+                # The conditions are checked again when deleting, in case a task
+                # was queued again in the meantime. The payload is not loaded.
+                _total, num_deleted_by_model = queryset.filter(id__in=task_ids).defer("multipart_mail_message").delete()
+                count += num_deleted_by_model.get(SendMailTask._meta.label, 0)
+
+                if progress_callback is not None:
+                    progress_callback(count)
+
+                if len(task_ids) < chunk_size:
+                    break
+
+                if pause:
+                    time.sleep(pause)
+
+        return count
+
+    def delete_orphan_spool_payloads(self, min_age=3600):
+        """
+        Removes the payloads of the spool not referenced by any task, left by
+        transactions rolled back after writing them. Only files older than
+        `min_age` seconds are considered, so the ones being queued right now
+        are not removed.
+        """
+        mail_spool = MailSpool()
+        if not mail_spool.is_enabled:
+            return 0
+
+        count = 0
+
+        for spool_refs in utils.chunked(mail_spool.iter_refs(min_age=min_age), 500):
+            referenced = set(self.filter(spool_ref__in=spool_refs).values_list("spool_ref", flat=True))
+
+            for spool_ref in spool_refs:
+                if spool_ref not in referenced:
+                    mail_spool.delete(spool_ref)
+                    count += 1
+
         return count
 
 
 # OutboundMessageQueueModel, SendMailQueueModel, MailQueueModel, SendMailModel
+class _ImmediateOutcomeWriter:
+    """
+    Writes the results of a delivery attempt right away, when no
+    `SendOutcomeWriter` is used.
+    """
+
+    def add(self, obj):
+        obj.save()
+
+    def add_all(self, objs):
+        if objs:
+            type(objs[0]).objects.bulk_create(objs)
+
+    def update_task(self, task, update_fields):
+        task.save(update_fields=update_fields)
+
+    def delete_task(self, task):
+        task.delete()
+
+
+_immediate_outcome_writer = _ImmediateOutcomeWriter()
+
+
 class SendMailTask(models.Model):
     PRIORITY_HIGH = 1
     PRIORITY_MEDIUM = 2
@@ -1483,7 +1949,18 @@ class SendMailTask(models.Model):
     email_recipients = CommaSeparatedEmailField()
 
     # message_data, encoded_mimeparts, serialized_email
-    multipart_mail_message = models.BinaryField()
+    # Only used when the spool is disabled
+    multipart_mail_message = models.BinaryField(blank=True, null=True)
+
+    # Reference of the MIME payload in the spool (see `mail_spool`)
+    spool_ref = models.CharField(_("Spool reference"), max_length=80, blank=True, null=True, db_index=True, editable=False)
+    payload_size = models.PositiveBigIntegerField(_("Payload size"), blank=True, null=True, editable=False)
+
+    # Copied from the message when queued, so they can be listed without
+    # parsing the payload
+    subject = models.CharField(_("Subject"), max_length=1000, blank=True, default="", editable=False)
+    envelope_sender = models.CharField(_("Envelope sender"), max_length=254, blank=True, default="", editable=False)
+    num_recipients = models.PositiveIntegerField(_("Number of recipients"), default=0, editable=False)
 
     # when_added
     created_at = models.DateTimeField(auto_now_add=True)
@@ -1498,18 +1975,31 @@ class SendMailTask(models.Model):
     # num_retries
     num_deferred_times = models.PositiveSmallIntegerField(_("Number of times deferred"), default=0, db_index=True)
     # deferred_at
+    # When the task can be sent. Set for all the queued tasks.
     scheduled_time = models.DateTimeField(_('The scheduled sending time'),
-                                          blank=True, null=True, db_index=True)
+                                          default=timezone.now, blank=True, null=True, db_index=True)
 
     last_sent_at = models.DateTimeField(blank=True, null=True)
     last_sent_succeed = models.BooleanField(blank=True, null=True, db_index=True)
 
+    # Set when a sending process claims the task. The task returns to the
+    # queue if the lease expires before being processed.
+    lease_token = models.CharField(_("Lease token"), max_length=32, blank=True, null=True, db_index=True, editable=False)
+    lease_expires_at = models.DateTimeField(_("Lease expires at"), blank=True, null=True, db_index=True, editable=False)
+
     objects = SendMailTaskManager()
 
     class Meta:
         verbose_name = _("Send Mail Task")
         verbose_name_plural = _("Send Email Task Queue")
 
+        indexes = [
+            # Next eligible tasks of the queue
+            models.Index(fields=["status", "scheduled_time", "priority", "created_at"], name="webmail_sendtask_eligible_idx"),
+            # Old tasks to purge
+            models.Index(fields=["status", "last_sent_at"], name="webmail_sendtask_purge_idx"),
+        ]
+
     def is_done(self):
         return self.status in (self.STATUS_COMPLETED, self.STATUS_FAILED, self.STATUS_CANCELLED) 
 
@@ -1518,48 +2008,101 @@ class SendMailTask(models.Model):
 
     def set_status_queued(self):
         self.status = self.STATUS_QUEUED
-        self.scheduled_time = None
+        self.scheduled_time = timezone.now()
+        self.lease_token = None
+        self.lease_expires_at = None
 
-        self.save(update_fields=("status", "scheduled_time"))
+        self.save(update_fields=("status", "scheduled_time", "lease_token", "lease_expires_at"))
 
-    def set_status_in_progress(self):
-        self.status = self.STATUS_IN_PROGRESS
-        self.scheduled_time = None
-
-        self.save(update_fields=("status", "scheduled_time"))
+    def set_status_completed(self, outcome_writer=None):
+        if outcome_writer is None:
+            outcome_writer = _immediate_outcome_writer
 
-    def set_status_completed(self):
         self.status = self.STATUS_COMPLETED
         self.scheduled_time = None
+        self.lease_token = None
+        self.lease_expires_at = None
+
+        outcome_writer.update_task(self, ("status", "scheduled_time", "lease_token", "lease_expires_at"))
 
-        self.save(update_fields=("status", "scheduled_time"))
+    def set_status_failed(self, outcome_writer=None):
+        if outcome_writer is None:
+            outcome_writer = _immediate_outcome_writer
 
-    def set_status_failed(self):
         self.status = self.STATUS_FAILED
         self.scheduled_time = None
+        self.lease_token = None
+        self.lease_expires_at = None
 
-        self.save(update_fields=("status", "scheduled_time"))
+        outcome_writer.update_task(self, ("status", "scheduled_time", "lease_token", "lease_expires_at"))
 
     def set_status_cancelled(self):
         self.status = self.STATUS_CANCELLED
         self.scheduled_time = None
+        self.lease_token = None
+        self.lease_expires_at = None
 
-        self.save(update_fields=("status", "scheduled_time"))
+        self.save(update_fields=("status", "scheduled_time", "lease_token", "lease_expires_at"))
+
+    def postpone(self, seconds):
+        """
+        Returns the task to the queue to be sent again after `seconds`. Unlike
+        `defer`, it doesn't count as a failed delivery attempt.
+        """
+        self.status = self.STATUS_QUEUED
+        self.scheduled_time = timezone.now() + datetime.timedelta(seconds=seconds)
+        self.lease_token = None
+        self.lease_expires_at = None
+        self.save(update_fields=("status", "scheduled_time", "lease_token", "lease_expires_at"))
+
+    def defer(self, outcome_writer=None, **kw):
+        if outcome_writer is None:
+            outcome_writer = _immediate_outcome_writer
 
-    def defer(self, **kw):
         self.status = self.STATUS_QUEUED
         self.scheduled_time = timezone.now() + datetime.timedelta(**kw)
         self.num_deferred_times += 1
-        self.save(update_fields=("status", "num_deferred_times", "scheduled_time",))
+        self.lease_token = None
+        self.lease_expires_at = None
+        outcome_writer.update_task(self, ("status", "num_deferred_times", "scheduled_time", "lease_token", "lease_expires_at"))
 
     def __str__(self):
         return str(self.id)
 
+    def get_mail_payload(self):
+        """
+        Returns the MIME payload, either bytes or a `SpooledMailMessage` to be
+        read from the spool.
+        """
+        if self.spool_ref:
+            return MailSpool().get_message(self.spool_ref, self.payload_size)
+        else:
+            return self.multipart_mail_message
+
     def _get_email_message(self):
-        return message_from_string(self.multipart_mail_message)
+        payload = self.get_mail_payload()
+        if payload is None:
+            return None
+
+        if not isinstance(payload, (bytes, memoryview)):
+            payload = payload.read()
+
+        return message_from_bytes(bytes(payload))
 
     def _set_email_message(self, email_message):
-        self.multipart_mail_message = email_message.as_bytes(linesep='\r\n')
+        multipart_mail_message = email_message.as_bytes(linesep='\r\n')
+
+        mail_spool = MailSpool()
+
+        if mail_spool.is_enabled:
+            self.spool_ref, self.payload_size = mail_spool.store(multipart_mail_message)
+            self.multipart_mail_message = None
+        else:
+            self.multipart_mail_message = multipart_mail_message
+            self.spool_ref = None
+            self.payload_size = len(multipart_mail_message)
+
+        self.subject = utils.convert_header_to_unicode(email_message.get("Subject", ""))[0:1000]
 
     email_message = property(
         _get_email_message,
@@ -1569,23 +2112,16 @@ set the attribute again to cause the underlying serialised data to be updated.""
 
     @property
     def to_addresses(self):
-        email_message = self.email_message
-        if email_message is not None:
-            return email_message.to
-        else:
-            return []
+        return self.email_recipients
 
-    @property
-    def subject(self):
-        email_message = self.email_message
-        if email_message is not None:
-            return email_message.subject
-        else:
-            return ""
-
-    def send(self, notify_failure=False, max_retries=settings.WEBMAIL_MAX_RETRIES_SEND_MAIL, wait_time_next_retry=settings.WEBMAIL_WAIT_TIME_NEXT_RETRY_SEND_MAIL):
+    def get_smtp_server(self):
+        """
+        Returns the SMTP server of the mailbox. If it's not configured, a
+        message is left in the inbox of the mailbox and
+        `NoSmtpServerConfiguredException` is raised.
+        """
         try:
-            smtp_server = self.mailbox.smtp_server
+            return self.mailbox.smtp_server
         except SmtpServer.DoesNotExist:
             logger.error("No smtp server configured for mailbox %d" % self.mailbox.id)
 
@@ -1594,66 +2130,254 @@ set the attribute again to cause the underlying serialised data to be updated.""
 
             raise NoSmtpServerConfiguredException()
 
+    def get_recipient_domains(self):
+        return {recipient.rpartition("@")[2].lower() for recipient in self.email_recipients}
+
+    def get_pending_recipients(self):
+        """
+        Returns the recipients of the next delivery attempt: all of them the
+        first time, and then the ones to retry from the previous attempt (see
+        `record_send_result`).
+        """
+        if self.num_deferred_times == 0:
+            return self.email_recipients
+
+        retry_recipients = set(SendMailTaskErrorRecipient.objects.filter(
+            task_batch__task=self,
+            task_batch__num_batch=self.num_deferred_times - 1,
+            retry=True).values_list("recipient", flat=True))
+
+        if not retry_recipients:
+            # Deferred before the recipients to retry were saved
+            return self.email_recipients
+
+        return [recipient for recipient in self.email_recipients if recipient in retry_recipients]
+
+    def start_batch(self, recipient_list=None, outcome_writer=None):
+        """
+        Returns the `SendMailTaskBatch` of a new delivery attempt. With an
+        `outcome_writer`, it's saved by the writer with the rest of the results
+        of the attempt.
+        """
+        if recipient_list is None:
+            recipient_list = self.email_recipients
+
+        if outcome_writer is None:
+            outcome_writer = _immediate_outcome_writer
+
         logger.info("Starting sending mail task #%s..." % self.id)
+        logger.info("Sending email to %s" % ", ".join(recipient_list))
 
-        multipart_mail_message = self.multipart_mail_message
+        batch = SendMailTaskBatch(task=self, num_batch=self.num_deferred_times)
+        outcome_writer.add(batch)
 
-        logger.info("Sending email to %s" % ", ".join(self.email_recipients))
-        batch = SendMailTaskBatch.objects.create(task=self, num_batch=self.num_deferred_times)
+        return batch
 
-        recipients_with_errors = None
+    @staticmethod
+    def _get_failed_recipients(recipient_list, exception):
+        """
+        Returns a list of tuples with the recipient, the error code (None if
+        there is no SMTP reply) and the response, for the recipients not sent
+        because of `exception`, and whether the error is permanent.
+        """
+        if isinstance(exception, SMTPRecipientChunksFailed):
+            failed_recipients = []
+            for chunk, chunk_exception in exception.failed_chunks:
+                failed_recipients.extend(SendMailTask._get_failed_recipients(chunk, chunk_exception))
 
-        try:
-            recipients_with_errors = smtp_server.send_mail(self.email_recipients, multipart_mail_message)
-        #except (OSError, smtplib.SMTPException) as e:
-        except Exception as e:
+            return failed_recipients
+
+        if isinstance(exception, smtplib.SMTPRecipientsRefused):
+            failed_recipients = []
+            for recipient in recipient_list:
+                # The server closes the connection after a 421 reply, the
+                # next recipients are not answered
+                code, response = exception.recipients.get(recipient, (None, str(exception)))
+                failed_recipients.append((recipient, code, response, code is not None and 500 <= code < 600))
+
+            return failed_recipients
+
+        code = getattr(exception, "smtp_code", None)
+        response = getattr(exception, "smtp_error", str(exception))
+        is_permanent = classify_send_error(exception) == PERMANENT_ERROR
+
+        return [(recipient, code, response, is_permanent) for recipient in recipient_list]
+
+    def record_send_result(self, batch, recipient_list=None, recipients_with_errors=None, exception=None, notify_failure=False, outcome_writer=None):
+        """
+        Saves the result of the delivery attempt `batch` to `recipient_list`
+        (all the recipients by default): the exception raised sending the
+        message, if any, and the recipients refused by the server.
+
+        The recipients not sent because of the exception are saved too. If the
+        message is sent in several transactions, only the recipients of the
+        failed ones. Unless `notify_failure` is set because there will be no
+        more attempts, the recipients that failed with a temporary error are
+        retried in the next attempt.
+
+        The results are written by `outcome_writer`, if provided, otherwise
+        right away.
+
+        Returns True if the message was sent.
+        """
+        if recipient_list is None:
+            recipient_list = self.email_recipients
+
+        if outcome_writer is None:
+            outcome_writer = _immediate_outcome_writer
+
+        retry_recipients = set()
+
+        if exception is None:
+            last_sent_succeed = True
+        else:
             # TODO: Check OSError: [Errno 101] Network is unreachable. e.errno == 101
 
             last_sent_succeed = False
 
-            if isinstance(e, smtplib.SMTPRecipientsRefused):
-                recipients_with_errors = e.recipients
+            if isinstance(exception, SMTPRecipientChunksFailed):
+                # Refused in the transactions accepted by the server
+                recipients_with_errors = dict(exception.refused_recipients)
+            else:
+                recipients_with_errors = {}
+
+            for recipient, code, response, is_permanent in self._get_failed_recipients(recipient_list, exception):
+                recipients_with_errors[recipient] = (code, response)
+
+                if not notify_failure and not is_permanent:
+                    retry_recipients.add(recipient)
 
-            exception_message = str(e)
-            exception_type = type(e).__name__
+            exception_message = str(exception)
+            exception_type = type(exception).__name__
 
-            py_traceback = '\n'.join(traceback.format_exception(*sys.exc_info()))
+            py_traceback = '\n'.join(traceback.format_exception(type(exception), exception, exception.__traceback__))
 
             logger.warning("Exception sending message task '%s'. Exception type: %s. Exception message: %s. Traceback:\n%s" % (self.pk, exception_type, exception_message, py_traceback))
 
-            SendMailTaskExceptionLog.objects.create(
+            outcome_writer.add(SendMailTaskExceptionLog(
                 task_batch=batch,
                 exception_type=exception_type,
                 exception_message=exception_message,
                 py_traceback=py_traceback
-            )
-        else:
-            last_sent_succeed = True
+            ))
 
         self.last_sent_at = timezone.now()
         self.last_sent_succeed = last_sent_succeed
-        self.save(update_fields=["last_sent_at", "last_sent_succeed"])
+        outcome_writer.update_task(self, ["last_sent_at", "last_sent_succeed"])
 
         if recipients_with_errors is not None and len(recipients_with_errors) != 0:
+            error_recipients = []
             for error_recipient_email, error_status in recipients_with_errors.items():
                 code, response = error_status
-                SendMailTaskErrorRecipient.objects.create(task_batch=batch, recipient=error_recipient_email, code=code, response=response)
+                if code is not None and code < 0:
+                    # smtplib uses negative codes for connection errors
+                    code = None
 
-            if len(recipients_with_errors) == len(self.email_recipients):
-                if notify_failure:
-                    body = _("Error sending mail!")
-                else:
-                    body = None       
+                error_recipients.append(SendMailTaskErrorRecipient(task_batch=batch, recipient=error_recipient_email, code=code, response=response, retry=error_recipient_email in retry_recipients))
+
+            outcome_writer.add_all(error_recipients)
+
+            # The recipients to retry are notified if the last attempt fails
+            recipient_errors = [recipient for recipient in recipients_with_errors if recipient not in retry_recipients]
+
+            if len(recipient_errors) == 0:
+                body = None
+            elif len(recipient_errors) == len(self.email_recipients):
+                body = _("Error sending mail!")
             else:
                 body = _("Error sending mail to some recipients!")
 
             if body is not None:
                 recipient_errors_text = get_text_list(recipient_errors, last_word=_("and"))
 
-                Message.objects.create(mailbox=self.mailbox, folder_id=Message.INBOX_FOLDER_ID, from_email=settings.WEBMAIL_EMAIL_FOR_ERROR_NOTIFICATION, to=recipient_errors, subject=_("Error email delivery to {recipients}").format(recipients=recipient_errors_text), text_plain=body)
+                outcome_writer.add(Message(mailbox=self.mailbox, folder_id=Message.INBOX_FOLDER_ID, from_email=settings.WEBMAIL_EMAIL_FOR_ERROR_NOTIFICATION, to=recipient_errors, subject=_("Error email delivery to {recipients}").format(recipients=recipient_errors_text), text_plain=body))
 
         return last_sent_succeed
 
+    def send(self, notify_failure=False, max_retries=settings.WEBMAIL_MAX_RETRIES_SEND_MAIL, wait_time_next_retry=settings.WEBMAIL_WAIT_TIME_NEXT_RETRY_SEND_MAIL, connection_pool=None):
+        smtp_server = self.get_smtp_server()
+
+        recipient_list = self.get_pending_recipients()
+        batch = self.start_batch(recipient_list)
+
+        recipients_with_errors = None
+        exception = None
+
+        try:
+            recipients_with_errors = smtp_server.send_mail(recipient_list, self.get_mail_payload(), connection_pool=connection_pool)
+        #except (OSError, smtplib.SMTPException) as e:
+        except Exception as e:
+            exception = e
+
+        return self.record_send_result(batch, recipient_list, recipients_with_errors=recipients_with_errors, exception=exception, notify_failure=notify_failure)
+
+
+class SendRateLimitBucketManager(models.Manager):
+    def acquire(self, key, rate, burst=1):
+        """
+        Takes one token of the bucket `key`, refilled with `rate` tokens per
+        second up to `burst` tokens. Returns 0 if the token was taken,
+        otherwise the seconds to wait until the next one is available.
+
+        It's the generic cell rate algorithm: the bucket only stores its
+        theoretical arrival time, and the token is taken with a conditional
+        update, so the same bucket can be shared by several processes.
+        """
+        emission_interval = 1 / rate
+        delay_tolerance = emission_interval * burst
+
+        while True:
+            now = time.time()
+
+            bucket, created = self.get_or_create(key=key, defaults={"theoretical_arrival_time": now})
+
+            new_theoretical_arrival_time = max(bucket.theoretical_arrival_time, now) + emission_interval
+
+            wait_time = new_theoretical_arrival_time - delay_tolerance - now
+            if wait_time > 0:
+                return wait_time
+
+            if self.filter(pk=bucket.pk, theoretical_arrival_time=bucket.theoretical_arrival_time).update(theoretical_arrival_time=new_theoretical_arrival_time):
+                return 0
+
+            # Taken by other process in the meantime, try again
+
+    def refund(self, key, rate):
+        """
+        Gives back a token taken with `acquire`.
+        """
+        self.filter(key=key).update(theoretical_arrival_time=F("theoretical_arrival_time") - 1 / rate)
+
+
+class SendRateLimitBucket(models.Model):
+    key = models.CharField(_("Key"), max_length=255, unique=True)
+    theoretical_arrival_time = models.FloatField(_("Theoretical arrival time"))
+
+    objects = SendRateLimitBucketManager()
+
+    class Meta:
+        verbose_name = _("Send Rate Limit Bucket")
+        verbose_name_plural = _("Send Rate Limit Buckets")
+
+    def __str__(self):
+        return self.key
+
+
+def delete_spooled_payload(sender, instance, using=None, **kwargs):
+    spool_ref = instance.spool_ref
+    if not spool_ref:
+        return
+
+    def delete():
+        # The same payload can be queued more than once
+        if not SendMailTask.objects.using(using).filter(spool_ref=spool_ref).exists():
+            MailSpool().delete(spool_ref)
+
+    transaction.on_commit(delete, using=using)
+
+
+post_delete.connect(delete_spooled_payload, sender=SendMailTask)
+
 
 class SendMailTaskBatch(models.Model):
     # last_attempt_at
@@ -1696,8 +2420,11 @@ class SendMailTaskExceptionLog(models.Model):
 class SendMailTaskErrorRecipient(models.Model):
     task_batch = models.ForeignKey(SendMailTaskBatch, db_index=True, on_delete=models.CASCADE, related_name="error_recipients")
     recipient = models.EmailField(_("Recipient Email"), db_index=True)
-    code = models.PositiveIntegerField(_('Code'))
+    # Null if the server didn't reply, for example if the connection was lost
+    code = models.PositiveIntegerField(_('Code'), blank=True, null=True)
     response = models.TextField(_('SMTP Response'))
+    # Sent again in the next attempt of the task
+    retry = models.BooleanField(_("Retry"), default=False)
 
     class Meta:
         verbose_name = _("Mail Sent Error Recipient")
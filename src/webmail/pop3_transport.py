@@ -1,5 +1,8 @@
+import io
 import poplib
 import email
+import tempfile
+from email.parser import BytesHeaderParser
 from email.policy import default as email_policy, strict as email_strict_policy
 from email.errors import MessageParseError, MessageDefect
 
@@ -7,9 +10,18 @@ from email.errors import MessageParseError, MessageDefect
 from . import settings
 
 
+# Messages up to this size are downloaded in memory, the larger ones to a
+# temporary file
+MAX_IN_MEMORY_MESSAGE_SIZE = 1024 * 1024
+
+
 class Pop3Transport:
-    def __init__(self, hostname, port=None, ssl=False):
+    def __init__(self, hostname, port=None, ssl=False, timeout=settings.WEBMAIL_POP3_TIMEOUT):
         self.hostname = hostname
+        # Seconds without an answer of the server before the connection is
+        # aborted
+        self.timeout = timeout
+        self.num_bytes_received = 0
         if ssl:
             self.transport = poplib.POP3_SSL
             if port is None:
@@ -22,40 +34,99 @@ class Pop3Transport:
         self.port = port
 
     def connect(self, username, password):
-        self.server = self.transport(self.hostname, self.port)
+        self.server = self.transport(self.hostname, self.port, timeout=self.timeout)
         self.server.user(username)
         self.server.pass_(password)
 
-    def get_email_from_bytes(self, contents):
+    def get_policy(self):
         if settings.WEBMAIL_EMAIL_PARSING_STRICT_POLICY:
-            policy = email_strict_policy
+            return email_strict_policy
         else:
-            policy = email_policy
+            return email_policy
 
-        message = email.message_from_bytes(contents, policy=policy)
+    def get_email_from_bytes(self, contents):
+        message = email.message_from_bytes(contents, policy=self.get_policy())
 
         return message
 
     def get_message_body(self, message_lines):
         return bytes('\r\n', 'ascii').join(message_lines)
 
-    def get_message(self, condition=None):
-        # TODO: USE UIDL
-        message_count = len(self.server.list()[1])
-        for i in range(message_count):
-            msg_contents = self.get_message_body(
-                self.server.retr(i + 1)[1]
-            )
+    def list_uids(self):
+        """
+        Returns a list of tuples with the number and the unique id (UIDL) of
+        the messages in the server.
+        """
+        uids = []
+        for line in self.server.uidl()[1]:
+            message_number, uid = line.split(None, 1)
+            uids.append((int(message_number), uid.decode("ascii", "replace")))
+
+        return uids
+
+    def list_sizes(self):
+        """
+        Returns a dictionary from the number of each message in the server to
+        its size in bytes.
+        """
+        sizes = {}
+        for line in self.server.list()[1]:
+            message_number, size = line.split()[:2]
+            sizes[int(message_number)] = int(size)
+
+        return sizes
+
+    def retrieve_headers(self, message_number):
+        """
+        Downloads only the headers of a message (TOP n 0).
+        """
+        header_lines = self.server.top(message_number, 0)[1]
+        contents = self.get_message_body(header_lines)
+        self.num_bytes_received += len(contents)
+
+        return BytesHeaderParser(policy=self.get_policy()).parsebytes(contents)
+
+    def _retrieve_to_file(self, message_number, f):
+        # Like poplib.POP3.retr, without keeping all the lines in memory
+        server = self.server
+        server._putcmd("RETR %s" % message_number)
+        server._getresp()
+
+        while True:
+            line, _octets = server._getline()
+            if line == b".":
+                break
+            if line.startswith(b".."):
+                line = line[1:]
+
+            f.write(line)
+            f.write(b"\r\n")
+            self.num_bytes_received += len(line) + 2
+
+    def retrieve_message(self, message_number):
+        """
+        Downloads a message. Returns None if it can't be parsed.
+        """
+        with tempfile.SpooledTemporaryFile(max_size=MAX_IN_MEMORY_MESSAGE_SIZE) as f:
+            self._retrieve_to_file(message_number, f)
+            f.seek(0)
+
             try:
-                message = self.get_email_from_bytes(msg_contents)
+                return email.message_from_binary_file(f, policy=self.get_policy())
             except (MessageParseError, MessageDefect):
-                continue
+                return None
+
+    def retrieve_raw_message(self, message_number):
+        """
+        Downloads a message without parsing it. Returns its bytes.
+        """
+        f = io.BytesIO()
+        self._retrieve_to_file(message_number, f)
 
-            if condition and not condition(message):
-                continue
+        return f.getvalue()
 
-            yield message
+    def delete_message(self, message_number):
+        self.server.dele(message_number)
 
-            self.server.dele(i + 1)
+    def quit(self):
         self.server.quit()
-        return
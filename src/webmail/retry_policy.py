@@ -0,0 +1,114 @@
+import asyncio
+import random
+import smtplib
+
+
+from . import settings
+from .smtp_transport import SMTPRecipientChunksFailed
+
+
+# Kinds of errors sending a message
+TEMPORARY_ERROR = "temporary"
+PERMANENT_ERROR = "permanent"
+NETWORK_ERROR = "network"
+
+
+def classify_send_error(exception):
+    """
+    Returns the kind of error of an exception raised sending a message:
+    `PERMANENT_ERROR` for 5xx replies of the SMTP server, `TEMPORARY_ERROR`
+    for 4xx replies and `NETWORK_ERROR` when the server could not be reached
+    or the connection was lost. Unknown errors are considered temporary.
+
+    When the message was sent in several transactions, the error is permanent
+    only if all the failed transactions failed with a permanent error.
+    """
+    if isinstance(exception, SMTPRecipientChunksFailed):
+        kinds = {classify_send_error(chunk_exception) for _recipients, chunk_exception in exception.failed_chunks}
+
+        if kinds == {PERMANENT_ERROR}:
+            return PERMANENT_ERROR
+        elif NETWORK_ERROR in kinds:
+            return NETWORK_ERROR
+        else:
+            return TEMPORARY_ERROR
+
+    if isinstance(exception, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _response in exception.recipients.values()]
+
+        # Some recipients could be accepted in another attempt
+        if codes and all(500 <= code < 600 for code in codes):
+            return PERMANENT_ERROR
+        else:
+            return TEMPORARY_ERROR
+
+    if isinstance(exception, smtplib.SMTPServerDisconnected):
+        return NETWORK_ERROR
+
+    if isinstance(exception, smtplib.SMTPResponseException):
+        if 500 <= exception.smtp_code < 600:
+            return PERMANENT_ERROR
+        elif 400 <= exception.smtp_code < 500:
+            return TEMPORARY_ERROR
+        else:
+            # smtplib uses negative codes for connection errors
+            return NETWORK_ERROR
+
+    if isinstance(exception, smtplib.SMTPNotSupportedError):
+        # The configuration of the SMTP server needs to be fixed
+        return PERMANENT_ERROR
+
+    if isinstance(exception, (OSError, asyncio.TimeoutError)):
+        return NETWORK_ERROR
+
+    return TEMPORARY_ERROR
+
+
+class RetryPolicy:
+    """
+    When the failed delivery attempts are retried: after `base_delay`
+    seconds, multiplied by `backoff_factor` with each new attempt up to
+    `max_delay`. The delay is randomized by a `jitter` fraction, so the tasks
+    that failed at the same time, for example because the SMTP server was
+    down, are not retried all at once.
+
+    Permanent errors are not retried, nor tasks already deferred
+    `max_times_deferred` times.
+    """
+
+    def __init__(
+        self,
+        base_delay=settings.WEBMAIL_MAILER_RETRY_BASE_DELAY,
+        max_delay=settings.WEBMAIL_MAILER_DEFER_DURATION * 3600,
+        backoff_factor=settings.WEBMAIL_MAILER_RETRY_BACKOFF_FACTOR,
+        jitter=settings.WEBMAIL_MAILER_RETRY_JITTER,
+        max_times_deferred=settings.WEBMAIL_MAILER_MAX_TIMES_MAIL_DEFERRED):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.backoff_factor = backoff_factor
+        self.jitter = jitter
+        self.max_times_deferred = max_times_deferred
+
+    def is_last_attempt(self, send_email_task):
+        """
+        Whether the task can't be deferred anymore if this delivery attempt
+        fails.
+        """
+        return self.max_times_deferred is not None and send_email_task.num_deferred_times >= self.max_times_deferred
+
+    def get_delay(self, num_deferred_times):
+        # The exponent is limited to avoid an overflow, the delay reached the
+        # max long before
+        delay = min(self.max_delay, self.base_delay * self.backoff_factor ** min(num_deferred_times, 64))
+
+        return delay * (1 - self.jitter) + random.uniform(0, delay * self.jitter)
+
+    def get_retry_delay(self, send_email_task, exception):
+        """
+        Returns the seconds to wait before retrying the task that failed with
+        `exception`, or None if it must not be retried.
+        """
+        if classify_send_error(exception) == PERMANENT_ERROR or self.is_last_attempt(send_email_task):
+            return None
+
+        return self.get_delay(send_email_task.num_deferred_times)
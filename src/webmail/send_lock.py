@@ -0,0 +1,131 @@
+import hashlib
+import time
+
+
+from django.db import connections
+
+
+from .lockfile import FileLock, AlreadyLocked, LockTimeout
+from . import settings
+
+
+# The lock held by the `sendmail` command for the whole run, so runs started
+# by cron don't overlap. The file lock only works for processes of the same
+# host. With processes sending from several hosts, the database lock is held
+# in the database of the queue.
+
+
+class DatabaseLock:
+    """
+    Advisory lock of PostgreSQL (`pg_try_advisory_lock`) or MySQL/MariaDB
+    (`GET_LOCK`), with the same interface as `FileLock`.
+
+    The lock is held by a dedicated connection, so it's not lost when the
+    connection used for the queries is closed or reconnected. The database
+    releases it when that connection is closed, also if the process is killed.
+    """
+
+    def __init__(self, name, using="default"):
+        self.name = name
+        self.using = using
+
+        vendor = connections[using].vendor
+        if vendor not in ("postgresql", "mysql"):
+            raise ValueError("The database lock requires PostgreSQL or MySQL, not %s" % vendor)
+
+        self._lock_connection = None
+
+    @property
+    def is_locked(self):
+        return self._lock_connection is not None
+
+    def _get_key(self):
+        digest = hashlib.sha256(self.name.encode("utf-8")).digest()
+
+        if connections[self.using].vendor == "postgresql":
+            # A signed 64 bits integer
+            return int.from_bytes(digest[:8], "big", signed=True)
+        else:
+            # Lock names are limited to 64 characters
+            return "webmail:" + digest.hex()[:32]
+
+    def _try_lock(self, connection, key):
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute("SELECT pg_try_advisory_lock(%s)", [key])
+            else:
+                cursor.execute("SELECT GET_LOCK(%s, 0)", [key])
+
+            return bool(cursor.fetchone()[0])
+
+    def acquire(self, timeout=None, interval=0.05):
+        """
+        Raises `AlreadyLocked` if `timeout` is None and the lock is held by
+        another process, or `LockTimeout` if it's still held after `timeout`
+        seconds.
+        """
+        assert not self.is_locked
+
+        connection = connections[self.using].copy()
+        key = self._get_key()
+
+        start_time = time.monotonic()
+        try:
+            connection.ensure_connection()
+            connection.set_autocommit(True)
+
+            while not self._try_lock(connection, key):
+                if timeout is None:
+                    raise AlreadyLocked(self.name)
+                if time.monotonic() - start_time >= timeout:
+                    raise LockTimeout(self.name)
+                time.sleep(interval)
+        except BaseException:
+            connection.close()
+            raise
+
+        self._lock_connection = connection
+
+    def release(self):
+        if not self.is_locked:
+            return
+
+        connection = self._lock_connection
+        self._lock_connection = None
+
+        try:
+            with connection.cursor() as cursor:
+                if connection.vendor == "postgresql":
+                    cursor.execute("SELECT pg_advisory_unlock(%s)", [self._get_key()])
+                else:
+                    cursor.execute("SELECT RELEASE_LOCK(%s)", [self._get_key()])
+        finally:
+            # Released anyway when the connection is closed
+            connection.close()
+
+    def __enter__(self):
+        if not self.is_locked:
+            self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+SEND_LOCK_BACKENDS = {
+    "file": lambda name, using: FileLock(name),
+    "database": DatabaseLock,
+}
+
+
+def get_send_lock(backend=settings.WEBMAIL_MAILER_LOCK_BACKEND, name=settings.WEBMAIL_MAILER_LOCK_PATH, using="default"):
+    """
+    Returns a lock of the `backend` ("file" or "database"). `name` is the path
+    of the lock file, or the name of the lock in the database.
+    """
+    try:
+        lock_backend = SEND_LOCK_BACKENDS[backend]
+    except KeyError:
+        raise ValueError("Unknown lock backend '%s'. Choices: %s" % (backend, ", ".join(SEND_LOCK_BACKENDS)))
+
+    return lock_backend(name, using)
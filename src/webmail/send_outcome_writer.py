@@ -0,0 +1,186 @@
+import time
+
+
+from django.db import connections, transaction
+
+
+from .models import SendMailTask, SendMailTaskBatch, SendMailTaskExceptionLog, SendMailTaskErrorRecipient, Message
+from .signals import send_outcomes_written_signal
+from .logutils import get_logger
+from . import settings
+
+
+logger = get_logger()
+
+
+class SendOutcomeWriter:
+    """
+    Writes the results of the delivery attempts to the database in batches.
+
+    Each attempt produces its `SendMailTaskBatch`, maybe an exception log,
+    failed recipients and a notification, and the next status of its task.
+    Written one by one, that's several queries and commits per message. The
+    writer accumulates them, and a flush does one bulk insert per model and
+    one bulk update of the tasks.
+
+    Results are flushed when `flush_size` attempts are pending or the oldest
+    one has waited `flush_interval` seconds (see `flush_if_needed`). Until
+    then the tasks are still in progress in the database. The results must be
+    flushed before releasing the lease of the tasks, otherwise they would
+    return to the queue and be sent again.
+
+    Ordering guarantee: each flush is a single transaction, and writes all the
+    results added before it in the order they were added. A task is never seen
+    with its new status without the records of the attempt, and the results of
+    a flush are never visible before the ones of the previous flush. If the
+    process dies with results not flushed, their tasks return to the queue
+    when the lease expires and are sent again.
+    """
+
+    # Written in this order, the batches first because the other records
+    # reference them
+    _MODELS = (SendMailTaskBatch, SendMailTaskExceptionLog, SendMailTaskErrorRecipient, Message)
+
+    def __init__(self, flush_size=settings.WEBMAIL_MAILER_OUTCOME_FLUSH_SIZE, flush_interval=settings.WEBMAIL_MAILER_OUTCOME_FLUSH_INTERVAL, using="default"):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.using = using
+
+        self._clear()
+
+    def _clear(self):
+        self._objects = {model: [] for model in self._MODELS}
+        # Task id -> (task, fields to update), in the order they were added
+        self._updated_tasks = {}
+        self._deleted_tasks = {}
+        self._first_added_at = None
+
+    def __len__(self):
+        """
+        Number of delivery attempts not written yet.
+        """
+        return len(self._objects[SendMailTaskBatch])
+
+    def _touch(self):
+        if self._first_added_at is None:
+            self._first_added_at = time.monotonic()
+
+    def add(self, obj):
+        self._objects[type(obj)].append(obj)
+        self._touch()
+
+    def add_all(self, objs):
+        for obj in objs:
+            self.add(obj)
+
+    def update_task(self, task, update_fields):
+        _task, fields = self._updated_tasks.setdefault(task.pk, (task, set()))
+        fields.update(update_fields)
+        self._touch()
+
+    def delete_task(self, task):
+        self._deleted_tasks[task.pk] = task
+        self._touch()
+
+    def should_flush(self):
+        if self._first_added_at is None:
+            return False
+
+        if self.flush_size is not None and len(self) >= self.flush_size:
+            return True
+
+        return self.flush_interval is not None and time.monotonic() - self._first_added_at >= self.flush_interval
+
+    def flush_if_needed(self):
+        """
+        Writes the pending results if `should_flush`. Returns the number of
+        delivery attempts written.
+        """
+        if self.should_flush():
+            return self.flush()
+
+        return 0
+
+    def _set_batch_ids(self, batches):
+        # Databases like MySQL don't return the ids of the inserted rows
+        missing_ids = [batch for batch in batches if batch.pk is None]
+        if not missing_ids:
+            return
+
+        batch_ids = {
+            (task_id, num_batch): batch_id
+            for batch_id, task_id, num_batch in SendMailTaskBatch.objects.using(self.using).filter(
+                task_id__in={batch.task_id for batch in missing_ids}).values_list("id", "task_id", "num_batch")
+        }
+
+        for batch in missing_ids:
+            batch.pk = batch_ids[(batch.task_id, batch.num_batch)]
+
+    def flush(self):
+        """
+        Writes all the pending results in one transaction. Returns the number
+        of delivery attempts written.
+
+        If the transaction fails, the results are discarded and the exception
+        is raised.
+        """
+        if self._first_added_at is None:
+            return 0
+
+        objects = self._objects
+        updated_tasks = self._updated_tasks
+        deleted_tasks = self._deleted_tasks
+
+        batches = objects[SendMailTaskBatch]
+
+        try:
+            self._write(objects, updated_tasks, deleted_tasks)
+        except BaseException:
+            # Like if the process died, the tasks return to the queue when
+            # their lease expires
+            logger.exception("Error writing the results of %d delivery attempts", len(batches))
+            self._clear()
+            raise
+
+        logger.debug("Written the results of %d delivery attempts", len(batches))
+
+        self._clear()
+
+        send_outcomes_written_signal.send(sender=SendOutcomeWriter, batches=batches)
+
+        return len(batches)
+
+    def _write(self, objects, updated_tasks, deleted_tasks):
+        manager = SendMailTask.objects.using(self.using)
+
+        with transaction.atomic(using=self.using):
+            # The records of the attempts of the tasks deleted now would be
+            # deleted with them
+            batches = [batch for batch in objects[SendMailTaskBatch] if batch.task_id not in deleted_tasks]
+            if batches:
+                SendMailTaskBatch.objects.using(self.using).bulk_create(batches)
+
+                if not connections[self.using].features.can_return_rows_from_bulk_insert:
+                    self._set_batch_ids(batches)
+
+            for model in (SendMailTaskExceptionLog, SendMailTaskErrorRecipient):
+                objs = [obj for obj in objects[model] if obj.task_batch.task_id not in deleted_tasks]
+                if objs:
+                    model.objects.using(self.using).bulk_create(objs)
+
+            # Rare, saved one by one so the signals of the messages are sent
+            for message in objects[Message]:
+                message.save(using=self.using)
+
+            tasks = []
+            fields = set()
+            for task_id, (task, task_fields) in updated_tasks.items():
+                if task_id not in deleted_tasks:
+                    tasks.append(task)
+                    fields.update(task_fields)
+
+            if tasks:
+                manager.bulk_update(tasks, sorted(fields))
+
+            if deleted_tasks:
+                manager.filter(pk__in=list(deleted_tasks)).delete()
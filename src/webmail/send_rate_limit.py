@@ -0,0 +1,92 @@
+import time
+
+
+from .models import SendRateLimitBucket
+from .logutils import get_logger
+from . import settings
+
+
+logger = get_logger()
+
+
+class SendRateLimiter:
+    """
+    Token buckets limiting the messages sent through each SMTP server and,
+    optionally, to each recipient domain (setting
+    `WEBMAIL_MAILER_RECIPIENT_DOMAIN_RATE_LIMITS`, a dictionary from domain to a
+    tuple of max messages per minute and burst).
+
+    The buckets are stored in the database, so the limits are shared by all the
+    sending processes. A task that can't be sent yet is returned to the queue
+    by the engine, which goes on with the tasks of other SMTP servers instead of
+    waiting.
+    """
+
+    def __init__(self, throttle_time=settings.WEBMAIL_MAILER_THROTTLE_TIME, recipient_domain_rate_limits=settings.WEBMAIL_MAILER_RECIPIENT_DOMAIN_RATE_LIMITS):
+        self.throttle_time = throttle_time
+        self.recipient_domain_rate_limits = {
+            domain.lower(): (messages_per_minute / 60, max(burst, 1))
+            for domain, (messages_per_minute, burst) in (recipient_domain_rate_limits or {}).items()
+        }
+
+        # Buckets known to be empty in this process, to avoid asking the
+        # database again before they are refilled
+        self._limited_until = {}
+
+    def get_rate_limits(self, send_email_task, smtp_server):
+        """
+        Returns the list of (bucket key, rate, burst) applying to the task.
+        """
+        rate_limits = []
+
+        smtp_server_rate_limit = smtp_server.get_send_rate_limit(throttle_time=self.throttle_time)
+        if smtp_server_rate_limit is not None:
+            rate_limits.append(("smtp_server:%d" % smtp_server.pk,) + smtp_server_rate_limit)
+
+        if self.recipient_domain_rate_limits:
+            for domain in sorted(send_email_task.get_recipient_domains()):
+                if domain in self.recipient_domain_rate_limits:
+                    rate_limits.append(("domain:%s" % domain,) + self.recipient_domain_rate_limits[domain])
+
+        return rate_limits
+
+    def acquire(self, send_email_task, smtp_server):
+        """
+        Takes a token of every bucket applying to the task. Returns 0 if the
+        task can be sent now, otherwise the seconds to wait. In that case no
+        token is taken.
+        """
+        rate_limits = self.get_rate_limits(send_email_task, smtp_server)
+
+        now = time.monotonic()
+
+        limited = [(key, rate) for key, rate, _burst in rate_limits if self._limited_until.get(key, now) > now]
+        if limited:
+            wait_time = max(self._limited_until[key] - now for key, _rate in limited)
+
+            # The next tasks waiting for the same buckets are spread over the
+            # time they are refilled, instead of all of them becoming eligible
+            # at the same time
+            for key, rate in limited:
+                self._limited_until[key] += 1 / rate
+
+            return wait_time
+
+        acquired = []
+
+        for key, rate, burst in rate_limits:
+            wait_time = SendRateLimitBucket.objects.acquire(key, rate, burst)
+
+            if wait_time > 0:
+                logger.debug("Rate limit of '%s' reached. Next message in %.2f seconds", key, wait_time)
+
+                self._limited_until[key] = time.monotonic() + wait_time + 1 / rate
+
+                for acquired_key, acquired_rate in acquired:
+                    SendRateLimitBucket.objects.refund(acquired_key, acquired_rate)
+
+                return wait_time
+
+            acquired.append((key, rate))
+
+        return 0
@@ -0,0 +1,146 @@
+from django.db.models import Count, Max, Min
+
+
+# A scheduler chooses which of the eligible tasks of the queue are claimed next
+# by `SendMailTaskManager.claim`.
+
+
+class FifoSendScheduler:
+    """
+    Tasks are sent by priority and, within the same priority, by creation date.
+    """
+
+    def select(self, queryset, limit, skip_locked=False):
+        queryset = queryset.order_by("priority", "created_at")
+
+        if skip_locked:
+            queryset = queryset.select_for_update(skip_locked=True)
+
+        return list(queryset[:limit])
+
+
+class FairSendScheduler:
+    """
+    Deficit round-robin between the mailboxes with tasks in the highest
+    priority queued, so a mailbox queueing thousands of messages doesn't block
+    the messages of the rest with the same priority. In each round, a mailbox
+    can send up to `Mailbox.send_weight` messages.
+
+    The state of the rounds is kept between claims, so each scheduler instance
+    should be used by only one sending process. Processes sending at the same
+    time are fair independently of each other.
+    """
+
+    def __init__(self, quantum=1):
+        self.quantum = quantum
+
+        self._deficits = {}
+
+        # Where the next claim continues the round, and whether that mailbox
+        # already received its quantum in a turn interrupted by a full claim
+        self._next_mailbox_id = None
+        self._quantum_given = False
+
+    def _schedule(self, mailboxes, limit):
+        """
+        Receives a dictionary from mailbox id to a tuple of number of tasks and
+        weight. Returns the list of mailbox ids in the order their next tasks
+        are sent, up to `limit`.
+        """
+        # Mailboxes without tasks don't keep their credit
+        for mailbox_id in list(self._deficits):
+            if mailbox_id not in mailboxes:
+                del self._deficits[mailbox_id]
+
+        mailbox_ids = sorted(mailboxes)
+        if not mailbox_ids:
+            return []
+
+        index = 0
+        resumed_mailbox_id = None
+
+        if self._next_mailbox_id is not None:
+            index = next((i for i, mailbox_id in enumerate(mailbox_ids) if mailbox_id >= self._next_mailbox_id), 0)
+
+            if self._quantum_given:
+                resumed_mailbox_id = self._next_mailbox_id
+
+        remaining = {mailbox_id: num_tasks for mailbox_id, (num_tasks, _weight) in mailboxes.items()}
+
+        schedule = []
+
+        while len(schedule) < limit and any(remaining.values()):
+            mailbox_id = mailbox_ids[index % len(mailbox_ids)]
+            index += 1
+
+            if not remaining[mailbox_id]:
+                continue
+
+            if mailbox_id == resumed_mailbox_id:
+                resumed_mailbox_id = None
+            else:
+                _num_tasks, weight = mailboxes[mailbox_id]
+                self._deficits[mailbox_id] = self._deficits.get(mailbox_id, 0) + self.quantum * max(weight or 1, 1)
+
+            while self._deficits[mailbox_id] >= 1 and remaining[mailbox_id] and len(schedule) < limit:
+                schedule.append(mailbox_id)
+
+                remaining[mailbox_id] -= 1
+                self._deficits[mailbox_id] -= 1
+
+            if not remaining[mailbox_id]:
+                self._deficits[mailbox_id] = 0
+            elif self._deficits[mailbox_id] >= 1:
+                # The claim is full in the middle of the turn of this
+                # mailbox. It continues in the next claim.
+                self._next_mailbox_id = mailbox_id
+                self._quantum_given = True
+                return schedule
+
+        self._next_mailbox_id = mailbox_ids[index % len(mailbox_ids)]
+        self._quantum_given = False
+
+        return schedule
+
+    def select(self, queryset, limit, skip_locked=False):
+        priority = queryset.aggregate(priority=Min("priority"))["priority"]
+        if priority is None:
+            return []
+
+        queryset = queryset.filter(priority=priority)
+
+        mailboxes = {
+            row["mailbox_id"]: (row["num_tasks"], row["weight"])
+            for row in queryset.order_by().values("mailbox_id").annotate(num_tasks=Count("id"), weight=Max("mailbox__send_weight"))
+        }
+
+        schedule = self._schedule(mailboxes, limit)
+
+        tasks_by_mailbox = {}
+        for mailbox_id in set(schedule):
+            mailbox_queryset = queryset.filter(mailbox_id=mailbox_id).order_by("created_at")
+
+            if skip_locked:
+                mailbox_queryset = mailbox_queryset.select_for_update(skip_locked=True)
+
+            tasks_by_mailbox[mailbox_id] = list(mailbox_queryset[:schedule.count(mailbox_id)])
+
+        tasks = []
+        for mailbox_id in schedule:
+            if tasks_by_mailbox[mailbox_id]:
+                tasks.append(tasks_by_mailbox[mailbox_id].pop(0))
+
+        return tasks
+
+
+SEND_SCHEDULERS = {
+    "fifo": FifoSendScheduler,
+    "fair": FairSendScheduler,
+}
+
+
+def get_send_scheduler(name):
+    try:
+        return SEND_SCHEDULERS[name]()
+    except KeyError:
+        raise ValueError("Unknown send scheduler '%s'. Choices: %s" % (name, ", ".join(SEND_SCHEDULERS)))
@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 from django.conf import settings as django_settings
 from django.utils.translation import gettext_lazy as _
@@ -33,9 +34,32 @@ WEBMAIL_UI_MAILBOX_LIST_PAGE_SIZE = getattr(django_settings, "WEBMAIL_UI_MAILBOX
 WEBMAIL_UI_MESSAGE_LIST_PAGE_SIZE = getattr(django_settings, "WEBMAIL_UI_MESSAGE_LIST_PAGE_SIZE", WEBMAIL_UI_ITEMS_PER_PAGE)
 
 
+# POP3 fetch settings
+WEBMAIL_POP3_TIMEOUT = getattr(django_settings, "WEBMAIL_POP3_TIMEOUT", 60)
+WEBMAIL_POP3_MAX_MESSAGE_SIZE = getattr(django_settings, "WEBMAIL_POP3_MAX_MESSAGE_SIZE", 10 * 1024 * 1024)
+WEBMAIL_FETCH_CONCURRENCY = getattr(django_settings, "WEBMAIL_FETCH_CONCURRENCY", 1)
+WEBMAIL_FETCH_BATCH_SIZE = getattr(django_settings, "WEBMAIL_FETCH_BATCH_SIZE", 50)
+WEBMAIL_FETCH_MIN_POLL_INTERVAL = getattr(django_settings, "WEBMAIL_FETCH_MIN_POLL_INTERVAL", 60)
+WEBMAIL_FETCH_MAX_POLL_INTERVAL = getattr(django_settings, "WEBMAIL_FETCH_MAX_POLL_INTERVAL", 1800)
+WEBMAIL_FETCH_MAX_ERROR_BACKOFF = getattr(django_settings, "WEBMAIL_FETCH_MAX_ERROR_BACKOFF", 3600)
+WEBMAIL_PARSE_PROCESSES = getattr(django_settings, "WEBMAIL_PARSE_PROCESSES", 0)
+WEBMAIL_PARSE_TEMP_DIR = getattr(django_settings, "WEBMAIL_PARSE_TEMP_DIR", None)
+
+# LMTP server settings
+WEBMAIL_LMTP_HOST = getattr(django_settings, "WEBMAIL_LMTP_HOST", "127.0.0.1")
+WEBMAIL_LMTP_PORT = getattr(django_settings, "WEBMAIL_LMTP_PORT", 2003)
+WEBMAIL_LMTP_UNIX_SOCKET = getattr(django_settings, "WEBMAIL_LMTP_UNIX_SOCKET", None)
+WEBMAIL_LMTP_MAX_MESSAGE_SIZE = getattr(django_settings, "WEBMAIL_LMTP_MAX_MESSAGE_SIZE", 25 * 1024 * 1024)
+WEBMAIL_LMTP_TIMEOUT = getattr(django_settings, "WEBMAIL_LMTP_TIMEOUT", 300)
+
 # Mailer settings
 WEBMAIL_MAILER_PAUSE_SEND = getattr(django_settings, "WEBMAIL_MAILER_PAUSE_SEND", False)
 WEBMAIL_MAILER_SLEEP_TIME_IF_QUEUE_EMPTY = getattr(django_settings, "WEBMAIL_MAILER_SLEEP_TIME_IF_QUEUE_EMPTY", 30)
+WEBMAIL_MAILER_WAKEUP_ENABLED = getattr(django_settings, "WEBMAIL_MAILER_WAKEUP_ENABLED", True)
+WEBMAIL_MAILER_WAKEUP_CHANNEL = getattr(django_settings, "WEBMAIL_MAILER_WAKEUP_CHANNEL", "webmail_send_queue")
+WEBMAIL_MAILER_WAKEUP_SOCKET_DIR = getattr(django_settings, "WEBMAIL_MAILER_WAKEUP_SOCKET_DIR", os.path.join(tempfile.gettempdir(), "webmail_mailer_wakeup"))
+WEBMAIL_MAILER_WAKEUP_SOCKET_MODE = getattr(django_settings, "WEBMAIL_MAILER_WAKEUP_SOCKET_MODE", 0o770)
+WEBMAIL_MAILER_LOCK_BACKEND = getattr(django_settings, "WEBMAIL_MAILER_LOCK_BACKEND", "file")
 WEBMAIL_MAILER_LOCK_PATH = getattr(django_settings, "WEBMAIL_MAILER_LOCK_PATH", "sending_mail")
 WEBMAIL_MAILER_LOCK_WAIT_TIMEOUT = getattr(django_settings, "WEBMAIL_MAILER_LOCK_WAIT_TIMEOUT", -1)
 WEBMAIL_MAILER_SLEEP_TIME_IF_NO_LOCK_ACQUIRED = getattr(django_settings, "WEBMAIL_MAILER_SLEEP_TIME_IF_NO_LOCK_ACQUIRED", 20)
@@ -45,8 +69,34 @@ WEBMAIL_MAILER_MAX_FAILED_TASKS_IN_BATCH = getattr(django_settings, "WEBMAIL_MAI
 WEBMAIL_MAILER_MAX_FAILED_OR_DEFERRED_TASKS_IN_BATCH = getattr(django_settings, "WEBMAIL_MAILER_MAX_FAILED_OR_DEFERRED_TASKS_IN_BATCH", None)
 WEBMAIL_MAILER_MAX_TIMES_MAIL_DEFERRED = getattr(django_settings, "WEBMAIL_MAILER_MAX_TIMES_MAIL_DEFERRED", None)
 WEBMAIL_MAILER_DEFER_DURATION = getattr(django_settings, "WEBMAIL_MAILER_DEFER_DURATION", 2)
+WEBMAIL_MAILER_RETRY_BASE_DELAY = getattr(django_settings, "WEBMAIL_MAILER_RETRY_BASE_DELAY", 300)
+WEBMAIL_MAILER_RETRY_BACKOFF_FACTOR = getattr(django_settings, "WEBMAIL_MAILER_RETRY_BACKOFF_FACTOR", 2)
+WEBMAIL_MAILER_RETRY_JITTER = getattr(django_settings, "WEBMAIL_MAILER_RETRY_JITTER", 0.5)
 WEBMAIL_MAILER_THROTTLE_TIME = getattr(django_settings, "WEBMAIL_MAILER_THROTTLE_TIME", 0)
+WEBMAIL_MAILER_RECIPIENT_DOMAIN_RATE_LIMITS = getattr(django_settings, "WEBMAIL_MAILER_RECIPIENT_DOMAIN_RATE_LIMITS", {})
 WEBMAIL_MAILER_DELETE_COMPLETED_TASKS = getattr(django_settings, "WEBMAIL_MAILER_DELETE_COMPLETED_TASKS", True)
+WEBMAIL_MAILER_PURGE_CHUNK_SIZE = getattr(django_settings, "WEBMAIL_MAILER_PURGE_CHUNK_SIZE", 500)
+WEBMAIL_MAILER_PURGE_PAUSE = getattr(django_settings, "WEBMAIL_MAILER_PURGE_PAUSE", 0.5)
+WEBMAIL_MAILER_CLAIM_BATCH_SIZE = getattr(django_settings, "WEBMAIL_MAILER_CLAIM_BATCH_SIZE", 10)
+WEBMAIL_MAILER_SCHEDULER = getattr(django_settings, "WEBMAIL_MAILER_SCHEDULER", "fifo")
+WEBMAIL_MAILER_LEASE_DURATION = getattr(django_settings, "WEBMAIL_MAILER_LEASE_DURATION", 600)
+WEBMAIL_MAILER_OUTCOME_FLUSH_SIZE = getattr(django_settings, "WEBMAIL_MAILER_OUTCOME_FLUSH_SIZE", 50)
+WEBMAIL_MAILER_OUTCOME_FLUSH_INTERVAL = getattr(django_settings, "WEBMAIL_MAILER_OUTCOME_FLUSH_INTERVAL", 2)
+WEBMAIL_MAILER_SMTP_CONNECTION_IDLE_TIMEOUT = getattr(django_settings, "WEBMAIL_MAILER_SMTP_CONNECTION_IDLE_TIMEOUT", 30)
+WEBMAIL_MAILER_SMTP_TIMEOUT = getattr(django_settings, "WEBMAIL_MAILER_SMTP_TIMEOUT", 60)
+WEBMAIL_MAILER_MAX_RECIPIENTS_PER_TRANSACTION = getattr(django_settings, "WEBMAIL_MAILER_MAX_RECIPIENTS_PER_TRANSACTION", 100)
+WEBMAIL_MAILER_SPOOL_DIR = getattr(django_settings, "WEBMAIL_MAILER_SPOOL_DIR", None)
+WEBMAIL_MAILER_SPOOL_COMPRESS = getattr(django_settings, "WEBMAIL_MAILER_SPOOL_COMPRESS", False)
+WEBMAIL_MAILER_SPOOL_COMPRESS_LEVEL = getattr(django_settings, "WEBMAIL_MAILER_SPOOL_COMPRESS_LEVEL", 6)
+WEBMAIL_MAILER_ENGINE = getattr(django_settings, "WEBMAIL_MAILER_ENGINE", "sync")
+WEBMAIL_MAILER_ASYNC_MAX_CONCURRENT_SESSIONS = getattr(django_settings, "WEBMAIL_MAILER_ASYNC_MAX_CONCURRENT_SESSIONS", 50)
+WEBMAIL_MAILER_ASYNC_MAX_SESSIONS_PER_SMTP_SERVER = getattr(django_settings, "WEBMAIL_MAILER_ASYNC_MAX_SESSIONS_PER_SMTP_SERVER", 5)
+WEBMAIL_MAILER_METRICS_DIR = getattr(django_settings, "WEBMAIL_MAILER_METRICS_DIR", None)
+WEBMAIL_MAILER_METRICS_FLUSH_INTERVAL = getattr(django_settings, "WEBMAIL_MAILER_METRICS_FLUSH_INTERVAL", 10)
+
+# Prometheus endpoint with the metrics of the mailer
+WEBMAIL_METRICS_ENABLED = getattr(django_settings, "WEBMAIL_METRICS_ENABLED", False)
+WEBMAIL_METRICS_TOKEN = getattr(django_settings, "WEBMAIL_METRICS_TOKEN", None)
 
 WEBMAIL_MAIL_SEND_ENABLED = getattr(django_settings, "WEBMAIL_MAIL_SEND_ENABLED", True)
 
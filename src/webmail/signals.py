@@ -22,6 +22,9 @@ pre_send_mail_signal = Signal()
 
 # Outbound message, after sending
 post_send_signal = Signal()
+
+# Results of the delivery attempts, once written to the database
+send_outcomes_written_signal = Signal()
 #email_sent = Signal()
 #email_failed_to_send = Signal()
 
@@ -0,0 +1,465 @@
+import re
+import smtplib
+import ssl
+import time
+
+
+from . import settings, metrics
+from .mail_spool import iter_payload_lines
+from .logutils import get_logger
+
+
+logger = get_logger()
+
+
+CRLF = b"\r\n"
+
+# Size of the writes to the socket in the DATA phase
+DATA_CHUNK_SIZE = 64 * 1024
+
+
+def fix_eols(data):
+    return re.sub(rb"(?:\r\n|\n|\r(?!\n))", CRLF, data)
+
+
+def quote_periods(data):
+    return re.sub(rb"(?m)^\.", b"..", data)
+
+
+def iter_data_chunks(multipart_mail_message, chunk_size=DATA_CHUNK_SIZE):
+    """
+    Yields the content of the DATA command for the message, bytes or a
+    `SpooledMailMessage`: CRLF line endings, dot-stuffed and without the final
+    ".". The message is read line by line, so a spooled message is never
+    loaded completely in memory.
+    """
+    chunk = []
+    chunk_length = 0
+
+    for line in iter_payload_lines(multipart_mail_message):
+        data = quote_periods(fix_eols(line))
+        if not data.endswith(CRLF):
+            # Last line of the message
+            data += CRLF
+
+        chunk.append(data)
+        chunk_length += len(data)
+
+        if chunk_length >= chunk_size:
+            yield b"".join(chunk)
+
+            chunk = []
+            chunk_length = 0
+
+    if chunk:
+        yield b"".join(chunk)
+
+
+# Errors of a single mail transaction. After any other error, like a lost
+# connection or a failed authentication, the next transactions would fail too.
+TRANSACTION_ERRORS = (smtplib.SMTPSenderRefused, smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError)
+
+
+def split_recipients(recipient_list, max_recipients=settings.WEBMAIL_MAILER_MAX_RECIPIENTS_PER_TRANSACTION):
+    """
+    Splits the recipients in chunks of at most `max_recipients`, each one
+    sent in its own mail transaction. Many servers don't accept more than 100
+    recipients per transaction, the minimum required by RFC 5321.
+    """
+    if isinstance(recipient_list, str):
+        recipient_list = [recipient_list]
+
+    if not max_recipients:
+        return [recipient_list]
+
+    return [recipient_list[i:i + max_recipients] for i in range(0, len(recipient_list), max_recipients)]
+
+
+class SMTPRecipientChunksFailed(smtplib.SMTPException):
+    """
+    The message was not accepted in some of the transactions used to send it
+    to the chunks of recipients (see `split_recipients`).
+
+    `failed_chunks` is a list of tuples with the recipients of each failed
+    transaction and its exception. `refused_recipients` are the recipients
+    refused by the server in the accepted transactions, like the result of
+    `smtplib.SMTP.sendmail`.
+    """
+
+    def __init__(self, failed_chunks, refused_recipients, num_chunks):
+        self.failed_chunks = failed_chunks
+        self.refused_recipients = refused_recipients
+        self.num_chunks = num_chunks
+
+        _recipients, first_exception = failed_chunks[0]
+
+        super().__init__("Message not accepted for %d of %d chunks of recipients. First error: %s: %s" % (len(failed_chunks), num_chunks, type(first_exception).__name__, first_exception))
+
+
+class SmtpTransport:
+    def __init__(self, hostname, port=None, ssl=False, tls=False, timeout=settings.WEBMAIL_MAILER_SMTP_TIMEOUT, metrics_label=None):
+        self.hostname = hostname or "localhost"
+        if ssl:
+            self.transport = smtplib.SMTP_SSL
+            if port is None:
+                port = smtplib.SMTP_SSL_PORT
+        else:
+            self.transport = smtplib.SMTP
+            if port is None:
+                port = smtplib.SMTP_PORT
+
+        self.port = port
+        self.use_ssl = ssl
+        self.use_tls = tls
+        # Seconds without an answer of the server before giving up
+        self.timeout = timeout
+        self.metrics_label = metrics_label
+
+        self.server = None
+        self.last_used_at = None
+        # Whether the server accepted MAIL FROM in the last transaction. After
+        # that, a lost connection doesn't tell if the message was queued.
+        self.mail_accepted = False
+
+    @property
+    def is_connected(self):
+        return self.server is not None
+
+    def _observe(self, histogram, start_time):
+        if self.metrics_label is not None:
+            histogram.observe(time.monotonic() - start_time, smtp_server=self.metrics_label)
+
+    def connect(self, username, password):
+        start_time = time.monotonic()
+
+        self.server = self.transport(self.hostname, self.port, timeout=self.timeout)
+
+        # TLS/SSL are mutually exclusive, so only attempt TLS over
+        # non-secure connections.
+        if not self.use_ssl and self.use_tls:
+            self.server.ehlo()
+            self.server.starttls()
+
+        # Otherwise done by login(), and measured as part of the
+        # authentication
+        self.server.ehlo()
+
+        self._observe(metrics.SMTP_CONNECT_SECONDS, start_time)
+
+        start_time = time.monotonic()
+        self.server.login(user=username, password=password)
+        self._observe(metrics.SMTP_AUTH_SECONDS, start_time)
+
+        self.last_used_at = time.monotonic()
+
+    def reset(self):
+        """
+        Aborts any pending mail transaction so the session can be reused for
+        the next message.
+        """
+        self.server.rset()
+        self.last_used_at = time.monotonic()
+
+    def sendmail(self, from_email, recipient_list, multipart_mail_message):
+        try:
+            return self._sendmail(from_email, recipient_list, multipart_mail_message)
+        finally:
+            self.last_used_at = time.monotonic()
+
+    def _rset_quietly(self):
+        try:
+            self.server.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    def _send_envelope(self, from_email, recipient_list, mail_options):
+        """
+        Sends MAIL FROM and one RCPT TO for each recipient. Returns the reply
+        to MAIL FROM and the list of replies to RCPT TO, which stops at the
+        first reply with code 421 (the server is closing the connection).
+
+        If the server supports PIPELINING (RFC 2920), all the commands are sent
+        in a single write, instead of waiting for the reply to each one.
+        """
+        server = self.server
+
+        mail_command = "mail FROM:%s%s" % (smtplib.quoteaddr(from_email), "".join(" " + option for option in mail_options))
+        recipient_commands = ["rcpt TO:%s" % smtplib.quoteaddr(recipient) for recipient in recipient_list]
+
+        if server.does_esmtp and server.has_extn("pipelining"):
+            server.send("".join(command + "\r\n" for command in [mail_command] + recipient_commands))
+
+            # All the replies are read, so the session is in sync with the
+            # server even if MAIL FROM was rejected
+            mail_reply = server.getreply()
+            if mail_reply[0] == 421:
+                return mail_reply, []
+
+            self.mail_accepted = mail_reply[0] == 250
+
+            recipient_replies = []
+            for _command in recipient_commands:
+                reply = server.getreply()
+                recipient_replies.append(reply)
+
+                if reply[0] == 421:
+                    break
+        else:
+            mail_reply = server.docmd(mail_command)
+            if mail_reply[0] != 250:
+                return mail_reply, []
+
+            self.mail_accepted = True
+
+            recipient_replies = []
+            for command in recipient_commands:
+                reply = server.docmd(command)
+                recipient_replies.append(reply)
+
+                if reply[0] == 421:
+                    break
+
+        return mail_reply, recipient_replies
+
+    def _sendmail(self, from_email, recipient_list, multipart_mail_message):
+        # Same as smtplib.SMTP.sendmail, except that a spooled message is
+        # streamed into the DATA phase, and the time of the DATA phase is
+        # measured
+
+        if isinstance(multipart_mail_message, str):
+            multipart_mail_message = multipart_mail_message.encode("ascii")
+
+        server = self.server
+        self.mail_accepted = False
+
+        server.ehlo_or_helo_if_needed()
+
+        mail_options = []
+        if server.does_esmtp and server.has_extn("size"):
+            mail_options.append("size=%d" % len(multipart_mail_message))
+
+        if isinstance(recipient_list, str):
+            recipient_list = [recipient_list]
+
+        (code, response), recipient_replies = self._send_envelope(from_email, recipient_list, mail_options)
+        if code != 250:
+            if code == 421:
+                server.close()
+            else:
+                self._rset_quietly()
+            raise smtplib.SMTPSenderRefused(code, response, from_email)
+
+        refused_recipients = {}
+        for recipient, (code, response) in zip(recipient_list, recipient_replies):
+            if code not in (250, 251):
+                refused_recipients[recipient] = (code, response)
+
+            if code == 421:
+                server.close()
+                raise smtplib.SMTPRecipientsRefused(refused_recipients)
+
+        if len(refused_recipients) == len(recipient_list):
+            # The server refused all our recipients
+            self._rset_quietly()
+            raise smtplib.SMTPRecipientsRefused(refused_recipients)
+
+        data_start_time = time.monotonic()
+
+        code, response = server.docmd("data")
+        if code != 354:
+            if code == 421:
+                server.close()
+            else:
+                self._rset_quietly()
+            raise smtplib.SMTPDataError(code, response)
+
+        # The end of data is sent in the same write as the last chunk. Sent
+        # apart, the small write waits for the acknowledgement of the
+        # previous one by the server (Nagle's algorithm), which can be
+        # delayed up to 40 ms.
+        last_chunk = b""
+        for chunk in iter_data_chunks(multipart_mail_message):
+            if last_chunk:
+                server.send(last_chunk)
+
+            last_chunk = chunk
+
+        server.send(last_chunk + b"." + CRLF)
+
+        code, response = server.getreply()
+        self._observe(metrics.SMTP_DATA_SECONDS, data_start_time)
+
+        if code != 250:
+            if code == 421:
+                server.close()
+            else:
+                self._rset_quietly()
+            raise smtplib.SMTPDataError(code, response)
+
+        return refused_recipients
+
+    def close(self):
+        if self.server is None:
+            return
+
+        try:
+            self.server.quit()
+        except (ssl.SSLError, smtplib.SMTPServerDisconnected, OSError):
+            # This happens when calling quit() on a TLS connection
+            # sometimes, or when the connection was already disconnected
+            # by the server.
+            self.server.close()
+
+        self.server = None
+
+
+class SmtpConnectionPool:
+    """
+    Keeps one authenticated SMTP session per SMTP server alive during a
+    delivery run, so the TLS handshake and the authentication are done only
+    once for all the tasks sent through the same server.
+
+    Sessions are reset with RSET between messages and closed after being
+    unused for more than `idle_timeout` seconds.
+
+    Messages with more than `max_recipients` recipients are sent in several
+    transactions (see `split_recipients`).
+    """
+
+    def __init__(self, idle_timeout=settings.WEBMAIL_MAILER_SMTP_CONNECTION_IDLE_TIMEOUT, max_recipients=settings.WEBMAIL_MAILER_MAX_RECIPIENTS_PER_TRANSACTION):
+        self.idle_timeout = idle_timeout
+        self.max_recipients = max_recipients
+        self._connections = {}
+
+    def __len__(self):
+        return len(self._connections)
+
+    @staticmethod
+    def _get_key(smtp_server):
+        # Changing the server configuration while a run is in progress must
+        # not reuse a session authenticated with the old parameters
+        return (smtp_server.pk, smtp_server.ip_address, smtp_server.port, smtp_server.username, smtp_server.password, smtp_server.use_ssl, smtp_server.use_tls)
+
+    def _checkout(self, smtp_server):
+        key = self._get_key(smtp_server)
+        transport = self._connections.pop(key, None)
+
+        if transport is not None:
+            try:
+                transport.reset()
+            except (smtplib.SMTPException, OSError):
+                logger.debug("SMTP session with %s is not usable anymore. Reconnecting.", smtp_server)
+                transport.close()
+                transport = None
+
+        if transport is None:
+            logger.debug("Opening SMTP session with %s", smtp_server)
+            return smtp_server.get_connection(), False
+        else:
+            return transport, True
+
+    def _checkin(self, smtp_server, transport):
+        self._connections[self._get_key(smtp_server)] = transport
+
+    def send_mail(self, smtp_server, from_email, recipient_list, multipart_mail_message):
+        """
+        Sends the message in one transaction for each chunk of recipients.
+        Returns the recipients refused by the server, like
+        `smtplib.SMTP.sendmail`.
+
+        If the message was sent in several transactions and some of them
+        failed, `SMTPRecipientChunksFailed` is raised with the exception of
+        each failed chunk. After an error not related to the transaction, for
+        example if the server can't be reached, the next chunks are not tried
+        and fail with the same exception.
+        """
+        chunks = split_recipients(recipient_list, self.max_recipients)
+
+        if len(chunks) == 1:
+            return self._send_transaction(smtp_server, from_email, chunks[0], multipart_mail_message)
+
+        refused_recipients = {}
+        failed_chunks = []
+        session_exception = None
+
+        for chunk in chunks:
+            if session_exception is not None:
+                failed_chunks.append((chunk, session_exception))
+                continue
+
+            try:
+                refused_recipients.update(self._send_transaction(smtp_server, from_email, chunk, multipart_mail_message))
+            except (smtplib.SMTPException, OSError) as e:
+                failed_chunks.append((chunk, e))
+
+                if not isinstance(e, TRANSACTION_ERRORS):
+                    session_exception = e
+
+        if failed_chunks:
+            raise SMTPRecipientChunksFailed(failed_chunks, refused_recipients, len(chunks))
+
+        return refused_recipients
+
+    def _send_transaction(self, smtp_server, from_email, recipient_list, multipart_mail_message):
+        self.close_idle()
+
+        transport, reused = self._checkout(smtp_server)
+
+        try:
+            statusdict = transport.sendmail(from_email, recipient_list, multipart_mail_message)
+        except smtplib.SMTPServerDisconnected:
+            transport.close()
+
+            # Once MAIL FROM is accepted, the server could have queued the
+            # message before the connection was lost, so it's deferred
+            # instead of sent again right away
+            if not reused or transport.mail_accepted:
+                raise
+
+            # The server closed a session that was idle in the pool. Try
+            # again only once with a brand new session.
+            logger.debug("SMTP session with %s disconnected by the server. Reconnecting.", smtp_server)
+            transport = smtp_server.get_connection()
+
+            try:
+                statusdict = transport.sendmail(from_email, recipient_list, multipart_mail_message)
+            except smtplib.SMTPResponseException:
+                self._checkin(smtp_server, transport)
+                raise
+            except BaseException:
+                transport.close()
+                raise
+        except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+            # The server rejected this message, but the session is still
+            # valid for the next one.
+            self._checkin(smtp_server, transport)
+            raise
+        except BaseException:
+            transport.close()
+            raise
+
+        self._checkin(smtp_server, transport)
+
+        return statusdict
+
+    def close_idle(self):
+        if self.idle_timeout is None:
+            return
+
+        now = time.monotonic()
+        for key, transport in list(self._connections.items()):
+            if now - transport.last_used_at >= self.idle_timeout:
+                logger.debug("Closing SMTP session idle for more than %s seconds", self.idle_timeout)
+                del self._connections[key]
+                transport.close()
+
+    def close_all(self):
+        while self._connections:
+            _key, transport = self._connections.popitem()
+            transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_all()
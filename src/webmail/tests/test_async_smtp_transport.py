@@ -0,0 +1,46 @@
+import asyncio
+
+from django.test import SimpleTestCase
+
+from webmail.async_smtp_transport import AsyncSmtpConnectionPool
+from webmail.tests.test_smtp_transport import FakeSmtpServer
+
+
+class FakeAsyncTransport:
+    is_connected = True
+
+    def __init__(self, last_used_at=0):
+        self.last_used_at = last_used_at
+        self.num_closed = 0
+
+    async def close(self):
+        # Other coroutines run while closing
+        await asyncio.sleep(0)
+        self.num_closed += 1
+
+
+class AsyncSmtpConnectionPoolCloseIdleTest(SimpleTestCase):
+    def test_concurrent_close_idle(self):
+        smtp_server = FakeSmtpServer([])
+        idle_transports = [FakeAsyncTransport(), FakeAsyncTransport()]
+        new_transport = FakeAsyncTransport(last_used_at=float("inf"))
+
+        async def checkin_while_closing(pool):
+            await asyncio.sleep(0)
+            pool._checkin(smtp_server, new_transport)
+
+        async def run():
+            pool = AsyncSmtpConnectionPool(idle_timeout=60)
+            for transport in idle_transports:
+                pool._checkin(smtp_server, transport)
+
+            await asyncio.gather(pool.close_idle(), pool.close_idle(), checkin_while_closing(pool))
+
+            return pool
+
+        pool = asyncio.run(run())
+
+        self.assertEqual([transport.num_closed for transport in idle_transports], [1, 1])
+        # The session checked in meanwhile is kept
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(new_transport.num_closed, 0)
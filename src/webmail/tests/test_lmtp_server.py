@@ -0,0 +1,291 @@
+import asyncio
+import os
+import tempfile
+import threading
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase
+
+from webmail.models import WebmailUser, Mailbox, Message
+from webmail.lmtp_server import LmtpServer, LmtpSession, deliver_message
+
+
+MESSAGE = b"From: sender@example.com\r\nTo: user@example.com\r\nSubject: Test\r\nMessage-Id: <test@example.com>\r\n\r\nBody\r\n"
+
+
+class FakeMailbox:
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeRecipientMap:
+    def __init__(self, mailboxes_by_email):
+        self.mailboxes_by_email = mailboxes_by_email
+
+    def get_mailboxes(self, address):
+        return self.mailboxes_by_email.get(address, [])
+
+
+class InlineExecutor:
+    async def run(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+
+class FakeWriter:
+    def __init__(self):
+        self.data = b""
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class LmtpSessionTest(SimpleTestCase):
+    def setUp(self):
+        self.delivered = []
+        self.delivery_replies = {}
+
+        def deliver(raw_message, mailboxes):
+            self.delivered.append((raw_message, [mailbox.id for mailbox in mailboxes]))
+            return {mailbox.id: self.delivery_replies.get(mailbox.id, "250 2.0.0 Delivered") for mailbox in mailboxes}
+
+        patcher = mock.patch("webmail.lmtp_server.deliver_message", side_effect=deliver)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.server = LmtpServer(hostname="lmtp.example.com", max_message_size=1000, recipient_map=FakeRecipientMap({
+            "user@example.com": [FakeMailbox(1)],
+            "alias@example.com": [FakeMailbox(1)],
+            "shared@example.com": [FakeMailbox(1), FakeMailbox(2)],
+        }))
+        self.server.database_executor = InlineExecutor()
+
+    def run_session(self, data):
+        """
+        Returns the reply lines to the commands of `data`.
+        """
+        writer = FakeWriter()
+
+        async def run():
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+
+            await LmtpSession(self.server, reader, writer).run()
+
+        asyncio.run(run())
+
+        return writer.data.decode("utf-8").splitlines()
+
+    def test_lhlo(self):
+        replies = self.run_session(b"LHLO mta.example.com\r\nQUIT\r\n")
+
+        self.assertEqual(replies, [
+            "220 lmtp.example.com LMTP server ready",
+            "250-lmtp.example.com",
+            "250-PIPELINING",
+            "250-ENHANCEDSTATUSCODES",
+            "250-8BITMIME",
+            "250 SIZE 1000",
+            "221 2.0.0 lmtp.example.com Bye",
+        ])
+
+    def test_helo_rejected(self):
+        replies = self.run_session(b"HELO mta.example.com\r\nLHLO\r\nFOO\r\n")
+
+        self.assertEqual(replies[1:], ["500 5.5.1 This is an LMTP server, use LHLO", "501 5.5.4 Syntax: LHLO hostname", "500 5.5.1 Command not recognized"])
+
+    def test_delivery(self):
+        replies = self.run_session(
+            b"LHLO mta.example.com\r\n"
+            b"MAIL FROM:<sender@example.com> SIZE=100\r\n"
+            b"RCPT TO:<user@example.com>\r\n"
+            b"RCPT TO:<unknown@example.com>\r\n"
+            b"RCPT TO:<shared@example.com>\r\n"
+            b"DATA\r\n" + MESSAGE + b".\r\n"
+            b"QUIT\r\n")
+
+        self.assertEqual(replies[6:], [
+            "250 2.1.0 OK",
+            "250 2.1.5 OK",
+            "550 5.1.1 <unknown@example.com> Recipient unknown",
+            "250 2.1.5 OK",
+            "354 Start mail input; end with <CRLF>.<CRLF>",
+            # One for each accepted recipient
+            "250 2.0.0 Delivered",
+            "250 2.0.0 Delivered",
+            "221 2.0.0 lmtp.example.com Bye",
+        ])
+
+        # Once to each mailbox
+        self.assertEqual(self.delivered, [(MESSAGE, [1, 2])])
+
+    def test_reply_for_each_recipient(self):
+        self.delivery_replies = {2: "451 4.3.0 Temporary failure delivering the message"}
+
+        replies = self.run_session(
+            b"LHLO mta.example.com\r\n"
+            b"MAIL FROM:<sender@example.com>\r\n"
+            b"RCPT TO:<user@example.com>\r\n"
+            b"RCPT TO:<shared@example.com>\r\n"
+            b"DATA\r\n" + MESSAGE + b".\r\n")
+
+        # The recipient of both mailboxes is retried
+        self.assertEqual(replies[-2:], ["250 2.0.0 Delivered", "451 4.3.0 Temporary failure delivering the message"])
+
+    def test_transaction_state(self):
+        replies = self.run_session(
+            b"LHLO mta.example.com\r\n"
+            b"RCPT TO:<user@example.com>\r\n"
+            b"MAIL FROM:<sender@example.com>\r\n"
+            b"MAIL FROM:<sender@example.com>\r\n"
+            b"DATA\r\n"
+            b"RSET\r\n"
+            b"RCPT TO:<user@example.com>\r\n")
+
+        self.assertEqual(replies[6:], [
+            "503 5.5.1 Need MAIL command",
+            "250 2.1.0 OK",
+            "503 5.5.1 Nested MAIL command",
+            "503 5.5.1 No valid recipients",
+            "250 2.0.0 OK",
+            "503 5.5.1 Need MAIL command",
+        ])
+
+    def test_dot_unstuffing(self):
+        self.run_session(
+            b"LHLO mta.example.com\r\n"
+            b"MAIL FROM:<sender@example.com>\r\n"
+            b"RCPT TO:<user@example.com>\r\n"
+            b"DATA\r\n"
+            b"Subject: Test\r\n\r\n..\r\n...Line\r\n.Line\r\n.\r\n")
+
+        self.assertEqual(self.delivered[0][0], b"Subject: Test\r\n\r\n.\r\n..Line\r\nLine\r\n")
+
+    def test_size_declared_in_mail_from(self):
+        replies = self.run_session(b"LHLO mta.example.com\r\nMAIL FROM:<sender@example.com> SIZE=1001\r\nMAIL FROM:<sender@example.com> SIZE=x\r\n")
+
+        self.assertEqual(replies[6:], ["552 5.3.4 Message size exceeds fixed limit", "501 5.5.4 Invalid SIZE parameter"])
+
+    def test_message_too_large(self):
+        replies = self.run_session(
+            b"LHLO mta.example.com\r\n"
+            b"MAIL FROM:<sender@example.com>\r\n"
+            b"RCPT TO:<user@example.com>\r\n"
+            b"RCPT TO:<alias@example.com>\r\n"
+            b"DATA\r\n" + b"Line\r\n" * 200 + b".\r\n"
+            b"NOOP\r\n")
+
+        self.assertEqual(replies[-3:], ["552 5.3.4 Message size exceeds fixed limit", "552 5.3.4 Message size exceeds fixed limit", "250 2.0.0 OK"])
+        self.assertEqual(self.delivered, [])
+
+
+class DeliverMessageTest(TestCase):
+    def setUp(self):
+        user = WebmailUser.objects.create_user(username="user", password="password")
+        self.mailbox = Mailbox.objects.create(user=user, name="mailbox", emails="user@example.com")
+
+    def test_delivered(self):
+        replies = deliver_message(MESSAGE, [self.mailbox])
+
+        self.assertTrue(replies[self.mailbox.id].startswith("250 "))
+        self.assertEqual(self.mailbox.messages.get().subject, "Test")
+
+    def test_delivered_before_skipped(self):
+        deliver_message(MESSAGE, [self.mailbox])
+
+        # Retried by the MTA
+        replies = deliver_message(MESSAGE, [self.mailbox])
+
+        self.assertEqual(replies, {self.mailbox.id: "250 2.0.0 Already delivered"})
+        self.assertEqual(self.mailbox.messages.count(), 1)
+
+    def test_sent_copy_not_delivered_before(self):
+        # A message sent to oneself, its sent copy is already in the mailbox
+        deliver_message(MESSAGE, [self.mailbox])
+        self.mailbox.messages.update(folder_id=Message.SENT_FOLDER_ID)
+
+        replies = deliver_message(MESSAGE, [self.mailbox])
+
+        self.assertTrue(replies[self.mailbox.id].startswith("250 2.0.0 <"))
+        self.assertEqual(self.mailbox.messages.filter(folder_id=Message.INBOX_FOLDER_ID).count(), 1)
+
+    def test_invalid_message(self):
+        replies = deliver_message(b"Subject: No From\r\n\r\nBody\r\n", [self.mailbox])
+
+        self.assertTrue(replies[self.mailbox.id].startswith("554 "))
+
+
+class LmtpServerShutdownTest(SimpleTestCase):
+    def test_shutdown(self):
+        delivery_started = threading.Event()
+        finish_delivery = threading.Event()
+
+        def deliver(raw_message, mailboxes):
+            delivery_started.set()
+            finish_delivery.wait(10)
+            return {mailbox.id: "250 2.0.0 Delivered" for mailbox in mailboxes}
+
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        unix_socket = os.path.join(temp_dir.name, "lmtp.sock")
+
+        server = LmtpServer(hostname="lmtp.example.com", recipient_map=FakeRecipientMap({"user@example.com": [FakeMailbox(1)]}))
+
+        async def read_reply(reader):
+            return (await asyncio.wait_for(reader.readline(), 10)).decode("ascii").rstrip("\r\n")
+
+        async def lhlo(reader, writer):
+            await read_reply(reader)
+            writer.write(b"LHLO mta.example.com\r\n")
+            while not (await read_reply(reader)).startswith("250 "):
+                pass
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            stop_event = asyncio.Event()
+            serve_task = asyncio.create_task(server.serve(unix_socket=unix_socket, stop_event=stop_event))
+
+            while not os.path.exists(unix_socket):
+                await asyncio.sleep(0.01)
+
+            idle_reader, idle_writer = await asyncio.open_unix_connection(unix_socket)
+            await lhlo(idle_reader, idle_writer)
+
+            reader, writer = await asyncio.open_unix_connection(unix_socket)
+            await lhlo(reader, writer)
+            writer.write(b"MAIL FROM:<sender@example.com>\r\nRCPT TO:<user@example.com>\r\nDATA\r\n" + MESSAGE + b".\r\n")
+            for i in range(3):
+                await read_reply(reader)
+
+            await loop.run_in_executor(None, delivery_started.wait, 10)
+
+            stop_event.set()
+
+            # The idle session is closed
+            idle_replies = [await read_reply(idle_reader), await read_reply(idle_reader)]
+
+            # The delivery in progress gets its reply, and then the session
+            # is closed
+            finish_delivery.set()
+            replies = [await read_reply(reader), await read_reply(reader), await read_reply(reader)]
+
+            await asyncio.wait_for(serve_task, 10)
+
+            idle_writer.close()
+            writer.close()
+
+            return idle_replies, replies
+
+        with mock.patch("webmail.lmtp_server.deliver_message", side_effect=deliver):
+            idle_replies, replies = asyncio.run(run())
+
+        self.assertEqual(idle_replies, ["421 4.3.2 Server shutting down", ""])
+        self.assertEqual(replies, ["250 2.0.0 Delivered", "421 4.3.2 Server shutting down", ""])
+        self.assertFalse(os.path.exists(unix_socket))
@@ -0,0 +1,130 @@
+import os
+import tempfile
+
+from django.test import SimpleTestCase, TestCase
+
+from webmail.models import WebmailUser, Mailbox, Message
+from webmail.mail_import import import_messages, iter_maildir, iter_mbox
+
+
+MESSAGE_1 = b"From: a@example.com\nSubject: One\n\nFirst body\n"
+MESSAGE_2 = b"From: b@example.com\nSubject: Two\n\nSecond body\n"
+
+
+class IterMboxTest(SimpleTestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+
+        self.path = os.path.join(temp_dir.name, "mbox")
+
+    def read(self, contents, position=0):
+        with open(self.path, "wb") as f:
+            f.write(contents)
+
+        return list(iter_mbox(self.path, position=position))
+
+    def test_messages(self):
+        contents = b"From a@example.com Sat Oct 17 10:00:00 2026\n" + MESSAGE_1 + b"\nFrom b@example.com Sat Oct 17 11:00:00 2026\n" + MESSAGE_2
+
+        messages = self.read(contents)
+
+        self.assertEqual([message for message, _position in messages], [MESSAGE_1, MESSAGE_2])
+        # The offset of the next "From " line, and the end of the file
+        self.assertEqual([position for _message, position in messages], [contents.index(b"From b@"), len(contents)])
+
+    def test_resumed_from_position(self):
+        contents = b"From a@example.com Sat Oct 17 10:00:00 2026\n" + MESSAGE_1 + b"\nFrom b@example.com Sat Oct 17 11:00:00 2026\n" + MESSAGE_2
+
+        messages = self.read(contents, position=contents.index(b"From b@"))
+
+        self.assertEqual(messages, [(MESSAGE_2, len(contents))])
+
+    def test_crlf(self):
+        message = MESSAGE_1.replace(b"\n", b"\r\n")
+        contents = b"From a@example.com Sat Oct 17 10:00:00 2026\r\n" + message + b"\r\nFrom b@example.com Sat Oct 17 11:00:00 2026\r\n" + message
+
+        self.assertEqual([message for message, _position in self.read(contents)], [message, message])
+
+    def test_from_line_not_after_blank_line(self):
+        body = b"From: a@example.com\nSubject: One\n\nLine\nFrom here it's not a new message\n"
+
+        messages = self.read(b"From a@example.com Sat Oct 17 10:00:00 2026\n" + body)
+
+        self.assertEqual([message for message, _position in messages], [body])
+
+    def test_quoted_from_lines(self):
+        body = b"From: a@example.com\nSubject: One\n\n>From the body\n>>From quoted twice\n> From not quoted\n"
+
+        messages = self.read(b"From a@example.com Sat Oct 17 10:00:00 2026\n" + body)
+
+        self.assertEqual(messages[0][0], b"From: a@example.com\nSubject: One\n\nFrom the body\n>From quoted twice\n> From not quoted\n")
+
+    def test_empty(self):
+        self.assertEqual(self.read(b""), [])
+
+
+class ImportMboxTest(TestCase):
+    def setUp(self):
+        user = WebmailUser.objects.create_user(username="user", password="password")
+        self.mailbox = Mailbox.objects.create(user=user, name="mailbox", emails="user@example.com")
+
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+
+        self.path = os.path.join(temp_dir.name, "mbox")
+
+    def import_mbox(self, contents, folder_id=None):
+        with open(self.path, "wb") as f:
+            f.write(contents)
+
+        return import_messages(self.mailbox, iter_mbox(self.path), folder_id=folder_id)
+
+    def test_imported_before_skipped(self):
+        contents = b"From a@example.com Sat Oct 17 10:00:00 2026\nFrom: a@example.com\nTo: user@example.com\nSubject: One\nMessage-Id: <one@example.com>\n\nBody\n"
+
+        self.assertEqual(self.import_mbox(contents).num_messages, 1)
+
+        result = self.import_mbox(contents)
+
+        self.assertEqual((result.num_messages, result.num_duplicates), (0, 1))
+        self.assertEqual(self.mailbox.messages.count(), 1)
+
+    def test_sent_copy_not_duplicate(self):
+        # A message sent to oneself, its sent copy is already in the mailbox
+        contents = b"From user@example.com Sat Oct 17 10:00:00 2026\nFrom: user@example.com\nTo: user@example.com\nSubject: One\nMessage-Id: <one@example.com>\n\nBody\n"
+        self.import_mbox(contents, folder_id=Message.SENT_FOLDER_ID)
+
+        result = self.import_mbox(contents)
+
+        self.assertEqual((result.num_messages, result.num_duplicates), (1, 0))
+        self.assertEqual(self.mailbox.messages.filter(folder_id=Message.INBOX_FOLDER_ID, message_id="<one@example.com>").count(), 1)
+
+
+class IterMaildirTest(SimpleTestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+
+        self.path = temp_dir.name
+
+        for subdir, file_name, contents in [
+            ("cur", "2.host:2,S", MESSAGE_2),
+            ("cur", "1.host:2,S", MESSAGE_1),
+            ("new", "3.host", MESSAGE_1),
+        ]:
+            os.makedirs(os.path.join(self.path, subdir), exist_ok=True)
+            with open(os.path.join(self.path, subdir, file_name), "wb") as f:
+                f.write(contents)
+
+        os.makedirs(os.path.join(self.path, "tmp"))
+
+    def test_messages_in_order(self):
+        self.assertEqual(list(iter_maildir(self.path)), [
+            (MESSAGE_1, "cur/1.host:2,S"),
+            (MESSAGE_2, "cur/2.host:2,S"),
+            (MESSAGE_1, "new/3.host"),
+        ])
+
+    def test_resumed_after_position(self):
+        self.assertEqual([key for _message, key in iter_maildir(self.path, position="cur/2.host:2,S")], ["new/3.host"])
@@ -0,0 +1,51 @@
+import os
+import stat
+import tempfile
+
+from django.test import SimpleTestCase
+
+from webmail import mail_queue_notify
+from webmail.mail_queue_notify import QueueWakeupListener, notify_mail_queued
+
+
+class QueueWakeupSocketTest(SimpleTestCase):
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+
+        self.socket_dir = os.path.join(temp_dir.name, "wakeup")
+
+    def test_notify(self):
+        with QueueWakeupListener(socket_dir=self.socket_dir) as listener:
+            self.assertFalse(listener.wait(0))
+
+            notify_mail_queued(socket_dir=self.socket_dir)
+            notify_mail_queued(socket_dir=self.socket_dir)
+
+            self.assertTrue(listener.wait(1))
+            # Several notifications wake up only once
+            self.assertFalse(listener.wait(0))
+
+        self.assertEqual(os.listdir(self.socket_dir), [])
+
+    def test_permissions(self):
+        previous_umask = os.umask(0o077)
+        try:
+            with QueueWakeupListener(socket_dir=self.socket_dir, socket_mode=0o770) as listener:
+                self.assertEqual(stat.S_IMODE(os.stat(self.socket_dir).st_mode), 0o770)
+                self.assertEqual(stat.S_IMODE(os.stat(listener._socket_path).st_mode), 0o660)
+        finally:
+            os.umask(previous_umask)
+
+    def test_notify_error_logged_once(self):
+        self.addCleanup(setattr, mail_queue_notify, "_notify_error_logged", False)
+        mail_queue_notify._notify_error_logged = False
+
+        # Not a directory
+        open(self.socket_dir, "w").close()
+
+        with self.assertLogs(mail_queue_notify.logger, level="DEBUG") as logs:
+            notify_mail_queued(socket_dir=self.socket_dir)
+            notify_mail_queued(socket_dir=self.socket_dir)
+
+        self.assertEqual([record.levelname for record in logs.records], ["WARNING", "DEBUG"])
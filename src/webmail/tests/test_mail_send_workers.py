@@ -0,0 +1,45 @@
+import os
+import signal
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from webmail.mail_send_engine import SendMailStats
+from webmail.mail_send_workers import send_all_multiprocess
+
+
+def send_until_stopped(stop_event, **kwargs):
+    stats = SendMailStats()
+    if stop_event.wait(10):
+        stats.num_tasks_processed = 1
+
+    return stats
+
+
+class SendAllMultiprocessTest(SimpleTestCase):
+    def test_sigterm_stops_the_workers(self):
+        timer = threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGTERM))
+        timer.start()
+
+        start_time = time.monotonic()
+        try:
+            stats = send_all_multiprocess(2, send_function=send_until_stopped)
+        finally:
+            timer.cancel()
+
+        self.assertLess(time.monotonic() - start_time, 10)
+        # Both workers reported their stats after the stop event
+        self.assertEqual(stats.num_tasks_processed, 2)
+
+    def test_previous_signal_handlers_restored(self):
+        previous_handler = signal.getsignal(signal.SIGTERM)
+
+        timer = threading.Timer(0.2, os.kill, (os.getpid(), signal.SIGTERM))
+        timer.start()
+        try:
+            send_all_multiprocess(1, send_function=send_until_stopped)
+        finally:
+            timer.cancel()
+
+        self.assertIs(signal.getsignal(signal.SIGTERM), previous_handler)
@@ -0,0 +1,27 @@
+from unittest import mock
+
+from django.test import RequestFactory, TestCase
+
+from webmail.views import mailer_metrics
+
+
+class MailerMetricsViewTest(TestCase):
+    def get(self, remote_addr="127.0.0.1", **headers):
+        request = RequestFactory().get("/metrics", REMOTE_ADDR=remote_addr, headers=headers)
+        return mailer_metrics(request)
+
+    @mock.patch("webmail.settings.WEBMAIL_METRICS_TOKEN", None)
+    def test_without_token_only_localhost(self):
+        response = self.get(remote_addr="127.0.0.1")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"webmail_sendmail_queue_depth", response.content)
+
+        self.assertEqual(self.get(remote_addr="::1").status_code, 200)
+        self.assertEqual(self.get(remote_addr="192.0.2.10").status_code, 403)
+
+    @mock.patch("webmail.settings.WEBMAIL_METRICS_TOKEN", "secret")
+    def test_token(self):
+        self.assertEqual(self.get(remote_addr="192.0.2.10", authorization="Bearer secret").status_code, 200)
+        self.assertEqual(self.get(remote_addr="192.0.2.10", authorization="Bearer other").status_code, 403)
+        # Also required from localhost
+        self.assertEqual(self.get(remote_addr="127.0.0.1").status_code, 403)
@@ -0,0 +1,101 @@
+import io
+import os
+
+from django.core.files.base import ContentFile
+from django.core.mail import EmailMessage, EmailMultiAlternatives
+from django.test import SimpleTestCase
+
+from webmail.mime_writer import BASE64_READ_CHUNK_SIZE, StreamedAttachmentPart, write_message
+
+
+HEADERS = {
+    "Date": "Sun, 18 Oct 2026 10:00:00 -0000",
+    "Message-ID": "<test@example.com>",
+}
+
+
+def set_boundaries(msg):
+    for num_part, part in enumerate(msg.walk()):
+        if part.is_multipart():
+            part.set_boundary("===============%d==" % num_part)
+
+
+def write_to_bytes(msg):
+    fp = io.BytesIO()
+    write_message(fp, msg)
+    return fp.getvalue()
+
+
+class WriteMessageTest(SimpleTestCase):
+    def build_message(self, attachments, stream_attachments, html=None):
+        # Long and not ASCII, so it's folded and encoded
+        subject = "Informe trimestral de ventas con más de setenta y ocho caracteres de longitud, ñandú"
+        body = "Adjunto el informe.\n\nSaludos, José\n"
+
+        if html is not None:
+            email_message = EmailMultiAlternatives(subject=subject, body=body, from_email="from@example.com", to=["to@example.com"], headers=HEADERS)
+            email_message.attach_alternative(html, "text/html")
+        else:
+            email_message = EmailMessage(subject=subject, body=body, from_email="from@example.com", to=["to@example.com"], headers=HEADERS)
+
+        for file_name, contents, mimetype in attachments:
+            if stream_attachments:
+                email_message.attach(StreamedAttachmentPart(ContentFile(contents), file_name, mimetype=mimetype))
+            else:
+                email_message.attach(file_name, contents, mimetype=mimetype)
+
+        msg = email_message.message()
+        set_boundaries(msg)
+
+        return msg
+
+    def assertWrittenLikeAsBytes(self, attachments, html=None):
+        expected = self.build_message(attachments, stream_attachments=False, html=html).as_bytes(linesep="\r\n")
+        written = write_to_bytes(self.build_message(attachments, stream_attachments=True, html=html))
+
+        self.assertEqual(written, expected)
+
+    def test_attachments(self):
+        self.assertWrittenLikeAsBytes([
+            ("report.pdf", os.urandom(1000), "application/pdf"),
+            # Several chunks, the last one partial
+            ("data.bin", os.urandom(BASE64_READ_CHUNK_SIZE * 2 + 100), None),
+            ("empty.bin", b"", "application/octet-stream"),
+        ])
+
+    def test_not_ascii_file_name(self):
+        self.assertWrittenLikeAsBytes([("presupuesto año 2026.pdf", os.urandom(100), "application/pdf")])
+
+    def test_nested_multipart(self):
+        html = "<p>Adjunto el informe.</p><p>Saludos, José</p>"
+        self.assertWrittenLikeAsBytes([("photo.jpg", os.urandom(5000), "image/jpeg")], html=html)
+
+    def test_without_streamed_parts(self):
+        msg = self.build_message([("notes.txt", "Notas\n", "text/plain")], stream_attachments=False)
+
+        self.assertEqual(write_to_bytes(msg), msg.as_bytes(linesep="\r\n"))
+
+    def test_boundary_generated(self):
+        email_message = EmailMessage(subject="Subject", body="Body\n", from_email="from@example.com", to=["to@example.com"], headers=HEADERS)
+        email_message.attach(StreamedAttachmentPart(ContentFile(os.urandom(100)), "data.bin"))
+        msg = email_message.message()
+
+        written = write_to_bytes(msg)
+
+        # Kept in the message, so written the same by the email package
+        boundary = msg.get_boundary()
+        self.assertIsNotNone(boundary)
+        self.assertIn(b"\r\n--" + boundary.encode("ascii") + b"--\r\n", written)
+
+    def test_preamble_and_epilogue(self):
+        attachments = [("data.bin", os.urandom(100), None)]
+
+        for preamble, epilogue in [("Preamble", "Epilogue"), ("Preamble\n", "Epilogue\n"), ("Two\nlines", "\n"), ("", "")]:
+            with self.subTest(preamble=preamble, epilogue=epilogue):
+                expected_msg = self.build_message(attachments, stream_attachments=False)
+                msg = self.build_message(attachments, stream_attachments=True)
+                for m in (expected_msg, msg):
+                    m.preamble = preamble
+                    m.epilogue = epilogue
+
+                self.assertEqual(write_to_bytes(msg), expected_msg.as_bytes(linesep="\r\n"))
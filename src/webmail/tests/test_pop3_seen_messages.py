@@ -0,0 +1,82 @@
+import email
+from email.policy import default as email_policy
+
+from django.test import TestCase
+
+from webmail.models import WebmailUser, Mailbox, Pop3MailServer, Pop3SeenMessage
+
+
+def make_message(uid):
+    return ("From: sender@example.com\r\nTo: user@example.com\r\nSubject: Message %s\r\nMessage-Id: <%s@example.com>\r\n\r\nBody\r\n" % (uid, uid)).encode("ascii")
+
+
+class FakePop3Connection:
+    def __init__(self, uids):
+        # Message number -> unique id
+        self.uids = dict(enumerate(uids, 1))
+        self.num_retrieved = 0
+        self.deleted = []
+
+    def list_sizes(self):
+        return {message_number: len(make_message(uid)) for message_number, uid in self.uids.items()}
+
+    def list_uids(self):
+        return list(self.uids.items())
+
+    def retrieve_message(self, message_number):
+        self.num_retrieved += 1
+        return email.message_from_bytes(make_message(self.uids[message_number]), policy=email_policy)
+
+    def delete_message(self, message_number):
+        self.deleted.append(message_number)
+
+    def quit(self):
+        pass
+
+
+class Pop3SeenMessageTest(TestCase):
+    def setUp(self):
+        user = WebmailUser.objects.create_user(username="user", password="password")
+        mailbox = Mailbox.objects.create(user=user, name="mailbox", emails="user@example.com")
+        self.pop3_mail_server = Pop3MailServer.objects.create(mailbox=mailbox, ip_address="127.0.0.1", port=110, username="user", password="password", leave_messages_on_server=True)
+
+    def fetch(self, uids):
+        connection = FakePop3Connection(uids)
+        list(self.pop3_mail_server.get_new_mail(connection=connection))
+        return connection
+
+    def get_seen_uid_hashes(self):
+        return set(self.pop3_mail_server.seen_messages.values_list("uid_hash", flat=True))
+
+    def test_uid_hash(self):
+        uid_hash = Pop3SeenMessage.get_uid_hash("000001-abc")
+
+        self.assertEqual(uid_hash, Pop3SeenMessage.get_uid_hash("000001-abc"))
+        self.assertNotEqual(uid_hash, Pop3SeenMessage.get_uid_hash("000002-abc"))
+        # Fits in a signed 64 bits column
+        self.assertTrue(-2 ** 63 <= uid_hash < 2 ** 63)
+
+    def test_only_new_messages_downloaded(self):
+        connection = self.fetch(["a", "b"])
+        self.assertEqual(connection.num_retrieved, 2)
+        self.assertEqual(connection.deleted, [])
+
+        connection = self.fetch(["a", "b", "c"])
+        self.assertEqual(connection.num_retrieved, 1)
+
+        self.assertEqual(self.pop3_mail_server.mailbox.messages.count(), 3)
+        self.assertEqual(self.get_seen_uid_hashes(), {Pop3SeenMessage.get_uid_hash(uid) for uid in "abc"})
+
+    def test_messages_deleted_from_server_forgotten(self):
+        self.fetch(["a", "b", "c"])
+
+        connection = self.fetch(["c", "d"])
+        self.assertEqual(connection.num_retrieved, 1)
+
+        self.assertEqual(self.get_seen_uid_hashes(), {Pop3SeenMessage.get_uid_hash(uid) for uid in "cd"})
+
+    def test_same_uid_listed_twice(self):
+        connection = self.fetch(["a", "a"])
+
+        self.assertEqual(connection.num_retrieved, 1)
+        self.assertEqual(self.pop3_mail_server.seen_messages.count(), 1)
@@ -0,0 +1,80 @@
+import asyncio
+import smtplib
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from webmail.retry_policy import NETWORK_ERROR, PERMANENT_ERROR, TEMPORARY_ERROR, RetryPolicy, classify_send_error
+from webmail.smtp_transport import SMTPRecipientChunksFailed
+
+
+class ClassifySendErrorTest(SimpleTestCase):
+    def test_replies(self):
+        self.assertEqual(classify_send_error(smtplib.SMTPDataError(554, "Rejected")), PERMANENT_ERROR)
+        self.assertEqual(classify_send_error(smtplib.SMTPSenderRefused(550, "No", "from@example.com")), PERMANENT_ERROR)
+        self.assertEqual(classify_send_error(smtplib.SMTPDataError(451, "Try later")), TEMPORARY_ERROR)
+        self.assertEqual(classify_send_error(smtplib.SMTPResponseException(-1, "Connection lost")), NETWORK_ERROR)
+
+    def test_recipients_refused(self):
+        self.assertEqual(classify_send_error(smtplib.SMTPRecipientsRefused({"a@example.com": (550, "No"), "b@example.com": (553, "No")})), PERMANENT_ERROR)
+        # Some recipients could be accepted later
+        self.assertEqual(classify_send_error(smtplib.SMTPRecipientsRefused({"a@example.com": (550, "No"), "b@example.com": (450, "Busy")})), TEMPORARY_ERROR)
+
+    def test_network_errors(self):
+        self.assertEqual(classify_send_error(smtplib.SMTPServerDisconnected("Closed")), NETWORK_ERROR)
+        self.assertEqual(classify_send_error(ConnectionRefusedError()), NETWORK_ERROR)
+        self.assertEqual(classify_send_error(asyncio.TimeoutError()), NETWORK_ERROR)
+
+    def test_configuration_error(self):
+        self.assertEqual(classify_send_error(smtplib.SMTPNotSupportedError("STARTTLS")), PERMANENT_ERROR)
+
+    def test_unknown_error(self):
+        self.assertEqual(classify_send_error(ValueError()), TEMPORARY_ERROR)
+
+    def test_recipient_chunks(self):
+        permanent = (["a@example.com"], smtplib.SMTPDataError(554, "Rejected"))
+        temporary = (["b@example.com"], smtplib.SMTPDataError(451, "Try later"))
+        network = (["c@example.com"], smtplib.SMTPServerDisconnected("Closed"))
+
+        self.assertEqual(classify_send_error(SMTPRecipientChunksFailed([permanent, permanent], {}, 3)), PERMANENT_ERROR)
+        self.assertEqual(classify_send_error(SMTPRecipientChunksFailed([permanent, temporary], {}, 3)), TEMPORARY_ERROR)
+        self.assertEqual(classify_send_error(SMTPRecipientChunksFailed([temporary, network], {}, 3)), NETWORK_ERROR)
+
+
+class FakeTask:
+    def __init__(self, num_deferred_times=0):
+        self.num_deferred_times = num_deferred_times
+
+
+class RetryPolicyTest(SimpleTestCase):
+    def setUp(self):
+        self.policy = RetryPolicy(base_delay=60, max_delay=3600, backoff_factor=2, jitter=0, max_times_deferred=5)
+
+    def test_exponential_backoff(self):
+        self.assertEqual([self.policy.get_delay(num_deferred_times) for num_deferred_times in range(8)], [60, 120, 240, 480, 960, 1920, 3600, 3600])
+
+        # No overflow
+        self.assertEqual(self.policy.get_delay(10000), 3600)
+
+    def test_jitter(self):
+        policy = RetryPolicy(base_delay=100, max_delay=3600, backoff_factor=2, jitter=0.2)
+
+        with mock.patch("webmail.retry_policy.random.uniform", side_effect=lambda a, b: b):
+            self.assertEqual(policy.get_delay(0), 100)
+
+        with mock.patch("webmail.retry_policy.random.uniform", side_effect=lambda a, b: a):
+            self.assertEqual(policy.get_delay(0), 80)
+
+    def test_retry_delay(self):
+        self.assertEqual(self.policy.get_retry_delay(FakeTask(2), smtplib.SMTPDataError(451, "Try later")), 240)
+        self.assertEqual(self.policy.get_retry_delay(FakeTask(0), smtplib.SMTPServerDisconnected("Closed")), 60)
+
+    def test_permanent_error_not_retried(self):
+        self.assertIsNone(self.policy.get_retry_delay(FakeTask(0), smtplib.SMTPDataError(554, "Rejected")))
+
+    def test_max_times_deferred(self):
+        self.assertIsNotNone(self.policy.get_retry_delay(FakeTask(4), smtplib.SMTPDataError(451, "Try later")))
+        self.assertIsNone(self.policy.get_retry_delay(FakeTask(5), smtplib.SMTPDataError(451, "Try later")))
+
+        policy = RetryPolicy(base_delay=60, max_delay=3600, jitter=0, max_times_deferred=None)
+        self.assertIsNotNone(policy.get_retry_delay(FakeTask(1000), smtplib.SMTPDataError(451, "Try later")))
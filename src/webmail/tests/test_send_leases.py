@@ -0,0 +1,96 @@
+import datetime
+from unittest import mock
+
+from django.test import TestCase
+from django.utils import timezone
+
+from webmail.models import SendMailTask
+from webmail.mail_send_benchmark import SmtpSink, seed_send_mail_tasks
+from webmail.mail_send_engine import send_all
+
+
+def save_payloads_in_tasks(test_case):
+    # The spooled payloads are deleted when the transaction is committed,
+    # they would be left behind
+    patcher = mock.patch("webmail.settings.WEBMAIL_MAILER_SPOOL_DIR", None)
+    patcher.start()
+    test_case.addCleanup(patcher.stop)
+
+
+class SendMailTaskLeaseTest(TestCase):
+    def setUp(self):
+        save_payloads_in_tasks(self)
+        seed_send_mail_tasks(3, "127.0.0.1", 25)
+
+    def test_claim(self):
+        lease_token, tasks = SendMailTask.objects.claim(limit=2, lease_duration=60)
+
+        self.assertEqual(len(tasks), 2)
+        self.assertEqual(SendMailTask.objects.filter(lease_token=lease_token, status=SendMailTask.STATUS_IN_PROGRESS).count(), 2)
+
+        # Each task is claimed only once
+        other_lease_token, other_tasks = SendMailTask.objects.claim(limit=2, lease_duration=60)
+        self.assertNotEqual(other_lease_token, lease_token)
+        self.assertEqual(len(other_tasks), 1)
+        self.assertFalse({task.pk for task in tasks} & {task.pk for task in other_tasks})
+
+        self.assertEqual(SendMailTask.objects.claim(limit=2)[1], [])
+
+    def test_claim_task_created_directly(self):
+        # Not created by `create_from_message`, e.g. in the admin
+        task = SendMailTask.objects.create(mailbox=SendMailTask.objects.first().mailbox, email_recipients=["to@example.com"], multipart_mail_message=b"Subject: Test\r\n\r\nBody\r\n")
+
+        _lease_token, tasks = SendMailTask.objects.claim(limit=4, lease_duration=60)
+
+        self.assertIn(task.pk, {task.pk for task in tasks})
+
+    def test_extend_lease(self):
+        lease_token, tasks = SendMailTask.objects.claim(limit=2, lease_duration=60)
+
+        self.assertEqual(SendMailTask.objects.extend_lease(lease_token, lease_duration=3600), 2)
+
+        for task in SendMailTask.objects.filter(lease_token=lease_token):
+            self.assertGreater(task.lease_expires_at, timezone.now() + datetime.timedelta(seconds=3000))
+
+    def test_release_lease(self):
+        lease_token, tasks = SendMailTask.objects.claim(limit=2, lease_duration=60)
+
+        self.assertEqual(SendMailTask.objects.release_lease(lease_token), 2)
+        self.assertEqual(SendMailTask.objects.filter(status=SendMailTask.STATUS_QUEUED, lease_token=None).count(), 3)
+
+    def test_requeue_expired_leases(self):
+        expired_lease_token, expired_tasks = SendMailTask.objects.claim(limit=1, lease_duration=60)
+        SendMailTask.objects.filter(lease_token=expired_lease_token).update(lease_expires_at=timezone.now() - datetime.timedelta(seconds=1))
+
+        lease_token, tasks = SendMailTask.objects.claim(limit=1, lease_duration=60)
+
+        self.assertEqual(SendMailTask.objects.requeue_expired_leases(), 1)
+        self.assertEqual(SendMailTask.objects.get(pk=expired_tasks[0].pk).status, SendMailTask.STATUS_QUEUED)
+        self.assertEqual(SendMailTask.objects.get(pk=tasks[0].pk).status, SendMailTask.STATUS_IN_PROGRESS)
+
+
+class SendAllLeaseTest(TestCase):
+    def setUp(self):
+        save_payloads_in_tasks(self)
+
+    def test_leases_renewed_until_results_written(self):
+        extended_lease_tokens = []
+
+        def extend_lease(lease_token, lease_duration):
+            extended_lease_tokens.append(lease_token)
+            return 0
+
+        with SmtpSink() as sink:
+            seed_send_mail_tasks(4, sink.host, sink.port)
+
+            # With a lease of 0 seconds, the heartbeat runs before each task
+            with mock.patch.object(SendMailTask.objects, "extend_lease", side_effect=extend_lease):
+                stats = send_all(claim_batch_size=2, lease_duration=0, throttle_time=0, outcome_flush_size=10, outcome_flush_interval=None)
+
+        self.assertEqual(stats.num_succeed, 4)
+        self.assertEqual(SendMailTask.objects.filter(status=SendMailTask.STATUS_IN_PROGRESS).count(), 0)
+
+        # The lease of the first batch is renewed while sending the second,
+        # its results are not written yet
+        first_lease_token = extended_lease_tokens[0]
+        self.assertEqual(extended_lease_tokens.count(first_lease_token), 4)
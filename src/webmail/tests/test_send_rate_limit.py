@@ -0,0 +1,79 @@
+from unittest import mock
+
+from django.test import TestCase
+
+from webmail.models import SendRateLimitBucket
+
+
+class SendRateLimitBucketTest(TestCase):
+    def setUp(self):
+        self.now = 1000.0
+
+        patcher = mock.patch("webmail.models.time.time", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def acquire(self, rate=1, burst=3):
+        return SendRateLimitBucket.objects.acquire("smtp_server:1", rate, burst=burst)
+
+    def test_burst(self):
+        self.assertEqual([self.acquire() for i in range(3)], [0, 0, 0])
+
+        # Empty until the next token, one second later
+        self.assertAlmostEqual(self.acquire(), 1)
+
+        self.now += 0.5
+        self.assertAlmostEqual(self.acquire(), 0.5)
+
+        self.now += 0.5
+        self.assertEqual(self.acquire(), 0)
+        self.assertAlmostEqual(self.acquire(), 1)
+
+    def test_refilled_up_to_burst(self):
+        for i in range(3):
+            self.acquire()
+
+        # Idle for long, the tokens don't accumulate beyond the burst
+        self.now += 100
+        self.assertEqual([self.acquire() for i in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(self.acquire(), 1)
+
+    def test_rate(self):
+        self.assertEqual(self.acquire(rate=10, burst=1), 0)
+        self.assertAlmostEqual(self.acquire(rate=10, burst=1), 0.1)
+
+    def test_buckets_independent(self):
+        self.assertEqual(self.acquire(burst=1), 0)
+        self.assertGreater(self.acquire(burst=1), 0)
+
+        self.assertEqual(SendRateLimitBucket.objects.acquire("domain:example.com", 1, burst=1), 0)
+
+    def test_refund(self):
+        for i in range(3):
+            self.acquire()
+
+        SendRateLimitBucket.objects.refund("smtp_server:1", 1)
+
+        self.assertEqual(self.acquire(), 0)
+        self.assertGreater(self.acquire(), 0)
+
+    def test_concurrent_update_retried(self):
+        self.acquire(burst=2)
+
+        # Another process takes a token between the read and the update
+        original_filter = SendRateLimitBucket.objects.filter
+        num_calls = 0
+
+        def filter(*args, **kwargs):
+            nonlocal num_calls
+            num_calls += 1
+            if num_calls == 1:
+                original_filter(key="smtp_server:1").update(theoretical_arrival_time=self.now + 2)
+
+            return original_filter(*args, **kwargs)
+
+        with mock.patch.object(SendRateLimitBucket.objects, "filter", side_effect=filter):
+            wait_time = self.acquire(burst=2)
+
+        # Retried with the new state, the bucket is empty now
+        self.assertAlmostEqual(wait_time, 1)
@@ -0,0 +1,125 @@
+import smtplib
+
+from django.test import SimpleTestCase
+
+from webmail.smtp_transport import SMTPRecipientChunksFailed, SmtpConnectionPool, split_recipients
+
+
+class FakeTransport:
+    def __init__(self, outcomes):
+        # What each call to sendmail does: an exception to raise, with the
+        # value of `mail_accepted` when it's raised, or a result
+        self.outcomes = outcomes
+        self.mail_accepted = False
+        self.last_used_at = 0
+        self.closed = False
+        self.num_sent = 0
+        self.recipient_lists = []
+
+    def reset(self):
+        pass
+
+    def sendmail(self, from_email, recipient_list, multipart_mail_message):
+        self.num_sent += 1
+        self.recipient_lists.append(recipient_list)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, tuple):
+            exception, self.mail_accepted = outcome
+            raise exception
+
+        return outcome
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSmtpServer:
+    pk = 1
+    ip_address = "127.0.0.1"
+    port = 25
+    username = "user"
+    password = "password"
+    use_ssl = False
+    use_tls = False
+
+    def __init__(self, transports):
+        self.transports = transports
+
+    def get_connection(self):
+        return self.transports.pop(0)
+
+
+class SmtpConnectionPoolReconnectTest(SimpleTestCase):
+    def send_with_reused_session(self, first_outcome):
+        reused_transport = FakeTransport([{}, first_outcome])
+        new_transport = FakeTransport([{}])
+        smtp_server = FakeSmtpServer([reused_transport, new_transport])
+
+        pool = SmtpConnectionPool(idle_timeout=None)
+        pool.send_mail(smtp_server, "from@example.com", ["to@example.com"], b"message")
+        # Sent with the session kept in the pool
+        pool.send_mail(smtp_server, "from@example.com", ["to@example.com"], b"message")
+
+        return pool, smtp_server, new_transport
+
+    def test_resent_if_disconnected_before_mail_from_accepted(self):
+        pool, smtp_server, new_transport = self.send_with_reused_session((smtplib.SMTPServerDisconnected("closed"), False))
+
+        self.assertEqual(new_transport.num_sent, 1)
+
+    def test_not_resent_if_disconnected_after_mail_from_accepted(self):
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            self.send_with_reused_session((smtplib.SMTPServerDisconnected("closed"), True))
+
+    def test_new_session_not_retried(self):
+        transport = FakeTransport([(smtplib.SMTPServerDisconnected("closed"), False)])
+        smtp_server = FakeSmtpServer([transport])
+
+        pool = SmtpConnectionPool(idle_timeout=None)
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            pool.send_mail(smtp_server, "from@example.com", ["to@example.com"], b"message")
+
+        self.assertTrue(transport.closed)
+        self.assertEqual(len(pool), 0)
+
+
+class RecipientChunksTest(SimpleTestCase):
+    recipients = ["%s@example.com" % name for name in "abcde"]
+
+    def test_split_recipients(self):
+        self.assertEqual(split_recipients(self.recipients, 2), [self.recipients[0:2], self.recipients[2:4], self.recipients[4:]])
+        self.assertEqual(split_recipients(self.recipients, 5), [self.recipients])
+        self.assertEqual(split_recipients(self.recipients, None), [self.recipients])
+        self.assertEqual(split_recipients("a@example.com", 2), [["a@example.com"]])
+
+    def send(self, outcomes):
+        transport = FakeTransport(outcomes)
+        pool = SmtpConnectionPool(idle_timeout=None, max_recipients=2)
+
+        try:
+            return pool.send_mail(FakeSmtpServer([transport]), "from@example.com", self.recipients, b"message"), transport
+        except SMTPRecipientChunksFailed as e:
+            return e, transport
+
+    def test_refused_recipients_of_all_chunks(self):
+        refused_recipients, transport = self.send([{"a@example.com": (550, "No")}, {}, {"e@example.com": (450, "Busy")}])
+
+        self.assertEqual(transport.recipient_lists, [self.recipients[0:2], self.recipients[2:4], self.recipients[4:]])
+        self.assertEqual(refused_recipients, {"a@example.com": (550, "No"), "e@example.com": (450, "Busy")})
+
+    def test_failed_chunk(self):
+        exception, transport = self.send([{"a@example.com": (550, "No")}, (smtplib.SMTPDataError(451, "Try later"), True), {}])
+
+        # The next chunks are sent in the same session
+        self.assertEqual(transport.num_sent, 3)
+        self.assertEqual(exception.failed_chunks, [(self.recipients[2:4], exception.failed_chunks[0][1])])
+        self.assertIsInstance(exception.failed_chunks[0][1], smtplib.SMTPDataError)
+        self.assertEqual(exception.refused_recipients, {"a@example.com": (550, "No")})
+        self.assertEqual(exception.num_chunks, 3)
+
+    def test_session_error_fails_next_chunks(self):
+        exception, transport = self.send([{}, (smtplib.SMTPServerDisconnected("closed"), True)])
+
+        self.assertEqual(transport.num_sent, 2)
+        self.assertEqual([recipients for recipients, _exception in exception.failed_chunks], [self.recipients[2:4], self.recipients[4:]])
+        self.assertIs(exception.failed_chunks[0][1], exception.failed_chunks[1][1])
@@ -41,6 +41,9 @@ urlpatterns.extend([
 ])
 
 
+if settings.WEBMAIL_METRICS_ENABLED:
+    urlpatterns.append(path('metrics', views.mailer_metrics, name="metrics"))
+
 if settings.WEBMAIL_ACCESS_LOGS_ENABLED:
     urlpatterns.append(
         path('mail/access_logs/', views.AccessLogsListView.as_view(), name="access_logs"),
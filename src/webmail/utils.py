@@ -130,3 +130,17 @@ def decode_payload(encoding, payload):
         return quopri.decodestring(payload)
     return payload
 
+
+
+def chunked(iterable, size):
+    """Yields lists of up to `size` items of the iterable."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
@@ -12,12 +12,13 @@ from email.errors import MessageParseError, MessageDefect
 from urllib.parse import urlencode
 
 
-from django.http.response import JsonResponse, FileResponse, HttpResponseRedirect, HttpResponseNotAllowed, Http404
+from django.http.response import HttpResponse, JsonResponse, FileResponse, HttpResponseRedirect, HttpResponseNotAllowed, HttpResponseForbidden, Http404
 from django.shortcuts import render, get_object_or_404
 from django.utils.translation import gettext as _
 from django.utils.decorators import method_decorator
 from django.utils.formats import localize
 from django.utils.safestring import mark_safe
+from django.utils.crypto import constant_time_compare
 from django.utils.encoding import escape_uri_path, iri_to_uri
 from django.contrib import messages as admin_messages
 from django.contrib.auth import REDIRECT_FIELD_NAME
@@ -43,13 +44,14 @@ from .auth_decorators import login_required
 from .auth import login as auth_login, logout as auth_logout, update_session_auth_hash
 from .srp import Verifier as SRP_Verifier, gN
 from .models import Mailbox, SmtpServer, Pop3MailServer, Message, MessageAttachment, MessageTag, UploadAttachmentSession, ContactUser, WebmailUser, UnknownFolderException, AccessLog, InvalidEmailMessageException, WebmailSession
-from .signals import file_attachment_uploaded_signal, attachment_downloaded_signal, message_flagged_as_spam_signal, message_flagged_as_not_spam_signal, message_queued_signal, attachments_uploaded_signal, user_logged_in_signal
+from .signals import file_attachment_uploaded_signal, attachment_downloaded_signal, message_flagged_as_spam_signal, message_flagged_as_not_spam_signal, attachments_uploaded_signal, user_logged_in_signal
 from .forms import MailActionForm, ComposeMailForm, MailboxForm, Pop3MailServerForm, MailboxActionForm, ContactForm, ContactActionForm, UsernameForm, SignUpForm, SRPUserInfoForm, SmtpServerForm
 #from .email_signature import EmailSignature
 from .ajax import ajax, AJAXError, InvalidAjaxRequest, FormAJAXError
 from .utils import format_body_reply
 from .hooks import dispatch_hook
 from .webmail_url_utils import reverse_webmail_url, get_folder_url, get_url_patterns_string_formats, redirect
+from .metrics import collect as collect_mailer_metrics, render_prometheus
 from .logutils import get_logger
 from . import settings
 
@@ -1815,8 +1817,6 @@ def mail_send(request, mailbox):
     else:
         message.dispatch()
 
-        message_queued_signal.send(sender=Message, message=message)
-
         return {
             "message_id": message.id,
         }
@@ -2089,8 +2089,6 @@ def finnished_attachments_session(request, mailbox, upload_session_id):
     message = upload_session.message_obj_reference
     message.dispatch()
 
-    message_queued_signal.send(sender=Message, message=message)
-
     upload_session.delete()
 
     free_space = calculate_free_space(user)
@@ -2876,4 +2874,24 @@ def delete_other_sessions(request):
 
         admin_messages.success(request, success_message)
 
-    return redirect("control_sessions", mailbox=request.current_mailbox)
\ No newline at end of file
+    return redirect("control_sessions", mailbox=request.current_mailbox)
+
+
+LOCALHOST_ADDRESSES = ("127.0.0.1", "::1")
+
+
+@require_GET
+def mailer_metrics(request):
+    """
+    Metrics of the mailer in the text format of Prometheus. If the setting
+    `WEBMAIL_METRICS_TOKEN` is defined, the request needs the header
+    "Authorization: Bearer <token>". Otherwise, they are only served to
+    requests from localhost.
+    """
+    if settings.WEBMAIL_METRICS_TOKEN is not None:
+        if not constant_time_compare(request.headers.get("Authorization", ""), "Bearer " + settings.WEBMAIL_METRICS_TOKEN):
+            return HttpResponseForbidden()
+    elif request.META.get("REMOTE_ADDR") not in LOCALHOST_ADDRESSES:
+        return HttpResponseForbidden()
+
+    return HttpResponse(render_prometheus(collect_mailer_metrics()), content_type="text/plain; version=0.0.4; charset=utf-8")